@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ComfyMiddleware.apply_inputs 微基准测试
+
+对比三种填参方式在大模板上的耗时：
+1. legacy:   旧实现 (每个通用键名都扫描全部节点, O(keys x nodes))
+2. compile:  每次现场编译 BindingPlan 后填参
+3. plan:     使用 TemplateCache 中预编译的 BindingPlan 直接写入
+
+模板副本 (marshal.loads) 在计时外准备，结果只反映填参本身。
+
+用法:
+    python benchmarks/bench_comfy_apply_inputs.py [--nodes 3000] [--rounds 200]
+"""
+
+import os
+import sys
+import time
+import marshal
+import argparse
+import importlib.util
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tapnow-server-full.py")
+
+
+def load_server():
+    spec = importlib.util.spec_from_file_location("tapnow_server_full", SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_template(node_count):
+    workflow = {
+        "3": {"class_type": "KSampler", "inputs": {"seed": 1, "steps": 20, "cfg": 7, "sampler_name": "euler", "scheduler": "normal"}},
+        "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 512, "height": 512, "batch_size": 1}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "positive"}},
+    }
+    for i in range(node_count):
+        workflow[str(100 + i)] = {
+            "class_type": "Custom",
+            "inputs": {"value": i, "strength": 1.0, "mode": "a", "image": ["3", 0]}
+        }
+    params_map = {f"p{i}": {"node_id": str(100 + i), "field": "inputs.value"} for i in range(0, node_count, max(1, node_count // 30))}
+    params_map["cfg"] = {"node_id": "3", "field": "inputs.cfg"}
+    return workflow, params_map
+
+
+def build_inputs(params_map):
+    inputs = {key: "42" for key in params_map}
+    inputs.update({
+        "prompt": "a cat", "seed": "1234", "steps": "30", "width": "768", "height": "768",
+        "batch_size": "2", "sampler_name": "dpmpp_2m", "scheduler": "karras",
+        "3:KSampler.denoise": "0.8", "5.batch_size": "1"
+    })
+    return inputs
+
+
+def legacy_apply_inputs(server, workflow, params_map, user_inputs):
+    """旧版 Dict 模式填参 (仅保留耗时相关逻辑)"""
+    mw = server.ComfyMiddleware
+
+    def find_unique_node_with_input(input_name):
+        return [nid for nid, node in workflow.items()
+                if isinstance(node, dict) and isinstance(node.get('inputs'), dict) and input_name in node['inputs']]
+
+    for key, val in user_inputs.items():
+        key = server.normalize_input_key(key)
+        value = mw.coerce_value(val)
+        if key in params_map:
+            mapping = params_map[key]
+            node_id = str(mapping.get('node_id', '')).strip()
+            field_path = (mapping.get('field', '') or '').split('.')
+            if node_id in workflow:
+                mw.set_by_path(workflow[node_id], field_path, value)
+            continue
+        if ':' in key or '.' in key:
+            node_id = key.replace(':', '.').split('.', 1)[0]
+            if node_id in workflow:
+                workflow[node_id]['inputs'][key.split('.')[-1]] = value
+            continue
+        for input_name in server.INPUT_ALIASES.get(key, ()):
+            matches = find_unique_node_with_input(input_name)
+            if len(matches) == 1:
+                workflow[matches[0]]['inputs'][input_name] = value
+                break
+        if key in ("seed", "steps", "width", "height"):
+            find_unique_node_with_input(key)
+    return workflow
+
+
+def bench(label, blob, rounds, func):
+    # 模板副本在计时外准备，只统计填参本身
+    copies = [marshal.loads(blob) for _ in range(rounds)]
+    start = time.perf_counter()
+    for workflow in copies:
+        func(workflow)
+    elapsed = (time.perf_counter() - start) / rounds
+    print(f"  {label:<10} {elapsed * 1000:8.3f} ms / job")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="apply_inputs micro benchmark")
+    parser.add_argument("--nodes", type=int, default=3000)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    server = load_server()
+    server.config["log_enabled"] = False
+    workflow, params_map = build_template(args.nodes)
+    user_inputs = build_inputs(params_map)
+    blob = marshal.dumps(workflow)
+    plan = server.BindingPlan(workflow, params_map)
+    apply_inputs = server.ComfyMiddleware.apply_inputs
+
+    print(f"nodes={len(workflow)} inputs={len(user_inputs)} rounds={args.rounds}")
+    legacy = bench("legacy", blob, args.rounds, lambda wf: legacy_apply_inputs(server, wf, params_map, user_inputs))
+    compiled = bench("compile", blob, args.rounds, lambda wf: apply_inputs(wf, params_map, user_inputs))
+    planned = bench("plan", blob, args.rounds, lambda wf: apply_inputs(wf, params_map, user_inputs, plan))
+    print(f"speedup: legacy/plan = {legacy / planned:.1f}x, compile/plan = {compiled / planned:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
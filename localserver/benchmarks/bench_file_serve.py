@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+/file/ 文件输出基准测试
+
+对比三种发送方式下的吞吐量 (MB/s) 与服务端 CPU 开销 (CPU 秒 / GB)：
+1. legacy:   旧实现 (8KB f.read + wfile.write 循环)
+2. buffer:   1MB 缓冲区复制 (无 sendfile 时的回退路径)
+3. sendfile: socket.sendfile 零拷贝 (平台不支持 os.sendfile 时跳过)
+
+服务端在本进程内运行，下载客户端在独立子进程中运行，CPU 统计只包含服务端。
+
+用法:
+    python benchmarks/bench_file_serve.py [--size-mb 256] [--rounds 4]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import importlib.util
+from http.server import ThreadingHTTPServer
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tapnow-server-full.py")
+
+CLIENT_SCRIPT = r"""
+import sys, http.client
+port, path, rounds = int(sys.argv[1]), sys.argv[2], int(sys.argv[3])
+for _ in range(rounds):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', path)
+    resp = conn.getresponse()
+    while resp.read(1024 * 1024):
+        pass
+    conn.close()
+"""
+
+
+def load_server():
+    spec = importlib.util.spec_from_file_location("tapnow_server_full", SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system
+
+
+def run_mode(server, port, rel_path, rounds, total_bytes):
+    started_cpu = cpu_seconds()
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", CLIENT_SCRIPT, str(port), f"/file/{rel_path}", str(rounds)], check=True)
+    elapsed = time.perf_counter() - started
+    cpu = cpu_seconds() - started_cpu
+    gigabytes = total_bytes / (1024 ** 3)
+    return total_bytes / (1024 * 1024) / elapsed, cpu / gigabytes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--rounds", type=int, default=4)
+    args = parser.parse_args()
+
+    server = load_server()
+    server.config["log_enabled"] = False
+    work_dir = tempfile.mkdtemp(prefix="tapnow-bench-")
+    server.config["save_path"] = work_dir
+    rel_path = "bench.mp4"
+    with open(os.path.join(work_dir, rel_path), "wb") as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(args.size_mb):
+            f.write(block)
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), server.TapnowFullHandler)
+    port = httpd.server_address[1]
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    modes = [("legacy", 8192, False), ("buffer", server.FILE_COPY_BUFFER_SIZE, False)]
+    if hasattr(os, "sendfile"):
+        modes.append(("sendfile", server.FILE_COPY_BUFFER_SIZE, True))
+
+    total_bytes = args.size_mb * 1024 * 1024 * args.rounds
+    print(f"file={args.size_mb}MB rounds={args.rounds}")
+    try:
+        for name, buffer_size, use_sendfile in modes:
+            server.FILE_COPY_BUFFER_SIZE = buffer_size
+            server.config["file_sendfile_enabled"] = use_sendfile
+            throughput, cpu_per_gb = run_mode(server, port, rel_path, args.rounds, total_bytes)
+            print(f"{name:>8}: {throughput:8.1f} MB/s  {cpu_per_gb:6.3f} CPU s/GB")
+    finally:
+        httpd.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
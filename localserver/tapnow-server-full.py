@@ -17,6 +17,7 @@ Tapnow Studio 本地全功能服务器 (Tapnow Local Server Full)
 
 import os
 import sys
+import errno
 import json
 import random
 import base64
@@ -27,13 +28,25 @@ import http.client
 import queue
 import time
 import uuid
+import select
+import socket
+import struct
 import mimetypes
+import marshal
+import itertools
+import hashlib
+import gzip
+import zlib
+import tempfile
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, unquote, parse_qs
+from urllib.parse import urlparse, unquote, parse_qs, urljoin
 from datetime import datetime
+from collections import OrderedDict
 from io import BytesIO
-from email.utils import formatdate
+from email.utils import formatdate, parsedate_to_datetime
+from email.message import Message
 
 # ==============================================================================
 # SECTION 1: 依赖检查与全局配置
@@ -47,6 +60,19 @@ except ImportError:
     PIL_AVAILABLE = False
     print("[提示] PIL未安装，PNG转JPG功能将不可用 (pip install Pillow)")
 
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+try:
+    import sqlite3
+    SQLITE_AVAILABLE = True
+except ImportError:
+    SQLITE_AVAILABLE = False
+    print("[提示] sqlite3不可用，/list-files 将使用目录遍历 (无索引)")
+
 try:
     import websocket
     WS_AVAILABLE = True
@@ -92,6 +118,7 @@ DEFAULT_PROXY_ALLOWED_HOSTS = [
 ]
 DEFAULT_PROXY_TIMEOUT = 300
 CONFIG_FILENAME = "tapnow-local-config.json"
+FILE_COPY_BUFFER_SIZE = 1024 * 1024  # 无法零拷贝时的复制缓冲区
 LOCAL_FILE_CACHE_CONTROL = "public, max-age=31536000, immutable"
 PROXY_MEDIA_CACHE_CONTROL = "public, max-age=86400, stale-while-revalidate=604800"
 MEDIA_FILE_EXTENSIONS = {
@@ -118,17 +145,54 @@ config = {
     "allow_overwrite": False,
     "log_enabled": True,
     "convert_png_to_jpg": True,
-    "jpg_quality": 95
+    "jpg_quality": 95,
+    "file_sendfile_enabled": True,
+    "file_memory_cache_mb": 64,
+    "file_memory_cache_max_kb": 512,
+    "file_memory_cache_check_interval": 2,
+    "file_path_cache_ttl": 5,
+    "file_path_cache_max_entries": 10000,
+    "media_index_enabled": True,
+    "media_index_rescan_interval": 2,
+    "media_index_tombstone_retention": 10000,
+    "response_compression_enabled": True,
+    "response_compression_min_bytes": 1024,
+    "response_compression_level": 6,
+    "proxy_pool_enabled": True,
+    "proxy_pool_max_per_host": 8,
+    "proxy_pool_idle_timeout": 60,
+    "proxy_max_body_mb": 2048,
+    "save_max_upload_mb": 4096,
+    "save_download_connect_timeout": 10,
+    "save_download_timeout": 60,
+    "save_download_max_mb": 4096,
+    "save_download_max_redirects": 5,
+    "save_download_restrict_hosts": True,
+    "proxy_cache_enabled": True,
+    "proxy_cache_max_mb": 2048,
+    "proxy_cache_max_entry_mb": 256,
+    "proxy_cache_ttl": 604800,
+    "proxy_coalesce_enabled": True,
+    "comfy_backends": [COMFY_URL],
+    "comfy_max_inflight": 2,
+    "comfy_job_timeout": 600,
+    "comfy_job_ttl": 3600,
+    "comfy_job_max_entries": 1000,
+    "comfy_template_cache_mb": 64,
+    "comfy_batch_max_jobs": 1000,
+    "comfy_result_cache_enabled": False,
+    "comfy_result_cache_max_entries": 500,
+    "comfy_result_cache_ttl": 86400,
+    "comfy_prefetch_outputs": False,
+    "comfy_prefetch_subfolder": "comfy",
+    "comfy_prefetch_workers": 4
 }
 
 # 1.5 全局状态对象
 # ComfyUI 队列相关
 JOB_QUEUE = queue.Queue()
-JOB_STATUS = {}
-STATUS_LOCK = threading.Lock()
 CLIENT_ID = str(uuid.uuid4())
-WS_MESSAGES = {}
-PROMPT_TO_JOB = {}
+PROMPT_TRACKERS = {}  # prompt_id -> PromptTracker (由 WebSocket 消息驱动完成)
 
 # ==============================================================================
 # SECTION 2: 核心工具函数 (Core Utilities)
@@ -162,6 +226,47 @@ def load_config_file():
         if data.get("allowed_roots"): config["allowed_roots"] = data["allowed_roots"]
         if data.get("proxy_allowed_hosts"): config["proxy_allowed_hosts"] = data["proxy_allowed_hosts"]
         if data.get("proxy_timeout"): config["proxy_timeout"] = int(data["proxy_timeout"])
+        if "file_sendfile_enabled" in data: config["file_sendfile_enabled"] = bool(data["file_sendfile_enabled"])
+        if "file_memory_cache_mb" in data: config["file_memory_cache_mb"] = float(data["file_memory_cache_mb"] or 0)
+        if data.get("file_memory_cache_max_kb"): config["file_memory_cache_max_kb"] = float(data["file_memory_cache_max_kb"])
+        if "file_path_cache_ttl" in data: config["file_path_cache_ttl"] = float(data["file_path_cache_ttl"] or 0)
+        if "media_index_enabled" in data: config["media_index_enabled"] = bool(data["media_index_enabled"])
+        if "media_index_rescan_interval" in data: config["media_index_rescan_interval"] = float(data["media_index_rescan_interval"] or 0)
+        if "media_index_tombstone_retention" in data: config["media_index_tombstone_retention"] = max(0, int(data["media_index_tombstone_retention"] or 0))
+        if "response_compression_enabled" in data: config["response_compression_enabled"] = bool(data["response_compression_enabled"])
+        if "response_compression_min_bytes" in data: config["response_compression_min_bytes"] = int(data["response_compression_min_bytes"] or 0)
+        if data.get("response_compression_level"): config["response_compression_level"] = int(data["response_compression_level"])
+        if data.get("file_path_cache_max_entries"): config["file_path_cache_max_entries"] = int(data["file_path_cache_max_entries"])
+        if "file_memory_cache_check_interval" in data: config["file_memory_cache_check_interval"] = float(data["file_memory_cache_check_interval"] or 0)
+        if "proxy_pool_enabled" in data: config["proxy_pool_enabled"] = bool(data["proxy_pool_enabled"])
+        if "proxy_pool_max_per_host" in data: config["proxy_pool_max_per_host"] = max(0, int(data["proxy_pool_max_per_host"] or 0))
+        if data.get("proxy_pool_idle_timeout"): config["proxy_pool_idle_timeout"] = float(data["proxy_pool_idle_timeout"])
+        if data.get("save_download_connect_timeout"): config["save_download_connect_timeout"] = float(data["save_download_connect_timeout"])
+        if data.get("save_download_timeout"): config["save_download_timeout"] = float(data["save_download_timeout"])
+        if "save_download_max_mb" in data: config["save_download_max_mb"] = float(data["save_download_max_mb"] or 0)
+        if "save_download_max_redirects" in data: config["save_download_max_redirects"] = int(data["save_download_max_redirects"] or 0)
+        if "save_download_restrict_hosts" in data: config["save_download_restrict_hosts"] = bool(data["save_download_restrict_hosts"])
+        if "save_max_upload_mb" in data: config["save_max_upload_mb"] = float(data["save_max_upload_mb"] or 0)
+        if "proxy_max_body_mb" in data: config["proxy_max_body_mb"] = float(data["proxy_max_body_mb"] or 0)
+        if "proxy_cache_enabled" in data: config["proxy_cache_enabled"] = bool(data["proxy_cache_enabled"])
+        if data.get("proxy_cache_max_mb"): config["proxy_cache_max_mb"] = float(data["proxy_cache_max_mb"])
+        if data.get("proxy_cache_max_entry_mb"): config["proxy_cache_max_entry_mb"] = float(data["proxy_cache_max_entry_mb"])
+        if "proxy_cache_ttl" in data: config["proxy_cache_ttl"] = int(data["proxy_cache_ttl"] or 0)
+        if "proxy_coalesce_enabled" in data: config["proxy_coalesce_enabled"] = bool(data["proxy_coalesce_enabled"])
+        if data.get("comfy_backends") and isinstance(data["comfy_backends"], list):
+            config["comfy_backends"] = data["comfy_backends"]
+        if data.get("comfy_max_inflight"): config["comfy_max_inflight"] = max(1, int(data["comfy_max_inflight"]))
+        if data.get("comfy_job_timeout"): config["comfy_job_timeout"] = int(data["comfy_job_timeout"])
+        if data.get("comfy_job_ttl"): config["comfy_job_ttl"] = int(data["comfy_job_ttl"])
+        if data.get("comfy_job_max_entries"): config["comfy_job_max_entries"] = int(data["comfy_job_max_entries"])
+        if "comfy_template_cache_mb" in data: config["comfy_template_cache_mb"] = float(data["comfy_template_cache_mb"] or 0)
+        if data.get("comfy_batch_max_jobs"): config["comfy_batch_max_jobs"] = int(data["comfy_batch_max_jobs"])
+        if "comfy_result_cache_enabled" in data: config["comfy_result_cache_enabled"] = bool(data["comfy_result_cache_enabled"])
+        if data.get("comfy_result_cache_max_entries"): config["comfy_result_cache_max_entries"] = int(data["comfy_result_cache_max_entries"])
+        if "comfy_result_cache_ttl" in data: config["comfy_result_cache_ttl"] = int(data["comfy_result_cache_ttl"] or 0)
+        if "comfy_prefetch_outputs" in data: config["comfy_prefetch_outputs"] = bool(data["comfy_prefetch_outputs"])
+        if data.get("comfy_prefetch_subfolder"): config["comfy_prefetch_subfolder"] = str(data["comfy_prefetch_subfolder"])
+        if data.get("comfy_prefetch_workers"): config["comfy_prefetch_workers"] = int(data["comfy_prefetch_workers"])
 
         # [NEW] 允许通过 config 文件覆盖环境变量开关
         # 例如 json 中: { "features": { "comfy_middleware": false } }
@@ -230,6 +335,99 @@ def get_unique_filename(filepath):
         counter += 1
     return f"{base}_{counter}{ext}"
 
+def join_contained(base, name):
+    """拼接 base 与客户端提供的文件名 (可含子目录)，结果不在 base 之内时返回 None
+
+    与 safe_join 不同，不对文件名做 URL 解码 (文件名中的 % 原样保留)。
+    """
+    if not name or os.path.isabs(name) or os.path.splitdrive(name)[0]:
+        return None
+    base_abs = os.path.abspath(base)
+    candidate = os.path.abspath(os.path.join(base_abs, name))
+    base_norm = os.path.normcase(base_abs)
+    try:
+        if os.path.commonpath([os.path.normcase(candidate), base_norm]) != base_norm or os.path.normcase(candidate) == base_norm:
+            return None
+    except ValueError:
+        return None
+    return candidate
+
+class SaveTargetError(Exception):
+    """保存目标不合法；status 为返回给客户端的 HTTP 状态码"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def resolve_save_target(filename, subfolder='', custom_path=''):
+    """按 /save 的规则解析目标文件路径：子目录 / 自定义路径 / 白名单 / 自动建目录 / 覆盖策略"""
+    if not filename and not custom_path:
+        raise SaveTargetError("缺少文件名")
+    if custom_path:
+        custom_path = os.path.expanduser(custom_path)
+        if not os.path.isabs(custom_path):
+            custom_path = safe_join(config["save_path"], custom_path)
+            if not custom_path:
+                raise SaveTargetError("非法路径")
+        else:
+            custom_path = os.path.abspath(custom_path)
+        if not is_path_allowed(custom_path):
+            raise SaveTargetError("不允许保存到该路径", 403)
+        save_dir = os.path.dirname(custom_path)
+        filepath = custom_path
+    else:
+        if subfolder:
+            save_dir = safe_join(config["save_path"], subfolder)
+            if not save_dir:
+                raise SaveTargetError("非法子目录")
+        else:
+            save_dir = config["save_path"]
+        filepath = join_contained(save_dir, filename)
+        if not filepath:
+            raise SaveTargetError("非法文件名")
+
+    # 文件名可带子目录：以文件实际所在目录为准
+    save_dir = os.path.dirname(filepath)
+    if config["auto_create_dir"]:
+        ensure_dir(save_dir)
+    elif not os.path.exists(save_dir):
+        raise SaveTargetError(f"目录不存在: {save_dir}")
+
+    if not config["allow_overwrite"]:
+        filepath = get_unique_filename(filepath)
+    return filepath
+
+def write_file_atomic(filepath, chunks):
+    """分块写入同目录下的临时文件，完成后原子替换目标；中途失败不会留下半个文件。返回写入字节数"""
+    directory, name = os.path.split(filepath)
+    temp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex[:8]}.part")
+    size = 0
+    try:
+        with open(temp_path, 'xb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return size
+
+def move_file_atomic(src, dst):
+    """原子移动：同一文件系统直接 os.replace，跨盘时先复制为目标目录下的临时文件再替换"""
+    try:
+        os.replace(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    with open(src, 'rb') as f:
+        write_file_atomic(dst, iter(lambda: f.read(FILE_COPY_BUFFER_SIZE), b''))
+    os.remove(src)
+
 # --- 代理相关工具 ---
 PROXY_SKIP_REQUEST_HEADERS = {
     'host', 'content-length', 'connection', 'proxy-connection', 'keep-alive',
@@ -278,6 +476,9 @@ def is_proxy_target_allowed(target_url):
     # Always allow local ComfyUI output fetch (avoid 403 loop)
     if host in ('127.0.0.1', 'localhost') and port == 8188:
         return True
+    # 已配置的 ComfyUI 后端同样放行 (多实例时端口各不相同)
+    if COMFY_POOL.is_backend_host(host, port):
+        return True
     if not allowed_hosts:
         return False
     for entry in allowed_hosts:
@@ -295,77 +496,2747 @@ def is_proxy_target_allowed(target_url):
                 if port_entry is None or port_entry == port:
                     return True
         else:
-            if host == host_entry and (port_entry is None or port_entry == port):
-                return True
-    return False
+            if host == host_entry and (port_entry is None or port_entry == port):
+                return True
+    return False
+
+def iter_proxy_response_chunks(response, chunk_size=8192):
+    # 通过 HTTPResponse.read1 读取：按到达即转发，同时由 http.client 处理分块编码与长度计数，
+    # 读完后连接可安全放回连接池
+    if hasattr(response, 'read1'):
+        while True:
+            chunk = response.read1(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        response.read()  # 定长响应读满后 read1 不会自动结束响应，补一次 read() 完成收尾
+        return
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+PROXY_BODY_CHUNK_SIZE = 64 * 1024
+
+
+class RequestBodyTooLarge(Exception):
+    """请求体超过上限 (proxy_max_body_mb / save_max_upload_mb)"""
+
+
+def get_proxy_max_body_size():
+    limit_mb = config.get("proxy_max_body_mb", 0)
+    return int(limit_mb * 1024 * 1024) if limit_mb and limit_mb > 0 else 0
+
+def iter_request_body(rfile, content_length, chunk_size=PROXY_BODY_CHUNK_SIZE):
+    """按定长分块读取请求体 (边收边转发，内存占用固定)"""
+    remaining = content_length
+    while remaining > 0:
+        chunk = rfile.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ConnectionResetError("客户端请求体不完整")
+        remaining -= len(chunk)
+        yield chunk
+
+def iter_chunked_request_body(rfile, max_size=0, chunk_size=PROXY_BODY_CHUNK_SIZE):
+    """解码 Transfer-Encoding: chunked 请求体并逐块产出"""
+    total = 0
+    while True:
+        line = rfile.readline(65537)
+        if not line.endswith(b'\n'):
+            # 连接在长度行中途断开 (如 "04a0" 只收到 "0") 时不能当作结束块
+            if len(line) > 65536:
+                raise ValueError("分块长度行过长")
+            raise ConnectionResetError("客户端请求体不完整")
+        size_text = line.split(b';', 1)[0].strip()
+        try:
+            size = int(size_text, 16)
+        except ValueError:
+            raise ValueError(f"非法分块长度: {size_text[:32]!r}")
+        if size == 0:
+            # 丢弃 trailer 直到空行
+            while True:
+                trailer = rfile.readline(65537)
+                if trailer in (b'\r\n', b'\n', b''):
+                    return
+        total += size
+        if max_size and total > max_size:
+            raise RequestBodyTooLarge(total)
+        remaining = size
+        while remaining > 0:
+            chunk = rfile.read(min(chunk_size, remaining))
+            if not chunk:
+                raise ConnectionResetError("客户端请求体不完整")
+            remaining -= len(chunk)
+            yield chunk
+        # 块尾必须紧跟 CRLF：长度与数据不符时拒绝，避免错位后把后续字节当作数据转发
+        tail = rfile.readline(3)
+        if tail != b'\r\n':
+            if not tail.endswith(b'\n') and len(tail) < 3:
+                raise ConnectionResetError("客户端请求体不完整")
+            raise ValueError("分块数据后缺少 CRLF")
+
+def get_save_max_upload_size():
+    limit_mb = config.get("save_max_upload_mb", 0)
+    return int(limit_mb * 1024 * 1024) if limit_mb and limit_mb > 0 else 0
+
+RAW_UPLOAD_TYPE_PREFIXES = ('application/octet-stream', 'image/', 'video/', 'audio/')
+
+def is_raw_upload_type(content_type):
+    return (content_type or '').split(';', 1)[0].strip().lower().startswith(RAW_UPLOAD_TYPE_PREFIXES)
+
+
+# 大于该值 (或 chunked) 的 /save、/save-cache JSON 请求体走流式解析
+STREAMING_JSON_MIN_BYTES = 1024 * 1024
+
+JSON_SIMPLE_ESCAPES = {b'"': b'"', b'\\': b'\\', b'/': b'/', b'b': b'\b', b'f': b'\f', b'n': b'\n', b'r': b'\r', b't': b'\t'}
+
+
+class JsonStreamReader:
+    """流式解析顶层 JSON 对象：指定的字符串字段逐段交给回调 (不在内存中拼出完整字符串)，其余字段常规解析"""
+
+    MAX_FIELD_BYTES = 64 * 1024
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.pos = 0
+
+    def _fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _require(self, size):
+        while len(self.buffer) - self.pos < size:
+            if not self._fill():
+                raise ValueError("JSON 数据不完整")
+
+    def _next_token(self):
+        """跳过空白并返回下一个字符 (不消费)"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in b' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos:self.pos + 1]
+            if not self._fill():
+                raise ValueError("JSON 数据不完整")
+
+    def _expect(self, token):
+        if self._next_token() != token:
+            raise ValueError(f"JSON 格式错误: 期望 {token.decode()}")
+        self.pos += 1
+
+    def _read_raw_value(self):
+        """读取一个完整 JSON 值的原始字节 (字符串 / 数字 / 字面量 / 嵌套对象)，长度受 MAX_FIELD_BYTES 限制"""
+        self._next_token()
+        start = self.pos
+        depth = 0
+        in_string = False
+        escaped = False
+        index = self.pos
+        while True:
+            if index >= len(self.buffer):
+                offset = index - self.pos
+                start_offset = start - self.pos
+                if not self._fill():
+                    if depth == 0 and not in_string and index > start:
+                        break
+                    raise ValueError("JSON 数据不完整")
+                index = self.pos + offset
+                start = self.pos + start_offset
+                continue
+            if index - start > self.MAX_FIELD_BYTES:
+                raise ValueError("JSON 字段过长")
+            ch = self.buffer[index]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == 0x5C:  # \\
+                    escaped = True
+                elif ch == 0x22:  # "
+                    in_string = False
+                    if depth == 0:
+                        index += 1
+                        break
+            elif ch == 0x22:
+                in_string = True
+            elif ch in b'{[':
+                depth += 1
+            elif ch in b'}]':
+                if depth == 0:
+                    break
+                depth -= 1
+                if depth == 0:
+                    index += 1
+                    break
+            elif ch in b', \t\r\n' and depth == 0:
+                break
+            index += 1
+        raw = self.buffer[start:index]
+        self.pos = index
+        return json.loads(raw)
+
+    def _stream_string(self, callback):
+        """字符串值逐段回调 (已处理转义，UTF-8 字节)；返回字符串字节数"""
+        self._expect(b'"')
+        total = 0
+        while True:
+            quote = self.buffer.find(b'"', self.pos)
+            backslash = self.buffer.find(b'\\', self.pos)
+            stop = quote if backslash < 0 or (0 <= quote < backslash) else backslash
+            if stop < 0:
+                data = self.buffer[self.pos:]
+                self.pos = len(self.buffer)
+                if data:
+                    callback(data)
+                    total += len(data)
+                if not self._fill():
+                    raise ValueError("JSON 数据不完整")
+                continue
+            if stop > self.pos:
+                callback(self.buffer[self.pos:stop])
+                total += stop - self.pos
+            self.pos = stop
+            if stop == quote:
+                self.pos += 1
+                return total
+            self._require(2)
+            escape = self.buffer[self.pos + 1:self.pos + 2]
+            if escape == b'u':
+                self._require(6)
+                data = chr(int(self.buffer[self.pos + 2:self.pos + 6], 16)).encode('utf-8', errors='replace')
+                self.pos += 6
+            elif escape in JSON_SIMPLE_ESCAPES:
+                data = JSON_SIMPLE_ESCAPES[escape]
+                self.pos += 2
+            else:
+                raise ValueError("JSON 格式错误: 非法转义")
+            callback(data)
+            total += len(data)
+
+    def parse(self, stream_field, callback):
+        """解析顶层对象，stream_field 为字符串时逐段交给 callback；返回其余字段组成的 dict"""
+        fields = {}
+        self._expect(b'{')
+        if self._next_token() == b'}':
+            self.pos += 1
+            return fields
+        while True:
+            if self._next_token() != b'"':
+                raise ValueError("JSON 格式错误: 期望字段名")
+            key = self._read_raw_value()
+            self._expect(b':')
+            if key == stream_field and self._next_token() == b'"':
+                self._stream_string(callback)
+            else:
+                fields[key] = self._read_raw_value()
+            token = self._next_token()
+            self.pos += 1
+            if token == b'}':
+                return fields
+            if token != b',':
+                raise ValueError("JSON 格式错误: 期望 , 或 }")
+
+
+BASE64_DISCARD_BYTES = bytes(set(range(256)) - set(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='))
+
+
+class Base64StreamDecoder:
+    """增量 base64 解码：跳过 data URL 前缀 (首个逗号之前)，按 4 字符对齐分段解码写入文件"""
+
+    MAX_PREFIX_BYTES = 1024
+
+    def __init__(self, out):
+        self.out = out
+        self.prefix = b''
+        self.in_prefix = True
+        self.pending = b''
+        self.received = 0
+        self.size = 0
+
+    def feed(self, data):
+        self.received += len(data)
+        if self.in_prefix:
+            self.prefix += data
+            comma = self.prefix.find(b',')
+            if comma >= 0:
+                data = self.prefix[comma + 1:]
+            elif len(self.prefix) > self.MAX_PREFIX_BYTES:
+                data = self.prefix
+            else:
+                return
+            self.in_prefix = False
+            self.prefix = b''
+        data = self.pending + data.translate(None, BASE64_DISCARD_BYTES)
+        aligned = len(data) - len(data) % 4
+        if aligned:
+            self._write(base64.b64decode(data[:aligned]))
+        self.pending = data[aligned:]
+
+    def close(self):
+        if self.in_prefix:
+            self.in_prefix = False
+            data, self.prefix = self.prefix, b''
+            self.pending += data.translate(None, BASE64_DISCARD_BYTES)
+        if self.pending:
+            self._write(base64.b64decode(self.pending))
+            self.pending = b''
+
+    def _write(self, data):
+        self.out.write(data)
+        self.size += len(data)
+
+
+class MultipartReader:
+    """流式 multipart/form-data 解析：缓冲区只保留不足一个分隔符长度的尾部，内存占用与请求体大小无关"""
+
+    MAX_HEADER_BYTES = 16 * 1024
+
+    def __init__(self, chunks, boundary):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.delimiter = b'--' + boundary
+
+    def _fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            raise ValueError("multipart 数据不完整")
+        self.buffer += chunk
+
+    def _read_exact(self, size):
+        while len(self.buffer) < size:
+            self._fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def _read_until(self, separator, limit):
+        while True:
+            index = self.buffer.find(separator)
+            if index >= 0:
+                data, self.buffer = self.buffer[:index], self.buffer[index + len(separator):]
+                return data
+            if limit and len(self.buffer) > limit:
+                raise ValueError("multipart 头部过长")
+            self._fill()
+
+    def _iter_until(self, separator):
+        keep = len(separator) - 1
+        while True:
+            index = self.buffer.find(separator)
+            if index >= 0:
+                data, self.buffer = self.buffer[:index], self.buffer[index + len(separator):]
+                if data:
+                    yield data
+                return
+            if len(self.buffer) > keep:
+                data, self.buffer = self.buffer[:-keep], self.buffer[-keep:]
+                yield data
+            self._fill()
+
+    def parts(self):
+        """逐个产出 (name, filename, content_type, body_iter)；body_iter 未读完时在下一部分前自动丢弃"""
+        for _ in self._iter_until(self.delimiter):
+            pass  # preamble
+        while True:
+            if self._read_exact(2) == b'--':
+                return
+            raw_headers = self._read_until(b'\r\n\r\n', self.MAX_HEADER_BYTES)
+            headers = Message()
+            for line in raw_headers.decode('utf-8', errors='replace').split('\r\n'):
+                key, sep, value = line.partition(':')
+                if sep:
+                    headers[key.strip()] = value.strip()
+            name = headers.get_param('name', header='content-disposition')
+            filename = headers.get_filename()
+            body = self._iter_until(b'\r\n' + self.delimiter)
+            yield (name if isinstance(name, str) else None), filename, headers.get_content_type(), body
+            for _ in body:
+                pass
+
+
+# 复用的连接在发送请求时被对端关闭：可换新连接重试一次
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected, http.client.BadStatusLine,
+    ConnectionResetError, ConnectionAbortedError, BrokenPipeError
+)
+
+
+class UpstreamConnectionPool:
+    """代理上游连接池：按 (scheme, host, port) 复用 keep-alive 连接，省去重复的 TCP/TLS 握手"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}  # (scheme, host, port) -> [(conn, idle_since), ...]
+        self.handshakes = 0
+        self.reused = 0
+        self.retries = 0
+        self.stale = 0
+        self.expired = 0
+        self.overflow = 0
+
+    @staticmethod
+    def is_enabled():
+        return bool(config.get("proxy_pool_enabled", True))
+
+    @staticmethod
+    def is_stale(conn):
+        """空闲连接上可读即表示对端已关闭 (或有意外数据)，不可再复用"""
+        sock = conn.sock
+        if sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def acquire(self, scheme, host, port, timeout, connect_timeout=None):
+        """返回 (conn, reused)；优先取最近放回的空闲连接。connect_timeout 单独限制新建连接的握手时间"""
+        key = (scheme, host, port)
+        idle_timeout = config.get("proxy_pool_idle_timeout", 60)
+        now = time.time()
+        while self.is_enabled():
+            with self.lock:
+                entries = self.idle.get(key)
+                if not entries:
+                    break
+                conn, idle_since = entries.pop()
+            if now - idle_since > idle_timeout:
+                with self.lock:
+                    self.expired += 1
+                conn.close()
+                continue
+            if self.is_stale(conn):
+                with self.lock:
+                    self.stale += 1
+                conn.close()
+                continue
+            conn.timeout = timeout
+            conn.sock.settimeout(timeout)
+            with self.lock:
+                self.reused += 1
+            return conn, True
+        conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        with self.lock:
+            self.handshakes += 1
+        if not connect_timeout:
+            return conn_class(host, port, timeout=timeout), False
+        conn = conn_class(host, port, timeout=connect_timeout)
+        conn.connect()
+        conn.timeout = timeout
+        conn.sock.settimeout(timeout)
+        return conn, False
+
+    def release(self, conn, response=None):
+        """响应已完整读取且上游允许保持连接时放回池中，否则关闭"""
+        reusable = (
+            self.is_enabled()
+            and conn.sock is not None
+            and (response is None or (response.isclosed() and not response.will_close))
+        )
+        if not reusable:
+            conn.close()
+            return
+        key = ('https' if isinstance(conn, http.client.HTTPSConnection) else 'http', conn.host, conn.port)
+        with self.lock:
+            entries = self.idle.setdefault(key, [])
+            if len(entries) < config.get("proxy_pool_max_per_host", 8):
+                entries.append((conn, time.time()))
+                return
+            self.overflow += 1
+        conn.close()
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def request(self, scheme, host, port, method, path, body, headers, timeout, connect_timeout=None):
+        """发送请求并返回 (conn, response)；复用连接失效时换新连接重试一次"""
+        conn, reused = self.acquire(scheme, host, port, timeout, connect_timeout)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            return conn, conn.getresponse()
+        except STALE_CONNECTION_ERRORS:
+            self.discard(conn)
+            if not reused or not (body is None or isinstance(body, (bytes, bytearray))):
+                raise
+        except Exception:
+            self.discard(conn)
+            raise
+        with self.lock:
+            self.retries += 1
+        conn, _ = self.acquire(scheme, host, port, timeout, connect_timeout)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            return conn, conn.getresponse()
+        except Exception:
+            self.discard(conn)
+            raise
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": self.is_enabled(),
+                "idle": sum(len(entries) for entries in self.idle.values()),
+                "hosts": len([entries for entries in self.idle.values() if entries]),
+                "handshakes": self.handshakes,
+                "reused": self.reused,
+                "retries": self.retries,
+                "stale_closed": self.stale,
+                "expired_closed": self.expired,
+                "overflow_closed": self.overflow
+            }
+
+
+UPSTREAM_POOL = UpstreamConnectionPool()
+
+
+class DownloadError(Exception):
+    """/save 的 url 下载失败；status 为返回给客户端的 HTTP 状态码"""
+
+    def __init__(self, message, status=502):
+        super().__init__(message)
+        self.status = status
+
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+
+def is_download_target_allowed(url):
+    """url 下载目标检查：复用代理白名单，并放行本服务自身 (/file/ 地址)"""
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return False
+    if not config.get("save_download_restrict_hosts", True):
+        return True
+    if parsed.hostname.lower() in ('127.0.0.1', 'localhost') and (parsed.port or 80) == config["port"]:
+        return True
+    return is_proxy_target_allowed(url)
+
+
+def iter_url_download(url, stats):
+    """流式下载 url：经上游连接池，带连接/读取超时、大小上限与重定向次数限制；stats 记录最终地址、字节数与重定向次数"""
+    limit_mb = config.get("save_download_max_mb", 0)
+    max_size = int(limit_mb * 1024 * 1024) if limit_mb and limit_mb > 0 else 0
+    headers = {'User-Agent': 'Tapnow-LocalServer', 'Accept': '*/*', 'Accept-Encoding': 'identity'}
+    stats.setdefault("bytes", 0)
+    stats.setdefault("redirects", 0)
+    for _ in range(max(0, config.get("save_download_max_redirects", 5)) + 1):
+        if not is_download_target_allowed(url):
+            raise DownloadError(f"不允许下载该地址: {urlparse(url).hostname or url}", 403)
+        parsed = urlparse(url)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        path = (parsed.path or '/') + (f"?{parsed.query}" if parsed.query else '')
+        try:
+            conn, response = UPSTREAM_POOL.request(
+                parsed.scheme, parsed.hostname, port, 'GET', path, None, headers,
+                config.get("save_download_timeout", 60), config.get("save_download_connect_timeout", 10)
+            )
+        except socket.timeout:
+            raise DownloadError("下载超时", 504)
+        except (OSError, http.client.HTTPException) as e:
+            raise DownloadError(f"下载失败: {e}")
+        location = response.getheader('Location')
+        if response.status in REDIRECT_STATUSES and location:
+            response.read(65536)
+            UPSTREAM_POOL.release(conn, response)
+            url = urljoin(url, location)
+            stats["redirects"] += 1
+            continue
+        if response.status != 200:
+            UPSTREAM_POOL.discard(conn)
+            raise DownloadError(f"下载失败: HTTP {response.status}")
+        content_length = response.getheader('Content-Length')
+        if max_size and content_length and content_length.isdigit() and int(content_length) > max_size:
+            UPSTREAM_POOL.discard(conn)
+            raise DownloadError("下载文件过大", 413)
+        stats["url"] = url
+        try:
+            for chunk in iter_proxy_response_chunks(response, PROXY_BODY_CHUNK_SIZE):
+                stats["bytes"] += len(chunk)
+                if max_size and stats["bytes"] > max_size:
+                    raise DownloadError("下载文件过大", 413)
+                yield chunk
+        except socket.timeout:
+            UPSTREAM_POOL.discard(conn)
+            raise DownloadError("下载超时", 504)
+        except (OSError, http.client.HTTPException) as e:
+            UPSTREAM_POOL.discard(conn)
+            raise DownloadError(f"下载失败: {e}")
+        except BaseException:
+            UPSTREAM_POOL.discard(conn)
+            raise
+        UPSTREAM_POOL.release(conn, response)
+        return
+    raise DownloadError("重定向次数过多")
+
+
+def download_to_file(url, filepath):
+    """下载到同目录临时文件并原子替换目标，返回下载统计 (含吞吐量)"""
+    stats = {}
+    started = time.perf_counter()
+    write_file_atomic(filepath, iter_url_download(url, stats))
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    return {
+        "url": stats.get("url", url),
+        "bytes": stats["bytes"],
+        "redirects": stats["redirects"],
+        "seconds": round(elapsed, 3),
+        "throughput_mbps": round(stats["bytes"] / elapsed / (1024 * 1024), 2)
+    }
+
+
+def guess_content_type(filepath):
+    content_type, _ = mimetypes.guess_type(filepath)
+    if content_type:
+        return content_type
+    if filepath.endswith('.png'): return 'image/png'
+    if filepath.endswith('.jpg') or filepath.endswith('.jpeg'): return 'image/jpeg'
+    if filepath.endswith('.webp'): return 'image/webp'
+    if filepath.endswith('.gif'): return 'image/gif'
+    if filepath.endswith('.mp4'): return 'video/mp4'
+    if filepath.endswith('.webm'): return 'video/webm'
+    return 'application/octet-stream'
+
+class MemoryFileEntry:
+    __slots__ = ('filepath', 'data', 'size', 'mtime_ns', 'etag', 'last_modified', 'content_type', 'checked_at')
+
+    def __init__(self, filepath, data, stat):
+        self.filepath = filepath
+        self.data = data
+        self.size = len(data)
+        self.mtime_ns = stat.st_mtime_ns
+        self.etag = f"\"{int(stat.st_mtime)}-{stat.st_size}\""
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.content_type = guess_content_type(filepath)
+        self.checked_at = time.time()
+
+
+class FileMemoryCache:
+    """/file/ 小文件热点缓存：按解析后的绝对路径缓存文件字节与预先计算的响应头 (LRU 字节预算)
+
+    以绝对路径为键：同一相对路径在多个根目录间切换时 (路径解析缓存已失效) 不会返回另一根目录的旧内容。
+    保存/删除接口主动失效；文件被外部修改时按 file_memory_cache_check_interval 周期比对 mtime。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # 绝对路径 -> MemoryFileEntry
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def budget():
+        return int(config.get("file_memory_cache_mb", 0) * 1024 * 1024)
+
+    @staticmethod
+    def max_object_size():
+        return int(config.get("file_memory_cache_max_kb", 512) * 1024)
+
+    def get(self, filepath):
+        key = os.path.abspath(filepath)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+        if time.time() - entry.checked_at >= config.get("file_memory_cache_check_interval", 2):
+            try:
+                stat = os.stat(entry.filepath)
+                valid = stat.st_mtime_ns == entry.mtime_ns and stat.st_size == entry.size
+            except OSError:
+                valid = False
+            if not valid:
+                self.invalidate_path(key)
+                with self.lock:
+                    self.misses += 1
+                return None
+            entry.checked_at = time.time()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.hits += 1
+        return entry
+
+    def load(self, filepath, f, stat):
+        """从调用方已打开的文件读取小文件并放入缓存；超出单文件上限或缓存关闭时返回 None (不读取)
+
+        复用同一个文件句柄：未缓存的大文件由调用方继续用它输出，不必再打开一次。
+        """
+        max_size = min(self.max_object_size(), self.budget())
+        if max_size <= 0 or stat.st_size > max_size:
+            return None
+        data = f.read(max_size + 1)
+        if len(data) != stat.st_size:
+            return None
+        entry = MemoryFileEntry(filepath, data, stat)
+        key = os.path.abspath(filepath)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.total_bytes -= old.size
+            self.entries[key] = entry
+            self.total_bytes += entry.size
+            budget = self.budget()
+            while self.entries and self.total_bytes > budget:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.size
+                self.evictions += 1
+        return entry
+
+    def invalidate_path(self, filepath):
+        with self.lock:
+            entry = self.entries.pop(os.path.abspath(filepath), None)
+            if entry:
+                self.total_bytes -= entry.size
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "budget_bytes": self.budget(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+FILE_MEMORY_CACHE = FileMemoryCache()
+
+
+def get_file_roots():
+    """/file/ 的查找根目录 (按优先级)"""
+    roots = [config["save_path"]]
+    if config["image_save_path"]:
+        roots.append(config["image_save_path"])
+    if config["video_save_path"]:
+        roots.append(config["video_save_path"])
+    return roots
+
+
+class ResolvedPathCache:
+    """/file/ 相对路径 -> 绝对路径的解析缓存 (含不存在的负缓存)
+
+    由保存/删除接口与目录配置变更主动失效，外部变更依赖 file_path_cache_ttl 过期。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # rel_path -> (abs_path 或 None, expires_at)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def resolve(self, rel_path):
+        ttl = config.get("file_path_cache_ttl", 5)
+        now = time.time()
+        if ttl > 0:
+            with self.lock:
+                entry = self.entries.get(rel_path)
+                if entry is not None and entry[1] > now:
+                    self.entries.move_to_end(rel_path)
+                    if entry[0] is None:
+                        self.negative_hits += 1
+                    else:
+                        self.hits += 1
+                    return entry[0]
+                self.misses += 1
+        filepath = None
+        for root in get_file_roots():
+            candidate = os.path.join(root, rel_path)
+            if os.path.isfile(candidate):
+                filepath = candidate
+                break
+        if ttl > 0:
+            with self.lock:
+                self.entries[rel_path] = (filepath, now + ttl)
+                self.entries.move_to_end(rel_path)
+                max_entries = max(1, config.get("file_path_cache_max_entries", 10000))
+                while len(self.entries) > max_entries:
+                    self.entries.popitem(last=False)
+        return filepath
+
+    def invalidate(self, rel_path):
+        with self.lock:
+            self.entries.pop(rel_path, None)
+
+    def invalidate_path(self, filepath):
+        """按绝对路径失效：文件可能以任一根目录下的相对路径被访问"""
+        abs_path = os.path.abspath(filepath)
+        for root in get_file_roots():
+            try:
+                rel_path = os.path.relpath(abs_path, os.path.abspath(root))
+            except ValueError:
+                continue
+            if rel_path.startswith('..'):
+                continue
+            rel_path = normalize_rel_path(rel_path)
+            if rel_path:
+                self.invalidate(rel_path)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses
+            }
+
+
+PATH_CACHE = ResolvedPathCache()
+
+
+def get_media_kind(filename):
+    if is_image_file(filename):
+        return 'image'
+    if is_video_file(filename):
+        return 'video'
+    return None
+
+
+class MediaIndexResyncRequired(Exception):
+    """since 早于已清理的墓碑：增量无法还原删除记录，客户端需全量重新同步"""
+
+    def __init__(self, since, purged_seq):
+        super().__init__(f"since={since} 早于已清理的墓碑 (purged_seq={purged_seq})，请全量重新同步")
+        self.since = since
+        self.purged_seq = purged_seq
+
+
+class MediaIndex:
+    """save_path 下媒体文件的持久化索引 (SQLite)
+
+    本服务的保存/删除接口增量更新；外部变更通过目录 mtime 对账发现 (仅重新列出 mtime 变化的目录)。
+    每次变更递增 seq，删除保留墓碑记录，用于 since 增量查询与 ETag。
+    墓碑只保留最近 media_index_tombstone_retention 个 seq，更早的被清理；purged_seq 之前的 since 需全量重新同步。
+    """
+
+    SORT_COLUMNS = {'path': 'rel_path', 'name': 'filename', 'mtime': 'mtime', 'size': 'size'}
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.conn = None
+        self.root = None
+        self.db_path = None
+        self.index_id = ''
+        self.seq = 0
+        self.purged_seq = 0
+        self.purge_floor = 0
+        self.last_reconcile = 0
+        self.reconciles = 0
+        self.dirs_rescanned = 0
+        self.count_cache = OrderedDict()  # (where, args) -> (seq, total)
+
+    @staticmethod
+    def is_enabled():
+        return SQLITE_AVAILABLE and bool(config.get("media_index_enabled", True))
+
+    def ensure_open(self):
+        """按当前 save_path 打开索引库；保存目录变化时切换到新目录的索引"""
+        root = os.path.abspath(config["save_path"])
+        if self.conn is not None and self.root == root:
+            return
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        cache_dir = os.path.join(root, '.tapnow_cache')
+        ensure_dir(cache_dir)
+        self.db_path = os.path.join(cache_dir, 'media_index.sqlite3')
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS dirs (rel_dir TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER);
+            CREATE TABLE IF NOT EXISTS files (
+                rel_path TEXT PRIMARY KEY, dir TEXT, filename TEXT, kind TEXT,
+                size INTEGER, mtime REAL, seq INTEGER, deleted INTEGER DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS files_dir ON files(dir);
+            CREATE INDEX IF NOT EXISTS files_seq ON files(seq);
+            CREATE INDEX IF NOT EXISTS files_mtime ON files(deleted, mtime);
+            CREATE INDEX IF NOT EXISTS files_path ON files(deleted, rel_path);
+            CREATE INDEX IF NOT EXISTS files_name ON files(deleted, filename);
+            CREATE INDEX IF NOT EXISTS files_size ON files(deleted, size);
+            CREATE INDEX IF NOT EXISTS files_kind ON files(deleted, kind, mtime);
+        """)
+        meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        self.index_id = meta.get('index_id') or uuid.uuid4().hex[:12]
+        self.seq = int(meta.get('seq') or 0)
+        self.purged_seq = int(meta.get('purged_seq') or 0)
+        self.purge_floor = self.purged_seq
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('index_id', ?)", (self.index_id,))
+        conn.commit()
+        self.conn = conn
+        self.root = root
+        self.last_reconcile = 0
+
+    def next_seq(self):
+        self.seq += 1
+        return self.seq
+
+    def save_seq(self):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('seq', ?)", (str(self.seq),))
+
+    def upsert_file(self, rel_dir, filename, stat, known=None):
+        """文件新增或大小/mtime 变化时写入并递增 seq；返回是否有变化
+
+        known 为已记录的 (size, mtime, deleted)；传入空元组表示确认无记录，None 表示需查询。
+        """
+        rel_path = f"{rel_dir}/{filename}" if rel_dir else filename
+        if known is None:
+            known = self.conn.execute(
+                "SELECT size, mtime, deleted FROM files WHERE rel_path = ?", (rel_path,)
+            ).fetchone()
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime and not known[2]:
+            return False
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files (rel_path, dir, filename, kind, size, mtime, seq, deleted) VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+            (rel_path, rel_dir, filename, get_media_kind(filename), stat.st_size, stat.st_mtime, self.next_seq())
+        )
+        return True
+
+    def tombstone(self, rel_path):
+        cur = self.conn.execute(
+            "UPDATE files SET deleted = 1, seq = ? WHERE rel_path = ? AND deleted = 0", (self.seq + 1, rel_path)
+        )
+        if cur.rowcount:
+            self.seq += 1
+            return True
+        return False
+
+    def purge_tombstones(self):
+        """清理超出保留窗口的墓碑，记录被清理的最大 seq (purged_seq)"""
+        retention = config.get("media_index_tombstone_retention", 10000)
+        if not retention:
+            return
+        floor = self.seq - retention
+        if floor <= self.purge_floor:
+            return
+        row = self.conn.execute(
+            "SELECT MAX(seq) FROM files WHERE deleted = 1 AND seq <= ?", (floor,)
+        ).fetchone()
+        self.purge_floor = floor
+        if not row or row[0] is None:
+            return
+        self.conn.execute("DELETE FROM files WHERE deleted = 1 AND seq <= ?", (row[0],))
+        self.purged_seq = max(self.purged_seq, row[0])
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('purged_seq', ?)", (str(self.purged_seq),)
+        )
+
+    @staticmethod
+    def check_since(since, purged_seq):
+        if since is not None and since < purged_seq:
+            raise MediaIndexResyncRequired(since, purged_seq)
+
+    def rescan_dir(self, rel_dir, abs_dir):
+        """重新列出单个目录：更新文件记录并返回子目录列表"""
+        subdirs = []
+        present = set()
+        known = {
+            row[0]: row[1:] for row in self.conn.execute(
+                "SELECT filename, size, mtime, deleted FROM files WHERE dir = ?", (rel_dir,)
+            )
+        }
+        with os.scandir(abs_dir) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(f"{rel_dir}/{entry.name}" if rel_dir else entry.name)
+                        continue
+                    if not get_media_kind(entry.name) or not entry.is_file():
+                        continue
+                    present.add(entry.name)
+                    self.upsert_file(rel_dir, entry.name, entry.stat(), known.get(entry.name) or ())
+                except OSError:
+                    continue
+        for filename, (_, _, deleted) in known.items():
+            if filename not in present and not deleted:
+                self.tombstone(f"{rel_dir}/{filename}" if rel_dir else filename)
+        self.dirs_rescanned += 1
+        return subdirs
+
+    def drop_dir(self, rel_dir):
+        prefix = f"{rel_dir}/"
+        for (rel_path,) in self.conn.execute(
+            "SELECT rel_path FROM files WHERE deleted = 0 AND (dir = ? OR substr(dir, 1, ?) = ?)",
+            (rel_dir, len(prefix), prefix)
+        ).fetchall():
+            self.tombstone(rel_path)
+        self.conn.execute("DELETE FROM dirs WHERE rel_dir = ? OR substr(rel_dir, 1, ?) = ?", (rel_dir, len(prefix), prefix))
+
+    def reconcile(self, force=False):
+        """目录 mtime 对账：mtime 未变的目录沿用已记录的子目录，不重新列出"""
+        with self.lock:
+            self.ensure_open()
+            interval = config.get("media_index_rescan_interval", 2)
+            now = time.time()
+            if not force and now - self.last_reconcile < interval:
+                return
+            known_dirs = {row[0]: row[1] for row in self.conn.execute("SELECT rel_dir, mtime_ns FROM dirs")}
+            children = {}
+            for rel_dir, parent in self.conn.execute("SELECT rel_dir, parent FROM dirs"):
+                children.setdefault(parent, []).append(rel_dir)
+            seen = set()
+            stack = ['']
+            while stack:
+                rel_dir = stack.pop()
+                abs_dir = os.path.join(self.root, *rel_dir.split('/')) if rel_dir else self.root
+                try:
+                    mtime_ns = os.stat(abs_dir).st_mtime_ns
+                except OSError:
+                    continue
+                seen.add(rel_dir)
+                if known_dirs.get(rel_dir) == mtime_ns:
+                    stack.extend(children.get(rel_dir, []))
+                    continue
+                try:
+                    subdirs = self.rescan_dir(rel_dir, abs_dir)
+                except OSError:
+                    continue
+                parent = rel_dir.rsplit('/', 1)[0] if '/' in rel_dir else ('' if rel_dir else None)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO dirs (rel_dir, parent, mtime_ns) VALUES (?, ?, ?)",
+                    (rel_dir, parent, mtime_ns)
+                )
+                for stale in set(children.get(rel_dir, [])) - set(subdirs):
+                    self.drop_dir(stale)
+                stack.extend(subdirs)
+            for rel_dir in set(known_dirs) - seen:
+                if rel_dir:
+                    self.drop_dir(rel_dir)
+            self.purge_tombstones()
+            self.save_seq()
+            self.conn.commit()
+            self.last_reconcile = time.time()
+            self.reconciles += 1
+
+    def note_file(self, filepath):
+        """保存/删除接口增量更新 (仅 save_path 下的媒体文件)"""
+        if not self.is_enabled() or self.conn is None:
+            return
+        filename = os.path.basename(filepath)
+        if not get_media_kind(filename):
+            return
+        try:
+            rel_path = os.path.relpath(os.path.abspath(filepath), self.root)
+        except ValueError:
+            return
+        if rel_path.startswith('..'):
+            return
+        rel_path = rel_path.replace('\\', '/')
+        rel_dir = rel_path.rsplit('/', 1)[0] if '/' in rel_path else ''
+        with self.lock:
+            if self.conn is None:
+                return
+            try:
+                stat = os.stat(filepath)
+                changed = self.upsert_file(rel_dir, filename, stat)
+            except OSError:
+                changed = self.tombstone(rel_path)
+            if changed:
+                self.save_seq()
+                self.conn.commit()
+
+    @staticmethod
+    def parse_time(value):
+        """时间过滤参数：epoch 秒或 YYYY-MM-DD[THH:MM:SS]"""
+        if value in (None, ''):
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.fromisoformat(value).timestamp()
+
+    def build_query(self, params):
+        """把查询参数转换为 SQL 条件；参数非法时抛出 ValueError"""
+        where, args = [], []
+        since = params.get('since')
+        if since not in (None, ''):
+            self.check_since(int(since), self.purged_seq)
+            where.append("seq > ?")
+            args.append(int(since))
+        else:
+            where.append("deleted = 0")
+        kind = params.get('type')
+        if kind:
+            if kind not in ('image', 'video'):
+                raise ValueError("type 仅支持 image / video")
+            where.append("kind = ?")
+            args.append(kind)
+        time_from = self.parse_time(params.get('from'))
+        if time_from is not None:
+            where.append("mtime >= ?")
+            args.append(time_from)
+        time_to = self.parse_time(params.get('to'))
+        if time_to is not None:
+            where.append("mtime < ?")
+            args.append(time_to)
+        if since not in (None, ''):
+            order_by = "seq ASC"
+        else:
+            sort = params.get('sort') or 'path'
+            if sort not in self.SORT_COLUMNS:
+                raise ValueError("sort 仅支持 path / name / mtime / size")
+            order = 'DESC' if (params.get('order') or 'asc').lower() == 'desc' else 'ASC'
+            order_by = f"{self.SORT_COLUMNS[sort]} {order}"
+            if sort != 'path':
+                order_by += ", rel_path ASC"
+        limit = params.get('limit')
+        limit = int(limit) if limit not in (None, '') else None
+        offset = int(params.get('offset') or 0)
+        if (limit is not None and limit < 0) or offset < 0:
+            raise ValueError("limit / offset 不能为负数")
+        return " AND ".join(where), args, order_by, limit, offset
+
+    def etag(self, params):
+        """索引版本 + 查询参数：任何文件变更都会改变 seq"""
+        query = json.dumps(sorted(params.items()), ensure_ascii=False)
+        digest = hashlib.sha1(query.encode('utf-8')).hexdigest()[:12]
+        return f"\"{self.index_id}-{self.seq}-{digest}\""
+
+    def query(self, params):
+        """返回 (rows, total, seq)；rows 为 (rel_path, filename, kind, size, mtime, seq, deleted)"""
+        where, args, order_by, limit, offset = self.build_query(params)
+        sql = f"SELECT rel_path, filename, kind, size, mtime, seq, deleted FROM files WHERE {where} ORDER BY {order_by}"
+        page_args = list(args)
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            page_args.extend([limit if limit is not None else -1, offset])
+        with self.lock:
+            rows = self.conn.execute(sql, page_args).fetchall()
+            if limit is None and not offset:
+                total = len(rows)
+            else:
+                total = self.count(where, args)
+            return rows, total, self.seq
+
+    def open_stream(self, params):
+        """在独立只读连接上执行查询 (快照一致，不占用索引锁)；返回 (conn, seq, cursor)，调用方负责关闭 conn"""
+        where, args, order_by, limit, offset = self.build_query(params)
+        conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+        try:
+            conn.execute("BEGIN")
+            meta = dict(conn.execute("SELECT key, value FROM meta WHERE key IN ('seq', 'purged_seq')").fetchall())
+            seq = int(meta.get('seq') or 0)
+            if params.get('since') not in (None, ''):
+                # 快照内复核：build_query 之后可能刚好发生了清理
+                self.check_since(int(params['since']), int(meta.get('purged_seq') or 0))
+            sql = f"SELECT rel_path, filename, kind, size, mtime, seq, deleted FROM files WHERE {where} ORDER BY {order_by}"
+            if limit is not None or offset:
+                sql += " LIMIT ? OFFSET ?"
+                args = list(args) + [limit if limit is not None else -1, offset]
+            return conn, seq, conn.execute(sql, args)
+        except Exception:
+            conn.close()
+            raise
+
+    def count(self, where, args):
+        """分页总数按 seq 缓存：索引未变化时翻页不再重复 COUNT"""
+        key = (where, tuple(args))
+        cached = self.count_cache.get(key)
+        if cached is not None and cached[0] == self.seq:
+            return cached[1]
+        total = self.conn.execute(f"SELECT COUNT(*) FROM files WHERE {where}", args).fetchone()[0]
+        self.count_cache[key] = (self.seq, total)
+        self.count_cache.move_to_end(key)
+        while len(self.count_cache) > 64:
+            self.count_cache.popitem(last=False)
+        return total
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                "enabled": self.is_enabled(),
+                "seq": self.seq,
+                "purged_seq": self.purged_seq,
+                "reconciles": self.reconciles,
+                "dirs_rescanned": self.dirs_rescanned
+            }
+            if self.conn is not None:
+                stats["files"] = self.conn.execute("SELECT COUNT(*) FROM files WHERE deleted = 0").fetchone()[0]
+                stats["dirs"] = self.conn.execute("SELECT COUNT(*) FROM dirs").fetchone()[0]
+            return stats
+
+
+MEDIA_INDEX = MediaIndex()
+
+
+def build_media_item(row, root, include_deleted=False):
+    rel_path, filename, kind, size, mtime, seq, deleted = row
+    item = {
+        "filename": filename,
+        "path": f"{root}/{rel_path}",
+        "rel_path": rel_path,
+        "size": size,
+        "mtime": mtime,
+        "type": kind
+    }
+    if include_deleted:
+        item["seq"] = seq
+        item["deleted"] = bool(deleted)
+    return item
+
+
+def notify_file_changed(filepath):
+    """保存/删除文件后调用：失效与该文件相关的缓存"""
+    FILE_MEMORY_CACHE.invalidate_path(filepath)
+    PATH_CACHE.invalidate_path(filepath)
+    MEDIA_INDEX.note_file(filepath)
+
+def notify_roots_changed():
+    """保存目录配置变化后调用：清空按相对路径索引的缓存"""
+    FILE_MEMORY_CACHE.clear()
+    PATH_CACHE.clear()
+
+def parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def etag_matches(header_value, etag, weak=True):
+    """If-None-Match (弱比较) / If-Range (强比较) 的 ETag 匹配"""
+    if not header_value or not etag:
+        return False
+    if header_value.strip() == '*':
+        return True
+    if not weak and etag.startswith('W/'):
+        return False
+    target = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header_value.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            if not weak:
+                continue
+            candidate = candidate[2:]
+        if candidate == target:
+            return True
+    return False
+
+def is_not_modified(headers, etag, last_modified):
+    """If-None-Match 优先；未携带时再比较 If-Modified-Since (秒级)"""
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match:
+        return etag_matches(if_none_match, etag)
+    since = parse_http_date(headers.get('If-Modified-Since'))
+    modified = parse_http_date(last_modified)
+    return since is not None and modified is not None and int(modified) <= int(since)
+
+def is_if_range_satisfied(if_range, etag, last_modified):
+    """If-Range 与当前版本一致 (或未携带) 时才按 Range 返回分段"""
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return etag_matches(if_range, etag, weak=False)
+    return if_range == last_modified
+
+def parse_byte_range(value, size):
+    """解析单段 bytes Range：返回 (start, end)；无法识别或多段时返回 None (按整文件响应)；不可满足返回 False"""
+    unit, _, spec = (value or '').partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    first, last = first.strip(), last.strip()
+    try:
+        if not first:
+            # 后缀范围 bytes=-N：最后 N 字节
+            suffix = int(last)
+            if suffix <= 0 or size == 0:
+                return False
+            return max(0, size - suffix), size - 1
+        start = int(first)
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if start < 0 or (end is not None and end < start):
+        return None
+    if start >= size:
+        return False
+    return start, size - 1 if end is None else min(end, size - 1)
+
+# 已压缩的媒体/归档格式再压缩只会浪费 CPU
+INCOMPRESSIBLE_TYPE_PREFIXES = ('image/', 'video/', 'audio/', 'font/woff')
+INCOMPRESSIBLE_TYPES = {'application/zip', 'application/gzip', 'application/x-7z-compressed', 'application/x-rar-compressed', 'application/pdf', 'application/octet-stream'}
+
+
+def is_compressible_type(content_type):
+    mime = (content_type or '').split(';', 1)[0].strip().lower()
+    if mime == 'image/svg+xml':
+        return True
+    return bool(mime) and not mime.startswith(INCOMPRESSIBLE_TYPE_PREFIXES) and mime not in INCOMPRESSIBLE_TYPES
+
+
+def choose_content_encoding(accept_encoding, content_type='application/json'):
+    """按 Accept-Encoding (含 q 值) 协商响应压缩：br (需 brotli) 优先，其次 gzip；不压缩返回 None"""
+    if not accept_encoding or not config.get("response_compression_enabled", True) or not is_compressible_type(content_type):
+        return None
+    weights = {}
+    for part in accept_encoding.split(','):
+        token, _, params = part.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[token.strip().lower()] = q
+    best, best_q = None, 0.0
+    for encoding in (('br', 'gzip') if BROTLI_AVAILABLE else ('gzip',)):
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def weaken_etag(etag):
+    """压缩后表示不同，强 ETag 降为弱 ETag (与 nginx 一致)，If-None-Match 弱比较仍可命中"""
+    if etag and not etag.startswith('W/'):
+        return 'W/' + etag
+    return etag
+
+
+class ResponseCompressor:
+    """增量压缩器：compress() 返回可立即写出的数据，finish() 返回尾部"""
+
+    def __init__(self, encoding, level=None):
+        level = config.get("response_compression_level", 6) if level is None else level
+        self.encoding = encoding
+        if encoding == 'br':
+            # brotli quality 0-11，与 gzip 级别 1-9 大致对齐
+            self.compressor = brotli.Compressor(quality=max(0, min(11, int(level))))
+        else:
+            self.compressor = zlib.compressobj(max(1, min(9, int(level))), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self.compressor.process(data)
+        return self.compressor.compress(data)
+
+    def flush(self):
+        if self.encoding == 'br':
+            return self.compressor.flush()
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.finish() if self.encoding == 'br' else self.compressor.flush()
+
+
+def compress_body(body, encoding, level=None):
+    level = config.get("response_compression_level", 6) if level is None else level
+    if encoding == 'br':
+        return brotli.compress(body, quality=max(0, min(11, int(level))))
+    return gzip.compress(body, compresslevel=max(1, min(9, int(level))), mtime=0)
+
+
+def parse_cache_control(value):
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip().strip('"')
+    return directives
+
+
+class ProxyCacheWriter:
+    """边转发边落盘的缓存写入器：完整读完且长度校验通过后才提交"""
+
+    def __init__(self, cache, key, url, headers, expected_size):
+        self.cache = cache
+        self.key = key
+        self.url = url
+        self.headers = headers
+        self.expected_size = expected_size
+        self.size = 0
+        self.tmp_path = os.path.join(cache.root(), f"{key}.{uuid.uuid4().hex}.part")
+        self.file = open(self.tmp_path, 'wb')
+
+    def active(self):
+        return self.file is not None
+
+    def write(self, chunk):
+        if self.file is None:
+            return
+        self.size += len(chunk)
+        if self.size > self.cache.max_entry_size():
+            self.abort()
+            return
+        self.file.write(chunk)
+
+    def commit(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if self.expected_size is not None and self.size != self.expected_size:
+            self.discard()
+            return
+        self.cache.commit(self)
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.discard()
+
+    def discard(self):
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class ProxyMediaCache:
+    """代理媒体磁盘缓存：按目标 URL 缓存 GET 媒体响应，LRU 字节预算，过期后用 ETag/Last-Modified 回源校验"""
+
+    STORED_HEADERS = ('content-type', 'etag', 'last-modified', 'cache-control', 'expires', 'date')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> meta
+        self.total_bytes = 0
+        self.loaded_root = None
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stores = 0
+        self.evictions = 0
+        self.pending_deletes = set()  # 删除失败 (Windows 上文件仍在被读取) 待重试的路径
+
+    @staticmethod
+    def is_enabled():
+        return bool(config.get("proxy_cache_enabled")) and config.get("proxy_cache_max_mb", 0) > 0
+
+    @staticmethod
+    def root():
+        return os.path.join(config["save_path"], '.tapnow_cache', 'proxy')
+
+    @staticmethod
+    def budget():
+        return int(config.get("proxy_cache_max_mb", 0) * 1024 * 1024)
+
+    def max_entry_size(self):
+        return min(self.budget(), int(config.get("proxy_cache_max_entry_mb", 256) * 1024 * 1024))
+
+    @staticmethod
+    def make_key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def paths(self, key):
+        base = os.path.join(self.root(), key)
+        return f"{base}.bin", f"{base}.json"
+
+    @staticmethod
+    def path_key(path):
+        return os.path.basename(path).rsplit('.', 1)[0]
+
+    def ensure_loaded(self):
+        """首次使用 (或保存目录变更) 时扫描磁盘重建索引，按写入时间排列 LRU
+
+        返回待删除的文件 (残留 .part、没有对应索引的 .bin/.json、超出预算的条目)，由调用方在释放锁后删除。
+        """
+        root = self.root()
+        if self.loaded_root == root:
+            return []
+        entries = []
+        names = set(os.listdir(root)) if os.path.isdir(root) else set()
+        orphans = []
+        for name in names:
+            path = os.path.join(root, name)
+            if name.endswith('.part'):
+                orphans.append(path)
+                continue
+            if name.endswith('.bin'):
+                if name[:-4] + '.json' not in names:
+                    orphans.append(path)
+                continue
+            if not name.endswith('.json'):
+                continue
+            try:
+                meta = read_json_file(path)
+            except (OSError, ValueError):
+                meta = None  # 写入中断的元数据按孤立文件清理
+            data_path = path[:-5] + '.bin'
+            has_data = name[:-5] + '.bin' in names
+            if not isinstance(meta, dict) or not has_data:
+                orphans.append(path)
+                if has_data:
+                    orphans.append(data_path)
+                continue
+            try:
+                meta['size'] = os.path.getsize(data_path)
+            except OSError:
+                continue
+            entries.append((meta.get('stored_at', 0), name[:-5], meta))
+        entries.sort(key=lambda item: item[0])
+        self.entries = OrderedDict((key, meta) for _, key, meta in entries)
+        self.total_bytes = sum(meta['size'] for meta in self.entries.values())
+        self.loaded_root = root
+        return orphans + self._evict_locked()
+
+    @staticmethod
+    def freshness_lifetime(meta):
+        headers = meta.get('headers', {})
+        directives = parse_cache_control(headers.get('cache-control'))
+        if 'no-cache' in directives:
+            return 0
+        for name in ('s-maxage', 'max-age'):
+            if name in directives:
+                try:
+                    return max(0, int(directives[name]))
+                except ValueError:
+                    pass
+        if headers.get('expires'):
+            try:
+                expires = parsedate_to_datetime(headers['expires']).timestamp()
+                date = parsedate_to_datetime(headers['date']).timestamp() if headers.get('date') else meta['stored_at']
+                return max(0, expires - date)
+            except (TypeError, ValueError, IndexError):
+                return 0
+        return config.get("proxy_cache_ttl", 604800)
+
+    def lookup(self, url):
+        """返回 (key, meta, fresh)；未命中时 meta 为 None"""
+        key = self.make_key(url)
+        with self.lock:
+            stale_paths = self.ensure_loaded()
+            meta = self.entries.get(key)
+            if meta is not None and meta.get('url') == url:
+                self.entries.move_to_end(key)
+        if stale_paths:
+            self._remove_paths(stale_paths)
+        if meta is None or meta.get('url') != url:
+            return key, None, False
+        fresh = time.time() - meta['stored_at'] < self.freshness_lifetime(meta)
+        return key, meta, fresh
+
+    def lookup_key(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def record(self, outcome):
+        with self.lock:
+            if outcome == 'hit':
+                self.hits += 1
+            elif outcome == 'revalidated':
+                self.hits += 1
+                self.revalidated += 1
+            else:
+                self.misses += 1
+
+    @classmethod
+    def pick_headers(cls, response_headers):
+        stored = {}
+        for header, value in response_headers:
+            lower = header.lower()
+            if lower in cls.STORED_HEADERS:
+                stored[lower] = value
+        return stored
+
+    @staticmethod
+    def is_cacheable_response(resp, response_headers):
+        if resp.status != 200:
+            return False
+        headers = {header.lower(): value for header, value in response_headers}
+        directives = parse_cache_control(headers.get('cache-control'))
+        if 'no-store' in directives or 'private' in directives:
+            return False
+        if headers.get('content-encoding', 'identity').lower() != 'identity':
+            return False
+        if headers.get('vary', '').strip() == '*':
+            return False
+        return True
+
+    def open_writer(self, key, url, resp, response_headers):
+        if not self.is_cacheable_response(resp, response_headers):
+            return None
+        expected_size = resp.length
+        if expected_size is not None and expected_size > self.max_entry_size():
+            return None
+        try:
+            ensure_dir(self.root())
+            return ProxyCacheWriter(self, key, url, self.pick_headers(response_headers), expected_size)
+        except OSError:
+            return None
+
+    def commit(self, writer):
+        data_path, meta_path = self.paths(writer.key)
+        meta = {
+            "url": writer.url,
+            "size": writer.size,
+            "stored_at": time.time(),
+            "headers": writer.headers
+        }
+        try:
+            os.replace(writer.tmp_path, data_path)
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+        except OSError:
+            writer.discard()
+            return
+        with self.lock:
+            old = self.entries.pop(writer.key, None)
+            if old:
+                self.total_bytes -= old['size']
+            self.entries[writer.key] = meta
+            self.total_bytes += meta['size']
+            self.stores += 1
+            evicted = self._evict_locked()
+        self._remove_paths(evicted)
+
+    def refresh(self, key, response_headers):
+        """回源返回 304：更新校验头与存储时间"""
+        with self.lock:
+            meta = self.entries.get(key)
+            if meta is None:
+                return None
+            meta['headers'].update(self.pick_headers(response_headers))
+            meta['stored_at'] = time.time()
+            snapshot = json.loads(json.dumps(meta))
+        try:
+            with open(self.paths(key)[1], 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+        except OSError:
+            pass
+        return meta
+
+    def remove(self, key):
+        with self.lock:
+            meta = self.entries.pop(key, None)
+            if meta:
+                self.total_bytes -= meta['size']
+        self._remove_paths(self.paths(key))
+
+    def _remove_paths(self, paths):
+        """在锁外删除文件，顺带重试之前失败的删除；仍失败的 (Windows 上正被其他线程输出) 留待下次
+
+        已重新写入索引的 key 不再重试：其文件已被新内容替换。重试与同 key 的并发写入偶有冲突时，
+        数据文件缺失会在 _serve_proxy_cache 中被发现并按未命中处理。
+        """
+        with self.lock:
+            retry = [path for path in self.pending_deletes if self.path_key(path) not in self.entries]
+            self.pending_deletes.clear()
+        failed = []
+        for path in list(paths) + retry:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                failed.append(path)
+        if failed:
+            with self.lock:
+                self.pending_deletes.update(failed)
+
+    def _evict_locked(self):
+        """按 LRU 淘汰到预算以内；返回待删除的文件路径 (调用方在释放锁后删除)"""
+        budget = self.budget()
+        paths = []
+        while self.entries and self.total_bytes > budget:
+            key, meta = self.entries.popitem(last=False)
+            self.total_bytes -= meta['size']
+            self.evictions += 1
+            paths.extend(self.paths(key))
+        return paths
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.is_enabled(),
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "budget_bytes": self.budget(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidated": self.revalidated,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "pending_deletes": len(self.pending_deletes)
+            }
+
+
+PROXY_CACHE = ProxyMediaCache()
+
+
+# 不影响上游响应内容的请求头，不参与合并键
+PROXY_FLIGHT_IGNORED_HEADERS = {
+    'connection', 'keep-alive', 'referer', 'origin', 'user-agent', 'cache-control',
+    'pragma', 'priority', 'x-proxy-target', 'dnt'
+}
+
+
+# 单飞合并的内存缓冲上限：无跟随者时超过即停止缓冲，有跟随者时超过则转存临时文件
+PROXY_FLIGHT_MEMORY_BYTES = 4 * 1024 * 1024
+
+
+class ProxyFlightAborted(Exception):
+    """领头请求在响应体中途失败，跟随者已发出的响应不完整"""
+
+
+class ProxyFlight:
+    """一次进行中的上游 GET：响应体先缓存在内存，跟随者从头读取并追到实时位置
+
+    只有已有跟随者且响应体超过 PROXY_FLIGHT_MEMORY_BYTES 时才转存临时文件；
+    无人跟随时超过上限即丢弃缓冲并不再接受合并，普通请求不产生额外磁盘写入。
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.cond = threading.Condition()
+        self.ready = threading.Event()
+        self.status = None
+        self.reason = ''
+        self.headers = []
+        self.error = None
+        self.cache_key = None  # 回源校验 304：跟随者直接读代理缓存
+        self.has_body = False
+        self.body_complete = False
+        self.chunks = []
+        self.path = None
+        self.file = None
+        self.size = 0
+        self.joinable = True
+        self.finished = False
+        self.followers = 0
+        self.refs = 1  # 首个请求 (leader) 自身
+
+    def publish(self, status, reason, headers, has_body=True):
+        self.status, self.reason, self.headers = status, reason, headers
+        self.has_body = has_body
+        self.ready.set()
+
+    def fail(self, error):
+        self.error = error
+        self.ready.set()
+
+    def use_cache(self, cache_key):
+        self.cache_key = cache_key
+        self.ready.set()
+
+    def append(self, chunk):
+        with self.cond:
+            if not self.joinable:
+                return
+            if self.file is None:
+                if self.size + len(chunk) <= PROXY_FLIGHT_MEMORY_BYTES:
+                    self.chunks.append(chunk)
+                    self.size += len(chunk)
+                    self.cond.notify_all()
+                    return
+                if self.refs <= 1:
+                    self.joinable = False
+                    self.chunks = []
+                    return
+                fd, self.path = tempfile.mkstemp(prefix='tapnow-flight-', suffix='.part')
+                self.file = os.fdopen(fd, 'wb', buffering=0)
+                for buffered in self.chunks:
+                    self.file.write(buffered)
+                self.chunks = []
+            self.file.write(chunk)
+            self.size += len(chunk)
+            self.cond.notify_all()
+
+    def end_body(self):
+        """响应体已完整读完"""
+        self.body_complete = True
+
+    def finish(self):
+        if not self.ready.is_set():
+            self.fail("上游请求未完成")
+        with self.cond:
+            if self.has_body and not self.body_complete and self.error is None:
+                self.error = "上游响应体中断"
+            self.finished = True
+            self.joinable = False
+            self.cond.notify_all()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def iter_body(self, chunk_size=65536):
+        """逐块产出响应体；领头请求中途失败时抛出 ProxyFlightAborted"""
+        if not self.has_body:
+            return
+        offset = 0
+        index = 0
+        f = None
+        try:
+            while True:
+                with self.cond:
+                    while offset >= self.size and not self.finished:
+                        self.cond.wait()
+                    if offset >= self.size:
+                        if self.error:
+                            raise ProxyFlightAborted(self.error)
+                        return
+                    data = None
+                    if self.path is None:
+                        data = b''.join(self.chunks[index:])
+                        index = len(self.chunks)
+                    available = self.size - offset
+                if data is None:
+                    if f is None:
+                        f = open(self.path, 'rb')
+                        f.seek(offset)
+                    data = f.read(min(available, chunk_size))
+                    if not data:
+                        raise ProxyFlightAborted("共享缓冲读取失败")
+                offset += len(data)
+                yield data
+        finally:
+            if f is not None:
+                f.close()
+
+    def has_followers(self):
+        with self.cond:
+            return self.refs > 1
+
+    def release(self):
+        with self.cond:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            self.chunks = []
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class ProxyFlightGroup:
+    """相同 GET 请求的单飞合并：同一时刻只向上游发出一次请求"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.leaders = 0
+        self.followers = 0
+        self.shared_bytes = 0
+
+    @staticmethod
+    def is_enabled():
+        return bool(config.get("proxy_coalesce_enabled", True))
+
+    @staticmethod
+    def make_key(target_url, headers):
+        items = sorted(
+            (key.lower(), value) for key, value in headers.items()
+            if key.lower() not in PROXY_FLIGHT_IGNORED_HEADERS and not key.lower().startswith('sec-')
+        )
+        return (target_url, tuple(items))
+
+    def join(self, key):
+        """返回 (flight, is_leader)"""
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                with flight.cond:
+                    if flight.joinable:
+                        flight.refs += 1
+                        flight.followers += 1
+                        self.followers += 1
+                        return flight, False
+            flight = ProxyFlight(key)
+            self.flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def complete(self, flight):
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+        flight.finish()
+        flight.release()
+
+    def record_shared(self, size):
+        with self.lock:
+            self.shared_bytes += size
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": self.is_enabled(),
+                "in_flight": len(self.flights),
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "shared_bytes": self.shared_bytes
+            }
+
+
+PROXY_FLIGHTS = ProxyFlightGroup()
+
+def convert_png_to_jpg(png_data, quality=95):
+    if not PIL_AVAILABLE:
+        return png_data, False
+    try:
+        img = Image.open(BytesIO(png_data))
+        if img.mode in ('RGBA', 'LA', 'P'):
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            if img.mode == 'P':
+                img = img.convert('RGBA')
+            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=quality, optimize=True)
+        return output.getvalue(), True
+    except Exception as e:
+        log(f"PNG转JPG失败: {str(e)}")
+        return png_data, False
+
+def is_image_file(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    return ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp']
+
+def is_video_file(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    return ext in ['.mp4', '.mov', '.webm', '.avi', '.mkv']
+
+def is_media_content_type(content_type):
+    if not content_type:
+        return False
+    lower = content_type.lower()
+    return lower.startswith('image/') or lower.startswith('video/') or lower.startswith('audio/')
+
+def is_media_path(path):
+    try:
+        clean_path = (path or '').split('?', 1)[0]
+        ext = os.path.splitext(clean_path)[1].lower()
+    except Exception:
+        return False
+    return ext in MEDIA_FILE_EXTENSIONS
+
+def read_json_file(path):
+    try:
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            return json.load(f)
+    except Exception:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+# ==============================================================================
+# SECTION 3: ComfyUI 中间件模块 (Comfy Middleware Module)
+# ==============================================================================
+
+class JobRecord:
+    """任务记录：__slots__ 紧凑存储，替代自由格式 dict
+
+    字段由 Worker / WebSocket 线程单独赋值 (GIL 下原子)，读取方无需加锁；
+    状态迁移时先写结果字段、最后写 status，保证轮询方看到的结果完整。
+    """
+
+    __slots__ = (
+        'id', 'app_id', 'inputs', 'prompt', 'status', 'created_at', 'started_at',
+        'finished_at', 'progress_state', 'prompt_id', 'error', 'images', 'backend',
+        'batch_id', 'cache_key'
+    )
+
+    def __init__(self, job_id, app_id=None, inputs=None, prompt=None, created_at=None):
+        self.id = job_id
+        self.app_id = app_id
+        self.inputs = inputs
+        self.prompt = prompt
+        self.status = 'queued'
+        self.created_at = created_at or time.time()
+        self.started_at = 0
+        self.finished_at = 0
+        self.progress_state = (0, 0)
+        self.prompt_id = None
+        self.error = None
+        self.images = None
+        self.backend = None
+        self.batch_id = None
+        self.cache_key = None
+
+    def is_finished(self):
+        return self.status in ('success', 'failed', 'canceled')
+
+    def progress(self):
+        value, max_value = self.progress_state
+        return {'value': value, 'max': max_value}
+
+    def set_progress(self, value, max_value):
+        self.progress_state = (value, max_value)
+        JOB_EVENTS.publish(self, 'progress')
+
+    def mark_running(self):
+        if self.status != 'queued':
+            return False
+        self.started_at = time.time()
+        self.progress_state = (0, 0)
+        self.status = 'processing'
+        JOB_EVENTS.publish(self, 'running')
+        return True
+
+    def mark_success(self, images):
+        now = time.time()
+        self.images = images
+        self.progress_state = (100, 100)
+        self.started_at = self.started_at or now
+        self.finished_at = now
+        self.status = 'success'
+        JOB_EVENTS.publish(self, 'success')
+
+    def mark_failed(self, error):
+        now = time.time()
+        self.error = error
+        self.started_at = self.started_at or now
+        self.finished_at = now
+        self.status = 'failed'
+        JOB_EVENTS.publish(self, 'failed')
+
+    def to_dict(self):
+        data = {
+            "id": self.id,
+            "app_id": self.app_id,
+            "inputs": self.inputs,
+            "prompt": self.prompt,
+            "status": self.status,
+            "created_at": self.created_at,
+            "progress": self.progress()
+        }
+        for key in ('started_at', 'finished_at', 'prompt_id', 'error', 'backend', 'batch_id'):
+            value = getattr(self, key)
+            if value:
+                data[key] = value
+        if self.images is not None:
+            data["result"] = {"images": self.images}
+        return data
+
+
+class JobStore:
+    """任务表：进行中的任务常驻，已结束任务按空闲 TTL 与条目上限 (LRU) 淘汰"""
+
+    def __init__(self):
+        # 锁只保护索引结构本身 (均为 O(1) 操作)，任务字段读写不经过此锁
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.by_prompt = {}  # prompt_id -> job_id 二级索引
+        self.finished = OrderedDict()  # job_id -> 最近访问时间，按 LRU 排序
+        self.batches = {}  # batch_id -> [job_id, ...]，其中任务全部淘汰后移除
+        self.batch_live = {}  # batch_id -> 仍在表中的任务数
+        self.evicted = 0
+
+    def add(self, job):
+        self.add_many([job])
+
+    def add_many(self, jobs, batch_id=None):
+        with self.lock:
+            for job in jobs:
+                job.batch_id = batch_id
+                self.jobs[job.id] = job
+            if batch_id:
+                self.batches[batch_id] = [job.id for job in jobs]
+                self.batch_live[batch_id] = len(jobs)
+        for job in jobs:
+            JOB_EVENTS.publish(job, 'queued')
+
+    def get_batch(self, batch_id):
+        """返回 (job_ids, 仍在表中的任务列表)，批次不存在时返回 None"""
+        with self.lock:
+            job_ids = self.batches.get(batch_id)
+            if job_ids is None:
+                return None
+            now = time.time()
+            jobs = []
+            for job_id in job_ids:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    continue
+                if job_id in self.finished:
+                    self.finished[job_id] = now
+                    self.finished.move_to_end(job_id)
+                jobs.append(job)
+            return job_ids, jobs
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.id in self.finished:
+                self.finished[job.id] = time.time()
+                self.finished.move_to_end(job.id)
+            return job
+
+    def bind_prompt(self, job, prompt_id):
+        with self.lock:
+            if job.prompt_id and self.by_prompt.get(job.prompt_id) == job.id:
+                self.by_prompt.pop(job.prompt_id, None)
+            job.prompt_id = prompt_id
+            if prompt_id:
+                self.by_prompt[prompt_id] = job.id
+
+    def find(self, request_id):
+        """按 job_id 或 prompt_id 查找任务 (O(1))"""
+        job = self.get(request_id)
+        if job is not None:
+            return job
+        job_id = self.by_prompt.get(request_id)
+        return self.get(job_id) if job_id else None
+
+    def mark_finished(self, job):
+        """任务结束后登记到淘汰队列，并释放不再需要的工作流图"""
+        with self.lock:
+            job.prompt = None
+            self.finished[job.id] = time.time()
+            self.finished.move_to_end(job.id)
+            self._prune_locked()
+
+    def prune(self):
+        with self.lock:
+            self._prune_locked()
+
+    def _prune_locked(self):
+        ttl = config.get("comfy_job_ttl", 3600)
+        max_entries = max(1, config.get("comfy_job_max_entries", 1000))
+        expire_before = time.time() - ttl if ttl and ttl > 0 else None
+        while len(self.finished) > max_entries:
+            self._evict_locked(next(iter(self.finished)))
+        if expire_before is not None:
+            while self.finished:
+                job_id, touched_at = next(iter(self.finished.items()))
+                if touched_at >= expire_before:
+                    break
+                self._evict_locked(job_id)
+
+    def _evict_locked(self, job_id):
+        self.finished.pop(job_id, None)
+        job = self.jobs.pop(job_id, None)
+        if job is not None and job.prompt_id:
+            self.by_prompt.pop(job.prompt_id, None)
+        if job is not None and job.batch_id in self.batch_live:
+            self.batch_live[job.batch_id] -= 1
+            if self.batch_live[job.batch_id] <= 0:
+                self.batch_live.pop(job.batch_id, None)
+                self.batches.pop(job.batch_id, None)
+        self.evicted += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "jobs": len(self.jobs),
+                "finished": len(self.finished),
+                "prompt_index": len(self.by_prompt),
+                "batches": len(self.batches),
+                "evicted": self.evicted
+            }
+
+
+JOB_STORE = JobStore()
+
+
+class JobEventSubscription:
+    __slots__ = ('job_ids', 'events', 'overflow')
+
+    def __init__(self, job_ids=None, max_pending=1000):
+        self.job_ids = set(job_ids) if job_ids else None
+        self.events = queue.Queue(maxsize=max_pending)
+        self.overflow = False
+
+
+class JobEventBus:
+    """任务事件广播：状态迁移直接推送给 /comfy/events 的 SSE 订阅者"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.seq = itertools.count(1)
+        self.published = 0
+
+    def subscribe(self, job_ids=None):
+        sub = JobEventSubscription(job_ids)
+        with self.lock:
+            self.subscribers = self.subscribers + [sub]
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not sub]
+
+    @staticmethod
+    def build_event(job, event_type, seq=0):
+        data = build_detail_response(job)["data"]
+        data["event"] = event_type
+        if job.status == 'success':
+            data["outputs"] = list(job.images or [])
+        return {"id": seq, "event": event_type, "data": data}
+
+    def publish(self, job, event_type):
+        subscribers = self.subscribers  # 写时复制，读取无需加锁
+        if not subscribers:
+            return
+        event = None
+        for sub in subscribers:
+            if sub.job_ids is not None and job.id not in sub.job_ids:
+                continue
+            if event is None:
+                event = self.build_event(job, event_type, next(self.seq))
+                self.published += 1
+            try:
+                sub.events.put_nowait(event)
+            except queue.Full:
+                # 客户端消费过慢，标记后由 SSE 处理器断开
+                sub.overflow = True
+
+    def stats(self):
+        return {"subscribers": len(self.subscribers), "published": self.published}
+
+
+JOB_EVENTS = JobEventBus()
+
+
+class ComfyBackend:
+    """单个 ComfyUI 实例：独立的 WebSocket 监听线程 + Worker 线程"""
+
+    # 连续失败达到该次数后标记为不健康 (WebSocket 断开会立即标记)
+    MAX_FAILURES = 3
+
+    def __init__(self, name, url, ws_url=None, capacity=1):
+        self.name = name
+        self.url = url.rstrip('/')
+        if not ws_url:
+            parsed = urlparse(self.url)
+            ws_scheme = 'wss' if parsed.scheme == 'https' else 'ws'
+            ws_url = f"{ws_scheme}://{parsed.netloc}{parsed.path.rstrip('/')}/ws"
+        self.ws_url = ws_url
+        self.capacity = max(1, int(capacity or 1))
+        self.jobs = queue.Queue()
+        self.active = 0
+        self.healthy = True
+        self.ws_connected = False
+        self.failures = 0
+        self.completed = 0
+        self.failed = 0
+        self.last_error = ''
+        self.last_ok_at = 0
+        self.last_activity = time.time()
+
+    def host_port(self):
+        parsed = urlparse(self.url)
+        host = (parsed.hostname or '').lower()
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        return host, port
+
+    def mark_ok(self):
+        self.failures = 0
+        self.healthy = True
+        self.last_ok_at = time.time()
+
+    def mark_failure(self, error, fatal=False):
+        self.failures += 1
+        self.last_error = str(error)
+        if fatal or self.failures >= self.MAX_FAILURES:
+            if self.healthy:
+                log(f"[Comfy] 后端 {self.name} 标记为不可用: {error}")
+            self.healthy = False
+
+    def snapshot(self):
+        return {
+            "name": self.name,
+            "url": self.url,
+            "ws_url": self.ws_url,
+            "healthy": self.healthy,
+            "ws_connected": self.ws_connected,
+            "active": self.active,
+            "capacity": self.capacity,
+            "completed": self.completed,
+            "failed": self.failed,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_ok_at": format_timestamp(self.last_ok_at) if self.last_ok_at else ""
+        }
+
+
+class ComfyBackendPool:
+    """ComfyUI 后端池：按最小负载分发 JOB_QUEUE 中的任务"""
+
+    def __init__(self):
+        self.backends = []
+        self.cond = threading.Condition()
+
+    @staticmethod
+    def parse_entry(entry, index):
+        if isinstance(entry, str):
+            entry = {"url": entry}
+        if not isinstance(entry, dict) or not entry.get("url"):
+            return None
+        url = str(entry["url"]).strip()
+        if '://' not in url:
+            url = f"http://{url}"
+        name = str(entry.get("name") or f"comfy-{index}")
+        capacity = entry.get("max_inflight") or config.get("comfy_max_inflight", 1)
+        return ComfyBackend(name, url, entry.get("ws_url"), capacity)
+
+    def configure(self, entries):
+        backends = []
+        seen = set()
+        for index, entry in enumerate(entries or []):
+            backend = self.parse_entry(entry, index)
+            if not backend or backend.url in seen:
+                continue
+            seen.add(backend.url)
+            backends.append(backend)
+        if not backends:
+            backends.append(ComfyBackend("comfy-0", COMFY_URL, COMFY_WS_URL))
+        with self.cond:
+            self.backends = backends
+        return backends
+
+    def is_backend_host(self, host, port):
+        for backend in self.backends:
+            if backend.host_port() == (host, port):
+                return True
+        return False
+
+    def acquire(self):
+        """阻塞直到有后端空闲，返回负载最小的后端 (优先健康实例)"""
+        with self.cond:
+            while True:
+                free = [b for b in self.backends if b.active < b.capacity]
+                healthy = [b for b in free if b.healthy]
+                if not healthy and any(b.healthy for b in self.backends):
+                    # 存在健康实例但已满载：等待其空闲，而不是投递到故障实例
+                    free = []
+                candidates = healthy or free
+                if candidates:
+                    backend = min(candidates, key=lambda b: b.active / b.capacity)
+                    backend.active += 1
+                    return backend
+                self.cond.wait(timeout=1.0)
+
+    def release(self, backend):
+        with self.cond:
+            backend.active = max(0, backend.active - 1)
+            self.cond.notify_all()
+
+    def snapshot(self):
+        return [b.snapshot() for b in self.backends]
+
+
+COMFY_POOL = ComfyBackendPool()
+
+
+class PromptTracker:
+    """单个 prompt 的执行跟踪：WebSocket 消息增量收集输出，完成时回调 ComfyMiddleware.finalize_prompt"""
+
+    def __init__(self, prompt_id, job, backend):
+        self.prompt_id = prompt_id
+        self.job = job
+        self.backend = backend
+        self.images = []
+        self.local_images = {}  # 远程 URL -> 预取后的本地 /file/ URL
+        self.pending = 0  # 进行中的输出预取数
+        self.ready = False  # 输出收集完毕，等待预取结束即可完成
+        self.completed = False
+        self.error = None
+        self.started = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.last_activity = time.time()
+
+    def touch(self):
+        self.last_activity = time.time()
+        self.backend.last_activity = self.last_activity
+
+    def add_output(self, output):
+        for img in (output or {}).get('images', []) or []:
+            url = f"{self.backend.url}/view?filename={img['filename']}&type={img['type']}&subfolder={img['subfolder']}"
+            if url not in self.images:
+                self.images.append(url)
+                if OutputPrefetcher.is_enabled():
+                    OUTPUT_PREFETCHER.schedule(self, url, img['filename'])
+
+    def final_images(self):
+        return [self.local_images.get(url) or url for url in self.images]
+
+    def is_expired(self, timeout, now=None):
+        # 同一后端仍在推进其它 prompt 时，排队中的 prompt 不计超时
+        now = now or time.time()
+        return now - max(self.last_activity, self.backend.last_activity) >= timeout
+
+    def finish(self, error=None):
+        with self.lock:
+            if self.done.is_set():
+                return
+            if error and not self.error:
+                self.error = error
+            self.done.set()
+        ComfyMiddleware.finalize_prompt(self)
+
+
+# 通用键名兜底映射：用户键 -> 依次尝试的节点输入名
+INPUT_ALIASES = {
+    "prompt": ["text", "prompt"],
+    "text": ["text", "prompt"],
+    "seed": ["seed"],
+    "steps": ["steps"],
+    "width": ["width"],
+    "height": ["height"],
+    "batch": ["batch_size", "batch"],
+    "sampler": ["sampler_name", "sampler"],
+    "scheduler": ["scheduler"]
+}
+
+
+def normalize_input_key(key):
+    if not isinstance(key, str):
+        return key
+    # 支持前端 *_input 命名（如 seed_input / batch_input）
+    if key.endswith('_input') and len(key) > 6:
+        key = key[:-6]
+    if key in ('batch_size', 'batchSize'):
+        key = 'batch'
+    if key in ('sampler_name', 'samplerName'):
+        key = 'sampler'
+    return key
+
+
+class BindingPlan:
+    """模板的参数绑定计划：每个模板编译一次，填参时只做直接写入
+
+    - params: params_map 键 -> (node_id, 字段路径, 是否 seed)，映射无效时为 None
+    - aliases: 节点输入名 -> 唯一拥有该输入的 node_id (多个节点同名时不收录)
+    """
+
+    __slots__ = ('params', 'aliases')
+
+    def __init__(self, workflow, params_map):
+        self.params = {}
+        for key, mapping in (params_map or {}).items():
+            binding = None
+            if isinstance(mapping, dict):
+                node_id = str(mapping.get('node_id', '')).strip()
+                field_path = tuple((mapping.get('field', '') or '').split('.'))
+                if node_id in workflow and field_path and field_path[0]:
+                    binding = (node_id, field_path, field_path[-1] == 'seed')
+            self.params[key] = binding
+
+        owners = {}
+        for node_id, node in workflow.items():
+            inputs = node.get('inputs') if isinstance(node, dict) else None
+            if not isinstance(inputs, dict):
+                continue
+            for input_name in inputs:
+                owners[input_name] = node_id if input_name not in owners else None
+        wanted = {name for names in INPUT_ALIASES.values() for name in names}
+        self.aliases = {name: owners[name] for name in wanted if owners.get(name)}
+
+
+class TemplateCache:
+    """模板缓存：按 app_id 缓存解析后的 template/meta，以文件 mtime/size 校验
+
+    工作流以 marshal 字节保存，每个任务通过 marshal.loads 获得独立副本，
+    比重新解析 JSON 或 copy.deepcopy 快得多；缓存总量受 comfy_template_cache_mb 限制。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # app_id -> (signature, blob, params_map, binding_plan)
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def paths(app_id):
+        return (
+            os.path.join(WORKFLOWS_DIR, app_id, "template.json"),
+            os.path.join(WORKFLOWS_DIR, app_id, "meta.json")
+        )
+
+    @staticmethod
+    def signature(template_path, meta_path):
+        sig = []
+        for path in (template_path, meta_path):
+            try:
+                st = os.stat(path)
+                sig.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append(None)
+        return tuple(sig)
+
+    def budget(self):
+        return int(float(config.get("comfy_template_cache_mb", 64) or 0) * 1024 * 1024)
+
+    def load(self, app_id):
+        """返回 (workflow 私有副本, params_map)"""
+        workflow, params_map, _ = self.load_with_plan(app_id)
+        return workflow, params_map
+
+    def load_with_plan(self, app_id):
+        """返回 (workflow 私有副本, params_map, BindingPlan)"""
+        template_path, meta_path = self.paths(app_id)
+        sig = self.signature(template_path, meta_path)
+        if sig[0] is None:
+            raise FileNotFoundError(f"模板不存在: {app_id}")
+        with self.lock:
+            entry = self.entries.get(app_id)
+            if entry is not None and entry[0] == sig:
+                self.entries.move_to_end(app_id)
+                self.hits += 1
+                return marshal.loads(entry[1]), entry[2], entry[3]
+            self.misses += 1
+
+        workflow = read_json_file(template_path)
+        params_map = {}
+        if sig[1] is not None:
+            meta = read_json_file(meta_path)
+            params_map = meta.get('params_map', {})
+        plan = BindingPlan(workflow, params_map)
+        try:
+            blob = marshal.dumps(workflow)
+        except ValueError:
+            return workflow, params_map, plan
+        self.store(app_id, (sig, blob, params_map, plan))
+        return marshal.loads(blob), params_map, plan
+
+    def store(self, app_id, entry):
+        budget = self.budget()
+        size = len(entry[1])
+        with self.lock:
+            old = self.entries.pop(app_id, None)
+            if old is not None:
+                self.bytes_used -= len(old[1])
+            if size > budget:
+                return
+            self.entries[app_id] = entry
+            self.bytes_used += size
+            while self.bytes_used > budget and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes_used -= len(evicted[1])
+                self.evictions += 1
+
+    def invalidate(self, app_ids=None):
+        with self.lock:
+            targets = list(self.entries) if not app_ids else [a for a in app_ids if a in self.entries]
+            for app_id in targets:
+                entry = self.entries.pop(app_id)
+                self.bytes_used -= len(entry[1])
+            return targets
+
+    def preload(self, app_ids=None):
+        if not app_ids:
+            app_ids = list_workflow_apps()
+        results = {}
+        for app_id in app_ids:
+            try:
+                self.load(app_id)
+                results[app_id] = True
+            except Exception as e:
+                results[app_id] = str(e)
+        return results
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes_used,
+                "budget": self.budget(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+TEMPLATE_CACHE = TemplateCache()
+
+
+class ResultCache:
+    """生成结果缓存：以填参后工作流的规范化哈希为键，命中时直接返回已有输出
+
+    仅缓存确定性任务 (未使用 -1 随机种子)，按条目上限 (LRU) 与 TTL 淘汰。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (images, stored_at)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @staticmethod
+    def is_enabled():
+        return bool(config.get("comfy_result_cache_enabled"))
+
+    @staticmethod
+    def is_deterministic(user_inputs):
+        """输入中出现 -1 (随机种子约定) 时视为非确定性任务"""
+        if isinstance(user_inputs, list):
+            values = [item.get('fieldValue') for item in user_inputs if isinstance(item, dict)]
+        elif isinstance(user_inputs, dict):
+            values = list(user_inputs.values())
+        else:
+            values = []
+        for value in values:
+            value = ComfyMiddleware.coerce_value(value)
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and value == -1:
+                return False
+        return True
 
-def iter_proxy_response_chunks(response, chunk_size=8192):
-    if response.fp and hasattr(response.fp, 'read1'):
-        while True:
-            chunk = response.fp.read1(chunk_size)
-            if not chunk:
-                break
-            yield chunk
-        return
-    while True:
-        chunk = response.read(chunk_size)
-        if not chunk:
-            break
-        yield chunk
+    @staticmethod
+    def make_key(workflow):
+        canonical = json.dumps(workflow, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
 
-def convert_png_to_jpg(png_data, quality=95):
-    if not PIL_AVAILABLE:
-        return png_data, False
-    try:
-        img = Image.open(BytesIO(png_data))
-        if img.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-            img = background
-        elif img.mode != 'RGB':
-            img = img.convert('RGB')
-        output = BytesIO()
-        img.save(output, format='JPEG', quality=quality, optimize=True)
-        return output.getvalue(), True
-    except Exception as e:
-        log(f"PNG转JPG失败: {str(e)}")
-        return png_data, False
+    def get(self, key):
+        ttl = config.get("comfy_result_cache_ttl", 0)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and ttl and time.time() - entry[1] > ttl:
+                self.entries.pop(key, None)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[0])
 
-def is_image_file(filename):
-    ext = os.path.splitext(filename)[1].lower()
-    return ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp']
+    def put(self, key, images):
+        max_entries = max(1, config.get("comfy_result_cache_max_entries", 500))
+        with self.lock:
+            self.entries[key] = (list(images), time.time())
+            self.entries.move_to_end(key)
+            self.stores += 1
+            while len(self.entries) > max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
 
-def is_video_file(filename):
-    ext = os.path.splitext(filename)[1].lower()
-    return ext in ['.mp4', '.mov', '.webm', '.avi', '.mkv']
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
 
-def is_media_content_type(content_type):
-    if not content_type:
-        return False
-    lower = content_type.lower()
-    return lower.startswith('image/') or lower.startswith('video/') or lower.startswith('audio/')
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.is_enabled(),
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions
+            }
 
-def is_media_path(path):
-    try:
-        clean_path = (path or '').split('?', 1)[0]
-        ext = os.path.splitext(clean_path)[1].lower()
-    except Exception:
-        return False
-    return ext in MEDIA_FILE_EXTENSIONS
 
-def read_json_file(path):
-    try:
-        with open(path, 'r', encoding='utf-8-sig') as f:
-            return json.load(f)
-    except Exception:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+RESULT_CACHE = ResultCache()
+
+
+class OutputPrefetcher:
+    """输出预取：executed 消息到达即并行下载到本地保存目录，任务结果改为本地 /file/ 地址"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.downloaded = 0
+        self.failed = 0
+        self.bytes = 0
+
+    @staticmethod
+    def is_enabled():
+        return bool(config.get("comfy_prefetch_outputs"))
+
+    @staticmethod
+    def target(prompt_id, filename):
+        """返回 (保存根目录, 相对路径)；相对路径可直接用于 /file/ 访问"""
+        root = config["image_save_path"] or config["save_path"]
+        subfolder = normalize_rel_path(config.get("comfy_prefetch_subfolder") or "comfy") or "comfy"
+        name = os.path.basename(str(filename).replace('\\', '/')) or "output"
+        rel_path = f"{subfolder}/{datetime.now().strftime('%Y%m%d')}/{prompt_id}_{name}"
+        return root, rel_path
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                workers = max(1, config.get("comfy_prefetch_workers", 4))
+                self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="comfy-prefetch")
+            return self.executor
+
+    def schedule(self, tracker, url, filename):
+        with tracker.lock:
+            tracker.pending += 1
+        try:
+            self.get_executor().submit(self.download, tracker, url, filename)
+        except Exception:
+            with tracker.lock:
+                tracker.pending -= 1
+
+    def download(self, tracker, url, filename):
+        try:
+            root, rel_path = self.target(tracker.prompt_id, filename)
+            filepath = os.path.join(root, *rel_path.split('/'))
+            ensure_dir(os.path.dirname(filepath))
+            # 经上游连接池下载到唯一临时文件并原子替换，失败时不留残件
+            size = download_to_file(url, filepath)["bytes"]
+            notify_file_changed(filepath)
+            tracker.local_images[url] = f"http://127.0.0.1:{config['port']}/file/{rel_path}"
+            with self.lock:
+                self.downloaded += 1
+                self.bytes += size
+        except Exception as e:
+            # 预取失败时保留 ComfyUI 原始地址
+            with self.lock:
+                self.failed += 1
+            log(f"[Comfy] 输出预取失败: {url}: {e}")
+        finally:
+            with tracker.lock:
+                tracker.pending -= 1
+            ComfyMiddleware.try_complete(tracker)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": self.is_enabled(),
+                "downloaded": self.downloaded,
+                "failed": self.failed,
+                "bytes": self.bytes
+            }
+
+
+OUTPUT_PREFETCHER = OutputPrefetcher()
+
+
+def list_workflow_apps():
+    if not os.path.exists(WORKFLOWS_DIR):
+        return []
+    return [d for d in os.listdir(WORKFLOWS_DIR) if os.path.isdir(os.path.join(WORKFLOWS_DIR, d))]
 
-# ==============================================================================
-# SECTION 3: ComfyUI 中间件模块 (Comfy Middleware Module)
-# ==============================================================================
 
 class ComfyMiddleware:
     """封装所有 ComfyUI 相关逻辑"""
@@ -434,25 +3305,12 @@ class ComfyMiddleware:
 
     @staticmethod
     def load_template(app_id):
-        """读取 Workflow 模板"""
-        template_path = os.path.join(WORKFLOWS_DIR, app_id, "template.json")
-        meta_path = os.path.join(WORKFLOWS_DIR, app_id, "meta.json")
-        
-        if not os.path.exists(template_path):
-            raise FileNotFoundError(f"模板不存在: {app_id}")
-            
-        workflow = read_json_file(template_path)
-            
-        params_map = {}
-        if os.path.exists(meta_path):
-            meta = read_json_file(meta_path)
-            params_map = meta.get('params_map', {})
-                
-        return workflow, params_map
+        """读取 Workflow 模板 (经 TEMPLATE_CACHE 缓存，返回可自由修改的副本)"""
+        return TEMPLATE_CACHE.load(app_id)
 
     @staticmethod
-    def apply_inputs(workflow, params_map, user_inputs):
-        """填充参数到 Workflow"""
+    def apply_inputs(workflow, params_map, user_inputs, plan=None):
+        """填充参数到 Workflow (plan 为模板预编译的 BindingPlan，缺省时现场编译)"""
         if not user_inputs:
             return workflow
 
@@ -481,44 +3339,31 @@ class ComfyMiddleware:
         if not isinstance(user_inputs, dict):
             return workflow
 
-        def find_unique_node_with_input(input_name):
-            matches = []
-            for node_id, node in workflow.items():
-                inputs = node.get('inputs') if isinstance(node, dict) else None
-                if isinstance(inputs, dict) and input_name in inputs:
-                    matches.append(node_id)
-            return matches
+        if plan is None:
+            plan = BindingPlan(workflow, params_map)
 
         for key, val in user_inputs.items():
             if val is None:
                 continue
             if isinstance(val, str) and val.strip() == '':
                 continue
-            if isinstance(key, str):
-                # 支持前端 *_input 命名（如 seed_input / batch_input）
-                if key.endswith('_input') and len(key) > 6:
-                    key = key[:-6]
-                if key in ('batch_size', 'batchSize'):
-                    key = 'batch'
-                if key in ('sampler_name', 'samplerName'):
-                    key = 'sampler'
+            key = normalize_input_key(key)
             value = ComfyMiddleware.coerce_value(val)
-            handled = False
-            if key in params_map:
-                mapping = params_map[key]
-                node_id = str(mapping.get('node_id', '')).strip()
-                field_path = (mapping.get('field', '') or '').split('.')
-                if node_id in workflow and field_path and field_path[0]:
-                    if field_path[-1] == 'seed':
+            if key in plan.params:
+                binding = plan.params[key]
+                if binding:
+                    node_id, field_path, is_seed = binding
+                    if is_seed:
                         value = ComfyMiddleware.normalize_seed_value(value)
-                    target = workflow[node_id]
-                    if not ComfyMiddleware.set_by_path(target, field_path, value):
-                        log(f"[Comfy] 参数填充失败 {key}: 无法写入路径 {field_path}")
-                handled = True
+                    if not ComfyMiddleware.set_by_path(workflow[node_id], field_path, value):
+                        log(f"[Comfy] 参数填充失败 {key}: 无法写入路径 {list(field_path)}")
+                continue
+
+            if not isinstance(key, str):
                 continue
 
             # 兼容 BizyAir 风格: "NodeID:NodeType.field"
-            if isinstance(key, str) and ':' in key:
+            if ':' in key:
                 node_part, field_part = key.split(':', 1)
                 node_id = node_part.strip()
                 field_name = field_part.split('.')[-1].strip() if field_part else ''
@@ -528,11 +3373,10 @@ class ComfyMiddleware:
                     inputs = workflow[node_id].setdefault('inputs', {})
                     if isinstance(inputs, dict):
                         inputs[field_name] = value
-                handled = True
                 continue
 
             # 兼容简化 "NodeID.field"
-            if isinstance(key, str) and '.' in key:
+            if '.' in key:
                 node_part, field_name = key.split('.', 1)
                 node_id = node_part.strip()
                 field_name = field_name.strip()
@@ -542,51 +3386,30 @@ class ComfyMiddleware:
                     inputs = workflow[node_id].setdefault('inputs', {})
                     if isinstance(inputs, dict):
                         inputs[field_name] = value
-                handled = True
                 continue
 
-            # 兜底：允许用通用键名（prompt/seed/steps/width/height）
-            if not handled and isinstance(key, str):
-                alias_map = {
-                    "prompt": ["text", "prompt"],
-                    "text": ["text", "prompt"],
-                    "seed": ["seed"],
-                    "steps": ["steps"],
-                    "width": ["width"],
-                    "height": ["height"],
-                    "batch": ["batch_size", "batch"],
-                    "sampler": ["sampler_name", "sampler"],
-                    "scheduler": ["scheduler"]
-                }
-                if key in alias_map:
-                    for input_name in alias_map[key]:
-                        matches = find_unique_node_with_input(input_name)
-                        if len(matches) == 1:
-                            inputs = workflow[matches[0]].setdefault('inputs', {})
-                            if isinstance(inputs, dict):
-                                if input_name == 'seed':
-                                    value = ComfyMiddleware.normalize_seed_value(value)
-                                inputs[input_name] = value
-                            handled = True
-                            break
-                if not handled and key in ("seed", "steps", "width", "height"):
-                    matches = find_unique_node_with_input(key)
-                    if len(matches) == 1:
-                        inputs = workflow[matches[0]].setdefault('inputs', {})
-                        if isinstance(inputs, dict):
-                            if key == 'seed':
-                                value = ComfyMiddleware.normalize_seed_value(value)
-                            inputs[key] = value
-                        handled = True
+            # 兜底：允许用通用键名（prompt/seed/steps/width/height），按计划中的唯一节点直接写入
+            for input_name in INPUT_ALIASES.get(key, ()):
+                node_id = plan.aliases.get(input_name)
+                if node_id is None:
+                    continue
+                inputs = workflow[node_id].setdefault('inputs', {})
+                if isinstance(inputs, dict):
+                    if input_name == 'seed':
+                        value = ComfyMiddleware.normalize_seed_value(value)
+                    inputs[input_name] = value
+                break
         return workflow
 
     @staticmethod
-    def send_to_comfy(workflow):
-        """提交 Prompt 到 ComfyUI"""
+    def send_to_comfy(workflow, backend_url=COMFY_URL, prompt_id=None):
+        """提交 Prompt 到 ComfyUI (prompt_id 可预先指定，便于提交前注册跟踪)"""
         payload = {"client_id": CLIENT_ID, "prompt": workflow}
+        if prompt_id:
+            payload["prompt_id"] = prompt_id
         data = json.dumps(payload).encode('utf-8')
         req = urllib.request.Request(
-            f"{COMFY_URL}/prompt",
+            f"{backend_url}/prompt",
             data=data,
             headers={"Content-Type": "application/json"}
         )
@@ -605,145 +3428,266 @@ class ComfyMiddleware:
                 log(f"[Comfy] HTTPError {e.code}")
             raise
 
+    @staticmethod
+    def fetch_history(backend_url, prompt_id):
+        """查询 /history/<prompt_id>，返回该 prompt 的 outputs (未完成时返回 None)"""
+        try:
+            with urllib.request.urlopen(f"{backend_url}/history/{prompt_id}", timeout=10) as resp:
+                data = json.loads(resp.read().decode('utf-8-sig') or '{}')
+        except Exception:
+            return None
+        entry = data.get(prompt_id) if isinstance(data, dict) else None
+        if not isinstance(entry, dict):
+            return None
+        return entry.get('outputs') or {}
+
+    @staticmethod
+    def recover_from_history(tracker):
+        """从 /history 补齐输出并结束跟踪 (WebSocket 丢消息 / 完成信号缺少输出时兜底)"""
+        outputs = ComfyMiddleware.fetch_history(tracker.backend.url, tracker.prompt_id)
+        if outputs is None:
+            return False
+        for output in outputs.values():
+            tracker.add_output(output)
+        tracker.finish()
+        return True
+
+    @staticmethod
+    def on_ws_message(backend, message):
+        """WebSocket 消息处理：按 prompt_id 定位跟踪对象，增量收集输出并在完成时发出信号"""
+        try:
+            msg = json.loads(message)
+            mtype = msg.get('type')
+            data = msg.get('data') or {}
+            pid = data.get('prompt_id')
+            tracker = PROMPT_TRACKERS.get(pid) if pid else None
+            if not tracker:
+                return
+            tracker.touch()
+            if mtype in ('execution_start', 'executing') and not tracker.started:
+                # ComfyUI 开始执行该 prompt (此前仅在后端队列中排队)
+                tracker.started = True
+                tracker.job.mark_running()
+            if mtype == 'executed': # 节点执行完成，增量收集输出
+                tracker.add_output(data.get('output'))
+            elif mtype == 'executing':
+                # node 为 null 表示整个 prompt 执行结束
+                if data.get('node') is None:
+                    tracker.finish()
+            elif mtype == 'execution_success':
+                tracker.finish()
+            elif mtype == 'progress':
+                tracker.job.set_progress(data.get('value', 0), data.get('max', 0))
+            elif mtype == 'execution_error':
+                tracker.finish(data.get('exception_message') or 'execution_error')
+            elif mtype == 'execution_interrupted':
+                tracker.finish('execution_interrupted')
+        except Exception:
+            pass
+
+    @staticmethod
+    def ws_loop(backend):
+        """单个后端的 WebSocket 监听线程 (自动重连 + 健康状态维护)"""
+        def recover_pending():
+            for tracker in list(PROMPT_TRACKERS.values()):
+                if tracker.backend is backend and not tracker.done.is_set():
+                    ComfyMiddleware.recover_from_history(tracker)
+
+        def on_open(ws):
+            backend.ws_connected = True
+            backend.mark_ok()
+            log(f"[Comfy] 后端 {backend.name} WebSocket 已连接")
+            # 断线期间可能错过完成消息，重连后通过 /history 补齐
+            threading.Thread(target=recover_pending, daemon=True).start()
+
+        def on_close(ws, *args):
+            if backend.ws_connected:
+                log(f"[Comfy] 后端 {backend.name} WebSocket 已断开")
+            backend.ws_connected = False
+            backend.mark_failure("websocket closed", fatal=True)
+
+        def on_error(ws, error):
+            backend.mark_failure(error, fatal=True)
+
+        while True:
+            try:
+                # 自动重连逻辑
+                ws = websocket.WebSocketApp(
+                    f"{backend.ws_url}?clientId={CLIENT_ID}",
+                    on_open=on_open,
+                    on_message=lambda ws, message: ComfyMiddleware.on_ws_message(backend, message),
+                    on_close=on_close,
+                    on_error=on_error
+                )
+                ws.run_forever()
+            except Exception:
+                time.sleep(5)
+            time.sleep(1)
+
+    @staticmethod
+    def finalize_prompt(tracker):
+        """prompt 结束回调 (WebSocket 线程中调用)：写回任务状态并释放后端窗口"""
+        PROMPT_TRACKERS.pop(tracker.prompt_id, None)
+        if not tracker.error and not tracker.images:
+            # 输出节点命中缓存等情况下可能没有 executed 消息，回查 history (避免阻塞 WebSocket 线程)
+            def fetch_then_complete():
+                outputs = ComfyMiddleware.fetch_history(tracker.backend.url, tracker.prompt_id) or {}
+                for output in outputs.values():
+                    tracker.add_output(output)
+                tracker.ready = True
+                ComfyMiddleware.try_complete(tracker)
+            threading.Thread(target=fetch_then_complete, daemon=True).start()
+            return
+        tracker.ready = True
+        ComfyMiddleware.try_complete(tracker)
+
+    @staticmethod
+    def try_complete(tracker):
+        """输出收集完毕且预取全部结束后完成任务 (仅执行一次)"""
+        with tracker.lock:
+            if not tracker.ready or tracker.pending or tracker.completed:
+                return
+            tracker.completed = True
+        ComfyMiddleware.complete_job(tracker)
+
+    @staticmethod
+    def complete_job(tracker):
+        backend = tracker.backend
+        job = tracker.job
+        final_images = tracker.final_images()
+        error = tracker.error or (None if final_images else "未获取到生成结果")
+        if error:
+            job.mark_failed(error)
+        else:
+            job.mark_success(final_images)
+            if job.cache_key:
+                RESULT_CACHE.put(job.cache_key, final_images)
+        JOB_STORE.mark_finished(job)
+        if error:
+            backend.failed += 1
+            log(f"[Comfy] 任务异常: {job.id} @ {backend.name}: {error}")
+        else:
+            backend.completed += 1
+            log(f"[Comfy] 任务完成: {len(final_images)} images @ {backend.name}")
+        COMFY_POOL.release(backend)
+
+    @staticmethod
+    def expire_trackers(backend):
+        timeout = config.get("comfy_job_timeout", 600)
+        now = time.time()
+        for tracker in list(PROMPT_TRACKERS.values()):
+            if tracker.backend is backend and tracker.is_expired(timeout, now):
+                tracker.finish("等待生成结果超时")
+
+    @staticmethod
+    def prepare_workflow(job):
+        """加载模板并填充参数，返回待提交的工作流"""
+        if job.prompt:
+            return job.prompt
+        wf, pmap, plan = TEMPLATE_CACHE.load_with_plan(job.app_id)
+        return ComfyMiddleware.apply_inputs(wf, pmap, job.inputs, plan)
+
+    @staticmethod
+    def complete_from_cache(job, workflow):
+        """确定性任务查询结果缓存，命中则直接完成 (返回 True)"""
+        if not ResultCache.is_enabled() or not ResultCache.is_deterministic(job.inputs):
+            return False
+        job.cache_key = ResultCache.make_key(workflow)
+        images = RESULT_CACHE.get(job.cache_key)
+        if not images:
+            return False
+        job.backend = 'cache'
+        job.mark_success(images)
+        JOB_STORE.mark_finished(job)
+        log(f"[Comfy] 结果缓存命中: {job.id} ({len(images)} images)")
+        return True
+
+    @staticmethod
+    def submit_job(backend, job, wf):
+        """提交单个已填参的任务 (不等待完成，完成由 WebSocket 事件驱动)"""
+        job_id = job.id
+        prompt_id = None
+        job.backend = backend.name
+
+        try:
+            log(f"[Comfy] 提交任务: {job_id} ({job.app_id}) @ {backend.name}")
+
+            # 提交前注册跟踪，保证不会错过任何 WebSocket 消息
+            prompt_id = str(uuid.uuid4())
+            tracker = PromptTracker(prompt_id, job, backend)
+            PROMPT_TRACKERS[prompt_id] = tracker
+            try:
+                resp = ComfyMiddleware.send_to_comfy(wf, backend.url, prompt_id)
+            except urllib.error.HTTPError:
+                # 后端可达，仅是工作流本身被拒绝
+                backend.mark_ok()
+                raise
+            except Exception as e:
+                backend.mark_failure(e, fatal=True)
+                raise
+            backend.mark_ok()
+            JOB_STORE.bind_prompt(job, resp.get('prompt_id') or prompt_id)
+            if resp.get('prompt_id') and resp['prompt_id'] != prompt_id:
+                # 旧版 ComfyUI 忽略自定义 prompt_id，改用后端分配的 ID
+                PROMPT_TRACKERS.pop(prompt_id, None)
+                prompt_id = resp['prompt_id']
+                tracker.prompt_id = prompt_id
+                PROMPT_TRACKERS[prompt_id] = tracker
+                ComfyMiddleware.recover_from_history(tracker)
+            log(f"[Comfy] 已提交到后端 {backend.name}, PromptID: {prompt_id}")
+        except Exception as e:
+            log(f"[Comfy] 任务异常: {e}")
+            if prompt_id:
+                PROMPT_TRACKERS.pop(prompt_id, None)
+            backend.failed += 1
+            job.mark_failed(str(e))
+            JOB_STORE.mark_finished(job)
+            COMFY_POOL.release(backend)
+
+    @staticmethod
+    def backend_worker_loop(backend):
+        """单个后端的任务提交循环：窗口内的任务提前提交到 ComfyUI 自身队列，保持 GPU 满载"""
+        while True:
+            try:
+                item = backend.jobs.get(timeout=5) # 阻塞获取已分配的任务 (job, workflow)
+            except queue.Empty:
+                item = None
+            ComfyMiddleware.expire_trackers(backend)
+            JOB_STORE.prune()
+            if item is not None:
+                ComfyMiddleware.submit_job(backend, *item)
+
     @staticmethod
     def worker_loop():
-        """后台 Worker 线程的主循环"""
+        """后台调度线程：启动各后端线程，并将 JOB_QUEUE 任务分发到最空闲的后端"""
         if not ComfyMiddleware.is_enabled():
             return
 
-        log("ComfyUI Worker 线程已启动 (等待任务...)")
-        
-        # 1. 启动 WebSocket 监听线程
-        def on_message(ws, message):
-            try:
-                msg = json.loads(message)
-                mtype = msg.get('type')
-                if mtype == 'executed': # 节点执行完成
-                    pid = msg.get('data', {}).get('prompt_id')
-                    if not pid:
-                        return
-                    if pid not in WS_MESSAGES:
-                        WS_MESSAGES[pid] = []
-                    WS_MESSAGES[pid].append(msg)
-                elif mtype == 'progress':
-                    data = msg.get('data', {})
-                    pid = data.get('prompt_id')
-                    if not pid:
-                        return
-                    job_id = PROMPT_TO_JOB.get(pid)
-                    if not job_id:
-                        return
-                    with STATUS_LOCK:
-                        if job_id in JOB_STATUS:
-                            JOB_STATUS[job_id]['progress'] = {
-                                'value': data.get('value', 0),
-                                'max': data.get('max', 0)
-                            }
-                elif mtype == 'execution_error':
-                    data = msg.get('data', {})
-                    pid = data.get('prompt_id')
-                    job_id = PROMPT_TO_JOB.get(pid) if pid else None
-                    if job_id:
-                        with STATUS_LOCK:
-                            if job_id in JOB_STATUS and JOB_STATUS[job_id].get('status') not in ('success', 'failed'):
-                                JOB_STATUS[job_id]['status'] = 'failed'
-                                JOB_STATUS[job_id]['error'] = data.get('exception_message') or 'execution_error'
-            except: pass
-
-        def ws_thread_func():
-            while True:
-                try:
-                    # 自动重连逻辑
-                    ws = websocket.WebSocketApp(f"{COMFY_WS_URL}?clientId={CLIENT_ID}", on_message=on_message)
-                    ws.run_forever()
-                except Exception:
-                    time.sleep(5) 
-                time.sleep(1)
+        backends = COMFY_POOL.backends or COMFY_POOL.configure(config.get("comfy_backends"))
+        for backend in backends:
+            # 1. 每个后端独立的 WebSocket 监听线程与 Worker 线程
+            threading.Thread(target=ComfyMiddleware.ws_loop, args=(backend,), daemon=True).start()
+            threading.Thread(target=ComfyMiddleware.backend_worker_loop, args=(backend,), daemon=True).start()
+            log(f"[Comfy] 后端已注册: {backend.name} ({backend.url})")
 
-        threading.Thread(target=ws_thread_func, daemon=True).start()
+        log(f"ComfyUI Worker 线程已启动 (后端数: {len(backends)}, 等待任务...)")
 
-        # 2. 任务处理循环
+        # 2. 分发循环：填参 -> 结果缓存 -> 分配后端
         while True:
             job = JOB_QUEUE.get() # 阻塞获取任务
-            job_id = job['id']
-            prompt_id = None
-            
-            with STATUS_LOCK:
-                JOB_STATUS[job_id]['status'] = 'processing'
-                JOB_STATUS[job_id]['started_at'] = time.time()
-                JOB_STATUS[job_id]['progress'] = {'value': 0, 'max': 0}
-                
             try:
-                log(f"[Comfy] 开始执行任务: {job_id} ({job['app_id']})")
-                
-                # 加载与填充
-                if job.get('prompt'):
-                    wf = job['prompt']
-                else:
-                    wf, pmap = ComfyMiddleware.load_template(job['app_id'])
-                    wf = ComfyMiddleware.apply_inputs(wf, pmap, job['inputs'])
-                
-                # 提交
-                resp = ComfyMiddleware.send_to_comfy(wf)
-                prompt_id = resp['prompt_id']
-                log(f"[Comfy] 已提交到后端, PromptID: {prompt_id}")
-                with STATUS_LOCK:
-                    JOB_STATUS[job_id]['prompt_id'] = prompt_id
-                PROMPT_TO_JOB[prompt_id] = job_id
-                expected_count = 1
                 try:
-                    expected_count = max(1, int(ComfyMiddleware.extract_batch_size(wf)))
-                except Exception:
-                    expected_count = 1
-                
-                # 等待结果 (简化版 Event Loop)
-                timeout = 600
-                start_t = time.time()
-                final_images = []
-                
-                last_count = 0
-                stable_ticks = 0
-                while time.time() - start_t < timeout:
-                    if prompt_id in WS_MESSAGES:
-                        msgs = WS_MESSAGES[prompt_id]
-                        for m in msgs:
-                            # 提取 output 图片
-                            outputs = m['data'].get('output', {}).get('images', [])
-                            for img in outputs:
-                                url = f"{COMFY_URL}/view?filename={img['filename']}&type={img['type']}&subfolder={img['subfolder']}"
-                                final_images.append(url)
-                        if len(final_images) >= expected_count:
-                            break
-                        if len(final_images) == last_count and final_images:
-                            stable_ticks += 1
-                            if stable_ticks >= 3:
-                                break
-                        else:
-                            stable_ticks = 0
-                            last_count = len(final_images)
-                    time.sleep(0.5)
-                
-                if final_images:
-                    with STATUS_LOCK:
-                        JOB_STATUS[job_id]['status'] = 'success'
-                        JOB_STATUS[job_id]['result'] = {'images': final_images}
-                        JOB_STATUS[job_id]['finished_at'] = time.time()
-                        JOB_STATUS[job_id]['progress'] = {'value': 100, 'max': 100}
-                    log(f"[Comfy] 任务完成: {len(final_images)} images")
-                else:
-                    raise TimeoutError("等待生成结果超时")
-                    
-            except Exception as e:
-                log(f"[Comfy] 任务异常: {e}")
-                with STATUS_LOCK:
-                    JOB_STATUS[job_id]['status'] = 'failed'
-                    JOB_STATUS[job_id]['error'] = str(e)
-                    JOB_STATUS[job_id]['finished_at'] = time.time()
+                    wf = ComfyMiddleware.prepare_workflow(job)
+                except Exception as e:
+                    log(f"[Comfy] 任务异常: {e}")
+                    job.mark_failed(str(e))
+                    JOB_STORE.mark_finished(job)
+                    continue
+                if ComfyMiddleware.complete_from_cache(job, wf):
+                    continue
+                backend = COMFY_POOL.acquire()
+                backend.jobs.put((job, wf))
             finally:
-                if prompt_id in WS_MESSAGES:
-                    WS_MESSAGES.pop(prompt_id, None)
-                if prompt_id in PROMPT_TO_JOB:
-                    PROMPT_TO_JOB.pop(prompt_id, None)
                 JOB_QUEUE.task_done()
 
 def format_timestamp(ts):
@@ -766,18 +3710,18 @@ def normalize_job_status(status):
 
 def build_detail_response(job):
     data = {
-        "requestId": job.get('id'),
-        "taskId": job.get('id'),
-        "app_id": job.get('app_id'),
-        "status": normalize_job_status(job.get('status')),
-        "created_at": format_timestamp(job.get('created_at', 0)),
-        "updated_at": format_timestamp(job.get('finished_at') or job.get('started_at') or job.get('created_at', 0)),
-        "progress": job.get('progress') or {"value": 0, "max": 0}
+        "requestId": job.id,
+        "taskId": job.id,
+        "app_id": job.app_id,
+        "status": normalize_job_status(job.status),
+        "created_at": format_timestamp(job.created_at or 0),
+        "updated_at": format_timestamp(job.finished_at or job.started_at or job.created_at or 0),
+        "progress": job.progress()
     }
-    if job.get('prompt_id'):
-        data["prompt_id"] = job.get('prompt_id')
-    if job.get('error'):
-        data["error"] = job.get('error')
+    if job.prompt_id:
+        data["prompt_id"] = job.prompt_id
+    if job.error:
+        data["error"] = job.error
     return {
         "code": 20000,
         "message": "Ok",
@@ -787,7 +3731,7 @@ def build_detail_response(job):
 
 def build_outputs_response(job):
     outputs = []
-    images = job.get('result', {}).get('images', []) if job else []
+    images = list(job.images or []) if job else []
     for url in images:
         outputs.append({"object_url": url})
     return {
@@ -801,17 +3745,100 @@ def build_outputs_response(job):
         "outputs": outputs
     }
 
+ENQUEUE_LOCK = threading.Lock()
+
+
+def enqueue_jobs(jobs, batch_id=None):
+    """登记并入队一组任务 (同一批次的任务在队列中保持连续)"""
+    with ENQUEUE_LOCK:
+        JOB_STORE.add_many(jobs, batch_id)
+        for job in jobs:
+            JOB_QUEUE.put(job)
+
+
+def expand_batch_inputs(base_inputs, items=None, sweep=None, max_jobs=0):
+    """展开批量输入：items 中每组输入叠加 sweep 各参数的笛卡尔积，均以 base_inputs 为底
+
+    先校验类型并计算任务总数，超过 max_jobs 时在展开前抛出 ValueError。
+    """
+    base_inputs = base_inputs if isinstance(base_inputs, dict) else {}
+    if items is not None and not isinstance(items, list):
+        raise ValueError("items 必须是数组")
+    if sweep is not None and not isinstance(sweep, dict):
+        raise ValueError("sweep 必须是对象")
+    item_list = items or [{}]
+    if not all(isinstance(item, dict) for item in item_list):
+        raise ValueError("items 中的每一项必须是对象")
+    sweep = sweep or {}
+    for key, values in sweep.items():
+        if not isinstance(values, list) or not values:
+            raise ValueError(f"sweep.{key} 必须是非空数组")
+    total = len(item_list)
+    for values in sweep.values():
+        total *= len(values)
+        if max_jobs and total > max_jobs:
+            break
+    if max_jobs and total > max_jobs:
+        raise ValueError(f"批量任务数超过上限 {max_jobs}")
+    keys = list(sweep.keys())
+    combos = [dict(zip(keys, combo)) for combo in itertools.product(*sweep.values())]
+    expanded = []
+    for item in item_list:
+        for combo in combos:
+            merged = dict(base_inputs)
+            merged.update(item)
+            merged.update(combo)
+            expanded.append(merged)
+    return expanded
+
+
+def build_batch_response(batch_id, job_ids, jobs):
+    counts = {}
+    entries = []
+    outputs = []
+    for job in jobs:
+        counts[job.status] = counts.get(job.status, 0) + 1
+        images = list(job.images or [])
+        outputs.extend({"object_url": url, "requestId": job.id} for url in images)
+        entry = {
+            "requestId": job.id,
+            "status": normalize_job_status(job.status),
+            "progress": job.progress(),
+            "images": images
+        }
+        if job.error:
+            entry["error"] = job.error
+        entries.append(entry)
+    total = len(job_ids)
+    missing = total - len(jobs)
+    finished = counts.get('success', 0) + counts.get('failed', 0) + counts.get('canceled', 0)
+    if finished + missing >= total:
+        status = 'Success' if counts.get('success', 0) == total else ('Failed' if not counts.get('success') else 'Partial')
+    elif finished or counts.get('processing'):
+        status = 'Running'
+    else:
+        status = 'Queued'
+    return {
+        "code": 20000,
+        "message": "Ok",
+        "status": True,
+        "data": {
+            "batchId": batch_id,
+            "status": status,
+            "total": total,
+            "finished": finished,
+            "missing": missing,
+            "counts": {normalize_job_status(k): v for k, v in counts.items()},
+            "jobs": entries,
+            "outputs": outputs
+        }
+    }
+
+
 def resolve_job_by_request_id(request_id):
     if not request_id:
         return None
-    with STATUS_LOCK:
-        job = JOB_STATUS.get(request_id)
-        if job:
-            return job
-        for candidate in JOB_STATUS.values():
-            if candidate.get('prompt_id') == request_id:
-                return candidate
-    return None
+    return JOB_STORE.find(request_id)
 
 # ==============================================================================
 # SECTION 4: HTTP 处理器 (Request Handlers)
@@ -834,11 +3861,24 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS, HEAD, PUT, DELETE')
         self.send_header('Access-Control-Allow-Headers', '*')
     
-    def _send_json(self, data, status=200):
+    def _send_json(self, data, status=200, headers=None):
         try:
             body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            headers = dict(headers or {})
+            if len(body) >= config.get("response_compression_min_bytes", 1024):
+                encoding = choose_content_encoding(self.headers.get('Accept-Encoding'))
+                if encoding:
+                    body = compress_body(body, encoding)
+                    headers['Content-Encoding'] = encoding
+                    if 'ETag' in headers:
+                        headers['ETag'] = weaken_etag(headers['ETag'])
+            if config.get("response_compression_enabled", True):
+                headers['Vary'] = 'Accept-Encoding'
             self.send_response(status)
             self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            for header, value in headers.items():
+                self.send_header(header, value)
             self._send_cors()
             self.end_headers()
             self.wfile.write(body)
@@ -888,7 +3928,13 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
                     "port": config["port"],
                     "pil_available": PIL_AVAILABLE,
                     "convert_png_to_jpg": config["convert_png_to_jpg"]
-                }
+                },
+                "proxy_pool": UPSTREAM_POOL.stats(),
+                "proxy_cache": PROXY_CACHE.stats(),
+                "proxy_coalesce": PROXY_FLIGHTS.stats(),
+                "file_memory_cache": FILE_MEMORY_CACHE.stats(),
+                "file_path_cache": PATH_CACHE.stats(),
+                "media_index": MEDIA_INDEX.stats()
             })
             return
             
@@ -910,25 +3956,7 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
             return
 
         if path == '/list-files':
-            base_path = config["save_path"]
-            if not os.path.exists(base_path):
-                self._send_json({"success": True, "files": [], "base_path": base_path})
-                return
-            files = []
-            for root, dirs, filenames in os.walk(base_path):
-                for filename in filenames:
-                    if not (is_image_file(filename) or is_video_file(filename)):
-                        continue
-                    filepath = os.path.join(root, filename)
-                    rel_path = os.path.relpath(filepath, base_path)
-                    files.append({
-                        "filename": filename,
-                        "path": filepath.replace('\\', '/'),
-                        "rel_path": rel_path.replace('\\', '/'),
-                        "size": os.path.getsize(filepath),
-                        "mtime": os.path.getmtime(filepath)
-                    })
-            self._send_json({"success": True, "files": files, "base_path": base_path.replace('\\', '/')})
+            self.handle_list_files(parsed)
             return
 
         if path.startswith('/file/'):
@@ -952,6 +3980,19 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
         if path in ('/proxy', '/proxy/'):
             self.handle_proxy(parsed)
             return
+
+        if path == '/save':
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.lower().startswith('multipart/form-data'):
+                self.handle_save_multipart(parsed)
+                return
+            if is_raw_upload_type(content_type):
+                self.handle_save_raw(parsed)
+                return
+
+        if path in ('/save', '/save-cache') and self._is_large_body():
+            self.handle_save_json_stream(path)
+            return
             
         # 2. 原有功能路由 (Save)
         body = self._read_json_body()
@@ -976,11 +4017,26 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
         else:
             self._send_json({"error": "Endpoint not found"}, 404)
 
+    def do_HEAD(self):
+        parsed = urlparse(self.path)
+        if parsed.path in ('/proxy', '/proxy/'):
+            self.handle_proxy(parsed)
+            return
+        if parsed.path.startswith('/file/'):
+            self.handle_file_serve(parsed.path[6:])
+            return
+        self.send_response(404)
+        self._send_cors()
+        self.end_headers()
+
     def do_PUT(self):
         parsed = urlparse(self.path)
         if parsed.path in ('/proxy', '/proxy/'):
             self.handle_proxy(parsed)
             return
+        if parsed.path == '/save':
+            self.handle_save_raw(parsed)
+            return
         self._send_json({"error": "Endpoint not found"}, 404)
 
     def do_PATCH(self):
@@ -1000,16 +4056,38 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
     # --- Handlers 实现 ---
 
     def handle_comfy_get(self, path, parsed):
-        if path == '/comfy/apps':
-            apps = []
-            if os.path.exists(WORKFLOWS_DIR):
-                apps = [d for d in os.listdir(WORKFLOWS_DIR) if os.path.isdir(os.path.join(WORKFLOWS_DIR, d))]
-            self._send_json({"apps": apps})
+        if path == '/comfy/backends':
+            self._send_json({"backends": COMFY_POOL.snapshot()})
+
+        elif path == '/comfy/stats':
+            self._send_json({
+                "backends": COMFY_POOL.snapshot(),
+                "jobs": JOB_STORE.stats(),
+                "templates": TEMPLATE_CACHE.stats(),
+                "events": JOB_EVENTS.stats(),
+                "result_cache": RESULT_CACHE.stats(),
+                "prefetch": OUTPUT_PREFETCHER.stats()
+            })
+
+        elif path == '/comfy/events':
+            self.handle_comfy_events(parsed)
+
+        elif path == '/comfy/batch' or path.startswith('/comfy/batch/'):
+            params = parse_qs(parsed.query or '')
+            batch_id = path[len('/comfy/batch/'):] if path.startswith('/comfy/batch/') else (params.get('batchId', [None])[0] or params.get('batch_id', [None])[0])
+            batch = JOB_STORE.get_batch(batch_id) if batch_id else None
+            if batch:
+                self._send_json(build_batch_response(batch_id, *batch))
+            else:
+                self._send_json({"code": 404, "message": "Batch not found"}, 404)
+
+        elif path == '/comfy/apps':
+            self._send_json({"apps": list_workflow_apps()})
             
         elif path.startswith('/comfy/status/'):
             job_id = path.split('/')[-1]
             status = resolve_job_by_request_id(job_id)
-            if status: self._send_json(status)
+            if status: self._send_json(status.to_dict())
             else: self._send_json({"error": "Job not found"}, 404)
 
         elif path.startswith('/comfy/outputs/'):
@@ -1038,7 +4116,78 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
             else:
                 self._send_json({"code": 404, "message": "Job not found"}, 404)
 
+    def handle_comfy_events(self, parsed):
+        """SSE 推送任务状态 (可用 job_ids=a,b 过滤；过滤的任务全部结束后自动关闭)"""
+        params = parse_qs(parsed.query or '')
+        raw_ids = []
+        for key in ('job_ids', 'job_id', 'requestId', 'request_id', 'taskId'):
+            for value in params.get(key, []):
+                raw_ids.extend(v.strip() for v in value.split(',') if v.strip())
+        watched = {}
+        for request_id in raw_ids:
+            job = resolve_job_by_request_id(request_id)
+            watched[job.id if job else request_id] = job
+        sub = JOB_EVENTS.subscribe(list(watched) if raw_ids else None)
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('X-Accel-Buffering', 'no')
+            self._send_cors()
+            self.end_headers()
+
+            def write_event(event):
+                payload = json.dumps(event["data"], ensure_ascii=False)
+                self.wfile.write(f"id: {event['id']}\nevent: {event['event']}\ndata: {payload}\n\n".encode('utf-8'))
+                self.wfile.flush()
+
+            # 订阅后先补发当前状态，避免错过订阅前的迁移
+            pending = set()
+            for job_id, job in watched.items():
+                if job is None:
+                    write_event({"id": 0, "event": "not_found", "data": {"requestId": job_id, "event": "not_found"}})
+                    continue
+                snapshot_type = {'queued': 'queued', 'processing': 'running'}.get(job.status, job.status)
+                write_event(JobEventBus.build_event(job, snapshot_type))
+                if not job.is_finished():
+                    pending.add(job.id)
+            if raw_ids and not pending:
+                return
+
+            while not sub.overflow:
+                try:
+                    event = sub.events.get(timeout=15)
+                except queue.Empty:
+                    self.wfile.write(b": ping\n\n")
+                    self.wfile.flush()
+                    continue
+                write_event(event)
+                if raw_ids and event["event"] in ('success', 'failed', 'canceled'):
+                    pending.discard(event["data"].get("requestId"))
+                    if not pending:
+                        return
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+            pass
+        finally:
+            JOB_EVENTS.unsubscribe(sub)
+
     def handle_comfy_post(self, path):
+        if path in ('/comfy/templates/preload', '/comfy/templates/invalidate'):
+            body = self._read_json_body()
+            if body is None:
+                self._send_json({"error": "Invalid JSON"}, 400)
+                return
+            app_ids = body.get('app_ids') or ([body['app_id']] if body.get('app_id') else None)
+            if path.endswith('/preload'):
+                self._send_json({"success": True, "results": TEMPLATE_CACHE.preload(app_ids), "stats": TEMPLATE_CACHE.stats()})
+            else:
+                self._send_json({"success": True, "invalidated": TEMPLATE_CACHE.invalidate(app_ids), "stats": TEMPLATE_CACHE.stats()})
+            return
+
+        if path == '/comfy/queue-batch':
+            self.handle_comfy_queue_batch()
+            return
+
         if path in ('/comfy/queue', '/task/openapi/create', '/task/openapi/ai-app/run', '/w/v1/webapp/task/openapi/create'):
             body = self._read_json_body()
             if body is None:
@@ -1054,18 +4203,8 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
                 return
 
             job_id = str(uuid.uuid4())
-            job = {
-                "id": job_id,
-                "app_id": app_id,
-                "inputs": params,
-                "prompt": raw_prompt,
-                "status": "queued",
-                "created_at": time.time()
-            }
-
-            with STATUS_LOCK:
-                JOB_STATUS[job_id] = job
-            JOB_QUEUE.put(job)
+            job = JobRecord(job_id, app_id, params, raw_prompt)
+            enqueue_jobs([job])
 
             log(f"[Comfy] 接收任务: {job_id}")
             self._send_json({
@@ -1083,76 +4222,230 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
                 }
             })
 
-    def handle_save(self, data):
-        """处理单个文件保存"""
+    def handle_comfy_queue_batch(self):
+        """批量提交：items 列表与/或 sweep 参数扫描，全部校验通过后一次性入队"""
+        body = self._read_json_body()
+        if body is None:
+            self._send_json({"error": "Invalid JSON"}, 400)
+            return
+        app_id = body.get('app_id') or body.get('web_app_id') or body.get('webappId') or body.get('workflow_id') or body.get('appId')
+        if not app_id:
+            self._send_json({"code": 400, "message": "Missing app_id"}, 400)
+            return
+        base_inputs = body.get('input_values') or body.get('inputs') or {}
         try:
-            filename = data.get('filename', '')
-            content = data.get('content', '')
-            url = data.get('url', '')
-            subfolder = data.get('subfolder', '')
-            custom_path = data.get('path', '')
-
-            if not filename and not custom_path:
-                self._send_json({"success": False, "error": "缺少文件名"}, 400)
-                return
+            input_sets = expand_batch_inputs(base_inputs, body.get('items'), body.get('sweep'),
+                                             config.get("comfy_batch_max_jobs", 1000))
+        except ValueError as e:
+            self._send_json({"code": 400, "message": str(e)}, 400)
+            return
 
-            if custom_path:
-                custom_path = os.path.expanduser(custom_path)
-                if not os.path.isabs(custom_path):
-                    custom_path = safe_join(config["save_path"], custom_path)
-                    if not custom_path:
-                        self._send_json({"success": False, "error": "非法路径"}, 400)
-                        return
-                else:
-                    custom_path = os.path.abspath(custom_path)
-                if not is_path_allowed(custom_path):
-                    self._send_json({"success": False, "error": "不允许保存到该路径"}, 403)
-                    return
-                save_dir = os.path.dirname(custom_path)
-                filepath = custom_path
-            else:
-                if subfolder:
-                    save_dir = safe_join(config["save_path"], subfolder)
-                    if not save_dir:
-                        self._send_json({"success": False, "error": "非法子目录"}, 400)
-                        return
-                else:
-                    save_dir = config["save_path"]
-                filepath = os.path.join(save_dir, filename)
+        batch_id = str(uuid.uuid4())
+        now = time.time()
+        jobs = [JobRecord(str(uuid.uuid4()), app_id, inputs, None, now) for inputs in input_sets]
+        enqueue_jobs(jobs, batch_id)
+        job_ids = [job.id for job in jobs]
+        log(f"[Comfy] 接收批量任务: {batch_id} ({len(jobs)} jobs)")
+        self._send_json({
+            "code": 20000,
+            "message": "Ok",
+            "status": True,
+            "batchId": batch_id,
+            "requestIds": job_ids,
+            "data": {
+                "batchId": batch_id,
+                "requestIds": job_ids,
+                "count": len(job_ids),
+                "status": "Queued"
+            }
+        })
 
-            if config["auto_create_dir"]:
-                ensure_dir(save_dir)
-            elif not os.path.exists(save_dir):
-                self._send_json({"success": False, "error": f"目录不存在: {save_dir}"}, 400)
+    def handle_save(self, data, staged_path=None):
+        """处理单个文件保存；staged_path 为流式解析时已解码好的 content 临时文件"""
+        try:
+            content = data.get('content', '')
+            url = data.get('url', '')
+            try:
+                filepath = resolve_save_target(data.get('filename', ''), data.get('subfolder', ''), data.get('path', ''))
+            except SaveTargetError as e:
+                self._send_json({"success": False, "error": str(e)}, e.status)
                 return
 
-            if not config["allow_overwrite"]:
-                filepath = get_unique_filename(filepath)
-
-            if content:
+            download = None
+            if staged_path:
+                move_file_atomic(staged_path, filepath)
+                size = os.path.getsize(filepath)
+            elif content:
                 if ',' in content:
                     content = content.split(',', 1)[1]
                 file_data = base64.b64decode(content)
+                with open(filepath, 'wb') as f:
+                    f.write(file_data)
+                size = len(file_data)
             elif url:
-                with urllib.request.urlopen(url) as response:
-                    file_data = response.read()
+                try:
+                    download = download_to_file(url, filepath)
+                except DownloadError as e:
+                    log(f"文件下载失败: {url} ({e})")
+                    self._send_json({"success": False, "error": str(e)}, e.status)
+                    return
+                size = download["bytes"]
             else:
                 self._send_json({"success": False, "error": "缺少文件内容"}, 400)
                 return
+            notify_file_changed(filepath)
 
-            with open(filepath, 'wb') as f:
-                f.write(file_data)
-
-            log(f"文件已保存: {filepath} ({len(file_data)} bytes)")
-            self._send_json({
+            if download:
+                log(f"文件已下载: {filepath} ({size} bytes, {download['throughput_mbps']} MB/s)")
+            else:
+                log(f"文件已保存: {filepath} ({size} bytes)")
+            result = {
                 "success": True,
                 "message": "文件保存成功",
                 "path": filepath,
-                "size": len(file_data)
-            })
+                "size": size
+            }
+            if download:
+                result["download"] = download
+            self._send_json(result)
+        except Exception as e:
+            log(f"文件保存失败: {e}")
+            self._send_json({"success": False, "error": str(e)}, 500)
+
+    def _iter_upload_body(self):
+        """上传请求体分块迭代器 (Content-Length 或 chunked)，超过 save_max_upload_mb 时抛出 RequestBodyTooLarge"""
+        max_size = get_save_max_upload_size()
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return iter_chunked_request_body(self.rfile, max_size)
+        content_length = int(self.headers.get('Content-Length') or 0)
+        if max_size and content_length > max_size:
+            raise RequestBodyTooLarge(content_length)
+        return iter_request_body(self.rfile, content_length)
+
+    def _is_large_body(self):
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return True
+        try:
+            return int(self.headers.get('Content-Length') or 0) >= STREAMING_JSON_MIN_BYTES
+        except ValueError:
+            return False
+
+    def handle_save_json_stream(self, path):
+        """大体积 JSON 保存 ({"content": "data:...;base64,..."})：边接收边解码 content 到临时文件，内存占用与文件大小无关"""
+        staging_dir = os.path.join(config["save_path"], '.tapnow_cache', 'uploads')
+        staged_path = os.path.join(staging_dir, f"{uuid.uuid4().hex}.part")
+        try:
+            ensure_dir(staging_dir)
+            with open(staged_path, 'xb') as f:
+                decoder = Base64StreamDecoder(f)
+                data = JsonStreamReader(self._iter_upload_body()).parse('content', decoder.feed)
+                decoder.close()
+            # 字段顺序任意：目标路径在整个请求体解析完后才能确定，因此先写入暂存目录
+            staged = staged_path if decoder.received else None
+            if path == '/save':
+                self.handle_save(data, staged)
+            else:
+                self.handle_save_cache(data, staged)
+        except RequestBodyTooLarge:
+            self._send_json({"success": False, "error": "上传文件过大"}, 413)
+        except ValueError as e:
+            self._send_json({"success": False, "error": f"Invalid JSON: {e}"}, 400)
+        except Exception as e:
+            log(f"文件保存失败: {e}")
+            self._send_json({"success": False, "error": str(e)}, 500)
+        finally:
+            try:
+                os.remove(staged_path)
+            except OSError:
+                pass
+
+    def handle_save_raw(self, parsed):
+        """原始二进制上传：PUT/POST /save?filename=&subfolder=&path=，请求体直接流式写盘"""
+        params = {key: values[-1] for key, values in parse_qs(parsed.query or '').items()}
+        try:
+            filepath = resolve_save_target(params.get('filename', ''), params.get('subfolder', ''), params.get('path', ''))
+            body = self._iter_upload_body()
+            size = write_file_atomic(filepath, body)
+        except SaveTargetError as e:
+            self._send_json({"success": False, "error": str(e)}, e.status)
+            return
+        except RequestBodyTooLarge:
+            self._send_json({"success": False, "error": "上传文件过大"}, 413)
+            return
+        except Exception as e:
+            log(f"文件保存失败: {e}")
+            self._send_json({"success": False, "error": str(e)}, 500)
+            return
+        notify_file_changed(filepath)
+        log(f"文件已保存: {filepath} ({size} bytes)")
+        self._send_json({"success": True, "message": "文件保存成功", "path": filepath, "size": size})
+
+    def handle_save_multipart(self, parsed):
+        """multipart/form-data 上传：文本字段 filename/subfolder/path 需位于文件字段之前，文件部分流式写盘"""
+        fields = {key: values[-1] for key, values in parse_qs(parsed.query or '').items()}
+        content_type = Message()
+        content_type['Content-Type'] = self.headers.get('Content-Type', '')
+        boundary = content_type.get_param('boundary')
+        if not isinstance(boundary, str) or not boundary:
+            self._send_json({"success": False, "error": "缺少 multipart boundary"}, 400)
+            return
+        results = []
+        try:
+            reader = MultipartReader(self._iter_upload_body(), boundary.encode('latin-1'))
+            for name, part_filename, _, body in reader.parts():
+                if part_filename is None:
+                    value = bytearray()
+                    for chunk in body:
+                        value += chunk
+                        if len(value) > 65536:
+                            raise ValueError(f"表单字段过长: {name}")
+                    if name:
+                        fields[name] = value.decode('utf-8', errors='replace')
+                    continue
+                if part_filename == '':
+                    # 浏览器对未选择文件的 <input type=file> 发送 filename="" 的空部分，直接跳过
+                    first = next(body, None)
+                    if first is None:
+                        continue
+                    body = itertools.chain((first,), body)
+                # filename / path 字段只作用于其后的第一个文件，其余文件使用自身文件名
+                filename = fields.pop('filename', '') or os.path.basename(part_filename.replace('\\', '/'))
+                try:
+                    filepath = resolve_save_target(filename, fields.get('subfolder', ''), fields.pop('path', ''))
+                except SaveTargetError as e:
+                    results.append({"success": False, "error": str(e), "status": e.status})
+                    continue
+                size = write_file_atomic(filepath, body)
+                notify_file_changed(filepath)
+                log(f"文件已保存: {filepath} ({size} bytes)")
+                results.append({"success": True, "path": filepath, "size": size})
+        except RequestBodyTooLarge:
+            self._send_json({"success": False, "error": "上传文件过大"}, 413)
+            return
+        except ValueError as e:
+            self._send_json({"success": False, "error": str(e)}, 400)
+            return
         except Exception as e:
             log(f"文件保存失败: {e}")
             self._send_json({"success": False, "error": str(e)}, 500)
+            return
+
+        if not results:
+            self._send_json({"success": False, "error": "缺少文件内容"}, 400)
+        elif len(results) == 1:
+            result = results[0]
+            if result["success"]:
+                self._send_json({"success": True, "message": "文件保存成功", "path": result["path"], "size": result["size"]})
+            else:
+                self._send_json({"success": False, "error": result["error"]}, result["status"])
+        else:
+            for result in results:
+                result.pop("status", None)
+            self._send_json({
+                "success": True,
+                "saved_count": sum(1 for r in results if r["success"]),
+                "results": results
+            })
 
     def handle_batch_save(self, data):
         files = data.get('files', [])
@@ -1162,64 +4455,28 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
         results = []
         for item in files:
             try:
-                filename = item.get('filename', '')
                 content = item.get('content', '')
                 url = item.get('url', '')
-                subfolder = item.get('subfolder', '')
-                custom_path = item.get('path', '')
-
-                if not filename and not custom_path:
-                    results.append({"success": False, "error": "缺少文件名"})
-                    continue
-
-                if custom_path:
-                    custom_path = os.path.expanduser(custom_path)
-                    if not os.path.isabs(custom_path):
-                        custom_path = safe_join(config["save_path"], custom_path)
-                        if not custom_path:
-                            results.append({"success": False, "error": "非法路径"})
-                            continue
-                    else:
-                        custom_path = os.path.abspath(custom_path)
-                    if not is_path_allowed(custom_path):
-                        results.append({"success": False, "error": "不允许保存到该路径"})
-                        continue
-                    save_dir = os.path.dirname(custom_path)
-                    filepath = custom_path
-                else:
-                    if subfolder:
-                        save_dir = safe_join(config["save_path"], subfolder)
-                        if not save_dir:
-                            results.append({"success": False, "error": "非法子目录"})
-                            continue
-                    else:
-                        save_dir = config["save_path"]
-                    filepath = os.path.join(save_dir, filename)
-
-                if config["auto_create_dir"]:
-                    ensure_dir(save_dir)
-                elif not os.path.exists(save_dir):
-                    results.append({"success": False, "error": f"目录不存在: {save_dir}"})
+                try:
+                    filepath = resolve_save_target(item.get('filename', ''), item.get('subfolder', ''), item.get('path', ''))
+                except SaveTargetError as e:
+                    results.append({"success": False, "error": str(e)})
                     continue
 
-                if not config["allow_overwrite"]:
-                    filepath = get_unique_filename(filepath)
-
                 if content:
                     if ',' in content:
                         content = content.split(',', 1)[1]
                     file_data = base64.b64decode(content)
+                    with open(filepath, 'wb') as f:
+                        f.write(file_data)
+                    notify_file_changed(filepath)
+                    results.append({"success": True, "path": filepath, "size": len(file_data)})
                 elif url:
-                    with urllib.request.urlopen(url) as response:
-                        file_data = response.read()
+                    download = download_to_file(url, filepath)
+                    notify_file_changed(filepath)
+                    results.append({"success": True, "path": filepath, "size": download["bytes"], "download": download})
                 else:
                     results.append({"success": False, "error": "缺少文件内容"})
-                    continue
-
-                with open(filepath, 'wb') as f:
-                    f.write(file_data)
-
-                results.append({"success": True, "path": filepath, "size": len(file_data)})
             except Exception as e:
                 results.append({"success": False, "error": str(e)})
         saved_count = sum(1 for r in results if r.get('success'))
@@ -1243,6 +4500,7 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
         try:
             if os.path.exists(path):
                 os.remove(path)
+                notify_file_changed(path)
                 log(f"文件删除: {path}")
                 self._send_json({"success": True})
             else:
@@ -1302,6 +4560,7 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
                     results.append({"path": found_path, "success": False, "error": "不允许删除"})
                     continue
                 os.remove(found_path)
+                notify_file_changed(found_path)
                 results.append({"path": found_path, "success": True})
             except Exception as e:
                 results.append({"path": filepath or url, "success": False, "error": str(e)})
@@ -1320,6 +4579,8 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
             config['image_save_path'] = data['image_save_path'] or ''
         if 'video_save_path' in data:
             config['video_save_path'] = data['video_save_path'] or ''
+        if any(key in data for key in ('save_path', 'image_save_path', 'video_save_path')):
+            notify_roots_changed()
         if 'log_enabled' in data:
             # 仅在明确提供布尔值时更新，避免 null/空字符串误关闭日志
             if isinstance(data['log_enabled'], bool):
@@ -1358,6 +4619,7 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
             file_data = base64.b64decode(content)
             with open(filepath, 'wb') as f:
                 f.write(file_data)
+            notify_file_changed(filepath)
             rel_path = f".tapnow_cache/{category}/{filename}"
             local_url = f"http://127.0.0.1:{config['port']}/file/{rel_path}"
             self._send_json({
@@ -1369,7 +4631,7 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
         except Exception as e:
             self._send_json({"success": False, "error": str(e)}, 500)
 
-    def handle_save_cache(self, data):
+    def handle_save_cache(self, data, staged_path=None):
         try:
             item_id = data.get('id', '')
             content = data.get('content', '')
@@ -1377,7 +4639,7 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
             filename_ext = data.get('ext', '.jpg')
             file_type = data.get('type', 'image')
             custom_path = data.get('custom_path', '')
-            if not item_id or not content:
+            if not item_id or not (content or staged_path):
                 self._send_json({"success": False, "error": "缺少ID或内容"}, 400)
                 return
             if custom_path:
@@ -1403,18 +4665,32 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
                 base_root = config["save_path"]
                 cache_dir = os.path.join(base_root, '.tapnow_cache', category)
             ensure_dir(cache_dir)
-            if ',' in content:
-                content = content.split(',', 1)[1]
-            file_data = base64.b64decode(content)
             converted = False
-            if file_type == 'image' and config["convert_png_to_jpg"] and filename_ext.lower() == '.png':
+            convert = file_type == 'image' and config["convert_png_to_jpg"] and filename_ext.lower() == '.png' and PIL_AVAILABLE
+            if staged_path and not convert:
+                # 流式解码的内容无需转换时直接移动，不读入内存
+                file_data = None
+            elif staged_path:
+                with open(staged_path, 'rb') as f:
+                    file_data = f.read()
+            else:
+                if ',' in content:
+                    content = content.split(',', 1)[1]
+                file_data = base64.b64decode(content)
+            if convert:
                 file_data, converted = convert_png_to_jpg(file_data, config["jpg_quality"])
                 if converted:
                     filename_ext = '.jpg'
             filename = f"{item_id}{filename_ext}"
             filepath = os.path.join(cache_dir, filename)
-            with open(filepath, 'wb') as f:
-                f.write(file_data)
+            if file_data is None:
+                move_file_atomic(staged_path, filepath)
+                size = os.path.getsize(filepath)
+            else:
+                with open(filepath, 'wb') as f:
+                    f.write(file_data)
+                size = len(file_data)
+            notify_file_changed(filepath)
             try:
                 rel_path = os.path.relpath(filepath, base_root).replace('\\', '/')
             except ValueError:
@@ -1436,66 +4712,231 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
                 "url": local_url,
                 "rel_path": rel_path,
                 "converted": converted,
-                "size": len(file_data)
+                "size": size
             })
         except Exception as e:
             self._send_json({"success": False, "error": str(e)}, 500)
 
-    def handle_file_serve(self, rel_path):
-        rel_path = normalize_rel_path(rel_path)
-        if not rel_path:
-            self.send_response(400); self.end_headers(); return
-        candidates = [
-            os.path.join(config["save_path"], rel_path),
-        ]
-        if config["image_save_path"]:
-            candidates.append(os.path.join(config["image_save_path"], rel_path))
-        if config["video_save_path"]:
-            candidates.append(os.path.join(config["video_save_path"], rel_path))
-        filepath = None
-        for candidate in candidates:
-            if os.path.exists(candidate) and os.path.isfile(candidate):
-                filepath = candidate
-                break
-        if not filepath:
-            self.send_response(404); self.end_headers(); return
+    def handle_list_files(self, parsed):
+        """列出 save_path 下的媒体文件 (索引可用时支持分页/排序/过滤/增量与 ETag)"""
+        base_path = config["save_path"]
+        if not os.path.exists(base_path):
+            self._send_json({"success": True, "files": [], "base_path": base_path})
+            return
+        if not MediaIndex.is_enabled():
+            self.handle_list_files_walk(base_path)
+            return
+        params = {key: values[-1] for key, values in parse_qs(parsed.query or '').items()}
         try:
-            stat = os.stat(filepath)
-            etag = f"\"{int(stat.st_mtime)}-{stat.st_size}\""
-            if_match = self.headers.get('If-None-Match', '')
-            if if_match == etag:
+            MEDIA_INDEX.reconcile()
+            etag = MEDIA_INDEX.etag(params)
+            if etag_matches(self.headers.get('If-None-Match'), etag):
                 self.send_response(304)
+                if config.get("response_compression_enabled", True):
+                    self.send_header('Vary', 'Accept-Encoding')
+                    if choose_content_encoding(self.headers.get('Accept-Encoding')):
+                        etag = weaken_etag(etag)
                 self.send_header('ETag', etag)
-                self.send_header('Cache-Control', LOCAL_FILE_CACHE_CONTROL)
-                self.send_header('Last-Modified', formatdate(stat.st_mtime, usegmt=True))
                 self._send_cors()
                 self.end_headers()
                 return
-            content_type, _ = mimetypes.guess_type(filepath)
-            if not content_type:
-                if filepath.endswith('.png'): content_type = 'image/png'
-                elif filepath.endswith('.jpg') or filepath.endswith('.jpeg'): content_type = 'image/jpeg'
-                elif filepath.endswith('.webp'): content_type = 'image/webp'
-                elif filepath.endswith('.gif'): content_type = 'image/gif'
-                elif filepath.endswith('.mp4'): content_type = 'video/mp4'
-                elif filepath.endswith('.webm'): content_type = 'video/webm'
-                else: content_type = 'application/octet-stream'
+            if params.get('format') == 'ndjson' or params.get('limit') in (None, ''):
+                # 未分页的完整列表与 NDJSON 逐批流式输出，内存占用与首字节时间不随文件数增长
+                self.stream_list_files(params, etag, base_path, params.get('format') == 'ndjson')
+                return
+            rows, total, seq = MEDIA_INDEX.query(params)
+        except MediaIndexResyncRequired as e:
+            self._send_json({
+                "success": False,
+                "error": str(e),
+                "resync": True,
+                "seq": MEDIA_INDEX.seq,
+                "purged_seq": e.purged_seq
+            }, 410)
+            return
+        except ValueError as e:
+            self._send_json({"success": False, "error": f"参数错误: {e}"}, 400)
+            return
+        except (sqlite3.Error, OSError) as e:
+            log(f"媒体索引不可用，改用目录遍历: {e}")
+            self.handle_list_files_walk(base_path)
+            return
+        root = base_path.replace('\\', '/').rstrip('/')
+        include_deleted = params.get('since') not in (None, '')
+        files = [build_media_item(row, root, include_deleted) for row in rows]
+        offset = int(params.get('offset') or 0)
+        self._send_json({
+            "success": True,
+            "files": files,
+            "base_path": root,
+            "total": total,
+            "offset": offset,
+            "has_more": offset + len(files) < total,
+            "seq": seq
+        }, headers={'ETag': etag})
+
+    def stream_list_files(self, params, etag, base_path, ndjson=False, batch_size=1000):
+        """流式输出文件列表：JSON 模式逐段写出 files 数组，NDJSON 模式首行为 meta，其后每行一个文件
+
+        服务端为 HTTP/1.0，响应不带 Content-Length，以关闭连接标记结束。
+        响应头发出后读取索引出错时不能再改用目录遍历 (会在半截响应后写出第二个状态行)，只能中断连接。
+        """
+        conn, seq, cursor = MEDIA_INDEX.open_stream(params)
+        root = base_path.replace('\\', '/').rstrip('/')
+        include_deleted = params.get('since') not in (None, '')
+        content_type = 'application/x-ndjson; charset=utf-8' if ndjson else 'application/json; charset=utf-8'
+        # 流式输出无法预知大小，不应用 min_bytes 阈值
+        encoding = choose_content_encoding(self.headers.get('Accept-Encoding'), content_type)
+        compressor = ResponseCompressor(encoding) if encoding else None
+        headers_sent = False
+        try:
             self.send_response(200)
+            headers_sent = True
             self.send_header('Content-Type', content_type)
-            self.send_header('Content-Length', str(stat.st_size))
+            if compressor:
+                self.send_header('Content-Encoding', encoding)
+                etag = weaken_etag(etag)
+            if config.get("response_compression_enabled", True):
+                self.send_header('Vary', 'Accept-Encoding')
             self.send_header('ETag', etag)
-            self.send_header('Last-Modified', formatdate(stat.st_mtime, usegmt=True))
-            self.send_header('Cache-Control', LOCAL_FILE_CACHE_CONTROL)
             self._send_cors()
             self.end_headers()
-            if self.command == 'HEAD':
+            self.close_connection = True
+
+            def write(text, final=False):
+                data = text.encode('utf-8')
+                if compressor:
+                    data = compressor.compress(data) + (compressor.finish() if final else compressor.flush())
+                if data:
+                    self.wfile.write(data)
+            head = {"success": True, "base_path": root, "seq": seq}
+            if ndjson:
+                buffer = [json.dumps({"meta": head}, ensure_ascii=False), '\n']
+            else:
+                buffer = [json.dumps(head, ensure_ascii=False)[:-1], ', "files": [']
+            buffered = 0
+            count = 0
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    item = json.dumps(build_media_item(row, root, include_deleted), ensure_ascii=False)
+                    if ndjson:
+                        buffer.append(item)
+                        buffer.append('\n')
+                    else:
+                        buffer.append(item if count == 0 else ', ' + item)
+                    buffered += len(item)
+                    count += 1
+                if buffered >= 65536:
+                    write(''.join(buffer))
+                    buffer, buffered = [], 0
+            if not ndjson:
+                offset = int(params.get('offset') or 0)
+                buffer.append(f'], "total": {count + offset}, "offset": {offset}, "has_more": false}}')
+            write(''.join(buffer), final=True)
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+            pass
+        except (sqlite3.Error, OSError) as e:
+            if not headers_sent:
+                raise
+            log(f"文件列表流式输出中断: {e}")
+            self._abort_connection()
+        finally:
+            conn.close()
+
+    def handle_list_files_walk(self, base_path):
+        files = []
+        for root, dirs, filenames in os.walk(base_path):
+            for filename in filenames:
+                if not (is_image_file(filename) or is_video_file(filename)):
+                    continue
+                filepath = os.path.join(root, filename)
+                rel_path = os.path.relpath(filepath, base_path)
+                files.append({
+                    "filename": filename,
+                    "path": filepath.replace('\\', '/'),
+                    "rel_path": rel_path.replace('\\', '/'),
+                    "size": os.path.getsize(filepath),
+                    "mtime": os.path.getmtime(filepath)
+                })
+        self._send_json({"success": True, "files": files, "base_path": base_path.replace('\\', '/')})
+
+    def handle_file_serve(self, rel_path):
+        rel_path = normalize_rel_path(rel_path)
+        if not rel_path:
+            self.send_response(400); self.end_headers(); return
+        filepath = PATH_CACHE.resolve(rel_path)
+        if not filepath:
+            self.send_response(404); self.end_headers(); return
+        entry = FILE_MEMORY_CACHE.get(filepath)
+        if entry is not None:
+            self._serve_memory_entry(entry)
+            return
+        try:
+            f = open(filepath, 'rb')
+        except FileNotFoundError:
+            # 缓存的路径已被外部删除：重新解析一次
+            PATH_CACHE.invalidate(rel_path)
+            filepath = PATH_CACHE.resolve(rel_path)
+            if not filepath:
+                self.send_response(404); self.end_headers(); return
+            self._serve_local_file(filepath)
+            return
+        except OSError:
+            self._serve_local_file(filepath)
+            return
+        # 只打开一次：小文件读入内存缓存，大文件直接用同一句柄输出
+        with f:
+            try:
+                stat = os.fstat(f.fileno())
+                entry = FILE_MEMORY_CACHE.load(filepath, f, stat)
+            except OSError:
+                stat, entry = None, None
+            if entry is not None:
+                self._serve_memory_entry(entry)
                 return
-            with open(filepath, 'rb') as f:
-                while True:
-                    chunk = f.read(8192)
-                    if not chunk:
-                        break
-                    self.wfile.write(chunk)
+            self._serve_file_handle(f, filepath, stat)
+
+    def _serve_memory_entry(self, entry):
+        view = memoryview(entry.data)
+        try:
+            self._send_file_response(
+                entry.size, entry.etag, entry.last_modified, entry.content_type,
+                LOCAL_FILE_CACHE_CONTROL, None,
+                lambda start, length: self.wfile.write(view[start:start + length])
+            )
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+            return
+
+    def _serve_local_file(self, filepath, content_type=None, etag=None, last_modified=None,
+                          cache_control=LOCAL_FILE_CACHE_CONTROL, extra_headers=None):
+        """本地文件输出 (/file/ 与代理缓存命中共用)"""
+        try:
+            f = open(filepath, 'rb')
+        except Exception:
+            try:
+                self.send_response(500); self.end_headers()
+            except Exception:
+                pass
+            return
+        with f:
+            self._serve_file_handle(f, filepath, None, content_type, etag, last_modified, cache_control, extra_headers)
+
+    def _serve_file_handle(self, f, filepath, stat=None, content_type=None, etag=None, last_modified=None,
+                           cache_control=LOCAL_FILE_CACHE_CONTROL, extra_headers=None):
+        """用已打开的文件输出 (按偏移读取，与当前读位置无关)；文件由调用方关闭"""
+        try:
+            stat = stat or os.fstat(f.fileno())
+            self._send_file_response(
+                stat.st_size,
+                etag or f"\"{int(stat.st_mtime)}-{stat.st_size}\"",
+                last_modified or formatdate(stat.st_mtime, usegmt=True),
+                content_type or guess_content_type(filepath),
+                cache_control, extra_headers,
+                lambda start, length: self._send_file_body(f, start, length)
+            )
         except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
             return
         except Exception:
@@ -1504,6 +4945,69 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
             except Exception:
                 pass
 
+    def _send_file_response(self, size, etag, last_modified, content_type, cache_control, extra_headers, send_body):
+        """条件请求 + Range 分段的通用响应；send_body(start, length) 负责输出内容"""
+        def send_common_headers():
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Cache-Control', cache_control)
+            self.send_header('Accept-Ranges', 'bytes')
+            for header, value in (extra_headers or {}).items():
+                self.send_header(header, value)
+            self._send_cors()
+
+        if is_not_modified(self.headers, etag, last_modified):
+            self.send_response(304)
+            send_common_headers()
+            self.end_headers()
+            return
+
+        byte_range = None
+        range_header = self.headers.get('Range')
+        if range_header and is_if_range_satisfied(self.headers.get('If-Range'), etag, last_modified):
+            byte_range = parse_byte_range(range_header, size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{size}")
+                self.send_header('Content-Length', '0')
+                send_common_headers()
+                self.end_headers()
+                return
+
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            start, end = 0, size - 1
+            self.send_response(200)
+        length = end - start + 1 if size else 0
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(length))
+        send_common_headers()
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        send_body(start, length)
+
+    def _send_file_body(self, f, offset, count):
+        """发送文件片段：普通 socket 上走 sendfile 零拷贝，否则用大缓冲区复制"""
+        if count <= 0:
+            return
+        sock = self.connection
+        if config.get("file_sendfile_enabled", True) and hasattr(os, 'sendfile') and type(sock) is socket.socket:
+            sock.sendfile(f, offset, count)
+            return
+        f.seek(offset)
+        buffer = memoryview(bytearray(min(FILE_COPY_BUFFER_SIZE, count)))
+        remaining = count
+        while remaining > 0:
+            read = f.readinto(buffer[:min(len(buffer), remaining)])
+            if not read:
+                break
+            remaining -= read
+            self.wfile.write(buffer[:read])
+
     def handle_proxy(self, parsed):
         target_url = parse_proxy_target(parsed, self.headers)
         if not target_url:
@@ -1518,8 +5022,27 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
             return
 
         method = self.command
-        content_length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(content_length) if content_length > 0 else None
+        # 请求体边收边转发：定长按 Content-Length 分块，chunked 解码后以 chunked 转发
+        max_body_size = get_proxy_max_body_size()
+        transfer_encoding = self.headers.get('Transfer-Encoding', '').lower()
+        content_length = 0
+        body = None
+        try:
+            if 'chunked' in transfer_encoding:
+                body = iter_chunked_request_body(self.rfile, max_body_size)
+            else:
+                content_length = int(self.headers.get('Content-Length', 0) or 0)
+                if max_body_size and content_length > max_body_size:
+                    raise RequestBodyTooLarge(content_length)
+                if content_length > 0:
+                    body = iter_request_body(self.rfile, content_length)
+        except ValueError:
+            self._send_json({"success": False, "error": "非法 Content-Length"}, 400)
+            return
+        except RequestBodyTooLarge:
+            self.close_connection = True
+            self._send_json({"success": False, "error": "请求体超过大小限制"}, 413)
+            return
 
         forward_headers = {}
         for key, value in self.headers.items():
@@ -1531,28 +5054,100 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
             forward_headers[key] = value
         if parsed_target.netloc:
             forward_headers['Host'] = parsed_target.netloc
+        if body is not None and content_length > 0:
+            forward_headers['Content-Length'] = str(content_length)
 
         path = parsed_target.path or '/'
         if parsed_target.query:
             path = f"{path}?{parsed_target.query}"
 
+        # 媒体缓存：仅匿名 GET/HEAD (Range 请求可由缓存命中分段返回，未命中时不写入)
+        cache_key = cache_meta = None
+        use_cache = (
+            method in ('GET', 'HEAD')
+            and body is None
+            and ProxyMediaCache.is_enabled()
+            and not self.headers.get('Authorization')
+        )
+        if use_cache:
+            cache_key, cache_meta, fresh = PROXY_CACHE.lookup(target_url)
+            if cache_meta is not None and fresh and self._serve_proxy_cache(cache_key, cache_meta, 'HIT'):
+                PROXY_CACHE.record('hit')
+                return
+            validators = cache_meta.get('headers', {}) if cache_meta else {}
+            if validators.get('etag') or validators.get('last-modified'):
+                # 过期条目回源校验；客户端自身的协商头由本地响应处理。
+                # 带 Range 时保留客户端的 If-Range：资源已变化时上游据此返回完整 200，
+                # 而不是把新版本的片段拼到客户端按旧版本校验过的数据上
+                has_range = any(key.lower() == 'range' for key in forward_headers)
+                for key in list(forward_headers):
+                    lower = key.lower()
+                    if lower == 'if-range' and has_range:
+                        continue
+                    if lower in ('if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since', 'if-range'):
+                        forward_headers.pop(key)
+                if validators.get('etag'):
+                    forward_headers['If-None-Match'] = validators['etag']
+                if validators.get('last-modified'):
+                    forward_headers['If-Modified-Since'] = validators['last-modified']
+            else:
+                cache_meta = None
+
+        # 相同 GET 并发合并：首个请求回源，其余请求从共享缓冲跟随读取
+        flight = None
+        if (method == 'GET' and body is None and ProxyFlightGroup.is_enabled()
+                and 'text/event-stream' not in self.headers.get('Accept', '')):
+            flight, is_leader = PROXY_FLIGHTS.join(ProxyFlightGroup.make_key(target_url, self.headers))
+            if not is_leader:
+                self._follow_proxy_flight(flight)
+                return
+        try:
+            self._forward_proxy_request(
+                parsed_target, method, path, body, forward_headers,
+                target_url, use_cache, cache_key, cache_meta, flight
+            )
+        finally:
+            if flight:
+                PROXY_FLIGHTS.complete(flight)
+
+    def _forward_proxy_request(self, parsed_target, method, path, body, forward_headers,
+                               target_url, use_cache, cache_key, cache_meta, flight):
         port = parsed_target.port or (443 if parsed_target.scheme == 'https' else 80)
-        conn_class = http.client.HTTPSConnection if parsed_target.scheme == 'https' else http.client.HTTPConnection
         timeout_value = config.get("proxy_timeout", DEFAULT_PROXY_TIMEOUT)
         timeout_value = None if timeout_value == 0 else timeout_value
         try:
-            conn = conn_class(parsed_target.hostname, port, timeout=timeout_value)
-            conn.request(method, path, body=body, headers=forward_headers)
-            resp = conn.getresponse()
+            conn, resp = UPSTREAM_POOL.request(
+                parsed_target.scheme, parsed_target.hostname, port,
+                method, path, body, forward_headers, timeout_value
+            )
+        except RequestBodyTooLarge:
+            self.close_connection = True
+            self._send_json({"success": False, "error": "请求体超过大小限制"}, 413)
+            return
         except Exception as exc:
             log(f"代理请求失败: {exc}")
+            if flight:
+                flight.fail(f"代理请求失败: {exc}")
+            self.close_connection = True
             self._send_json({"success": False, "error": f"代理请求失败: {exc}"}, 502)
-            try:
-                conn.close()
-            except Exception:
-                pass
             return
 
+        if cache_meta is not None and resp.status == 304:
+            resp.read()
+            UPSTREAM_POOL.release(conn, resp)
+            resp.close()
+            cache_meta = PROXY_CACHE.refresh(cache_key, resp.getheaders())
+            if cache_meta is not None and self._serve_proxy_cache(cache_key, cache_meta, 'REVALIDATED'):
+                PROXY_CACHE.record('revalidated')
+                if flight:
+                    flight.use_cache(cache_key)
+            else:
+                if flight:
+                    flight.fail("缓存条目已失效，请重试")
+                self._send_json({"success": False, "error": "缓存条目已失效，请重试"}, 502)
+            return
+
+        writer = None
         try:
             response_headers = resp.getheaders()
             content_type = ''
@@ -1565,30 +5160,125 @@ class TapnowFullHandler(BaseHTTPRequestHandler):
                 and resp.status in (200, 203, 206)
                 and (is_media_content_type(content_type) or is_media_path(parsed_target.path))
             )
-            self.send_response(resp.status, resp.reason)
+            client_headers = []
             for header, value in response_headers:
                 lower = header.lower()
                 if lower in PROXY_SKIP_RESPONSE_HEADERS:
                     continue
                 if should_override_cache and lower in ('cache-control', 'expires', 'pragma'):
                     continue
-                self.send_header(header, value)
+                client_headers.append((header, value))
             if should_override_cache:
-                self.send_header('Cache-Control', PROXY_MEDIA_CACHE_CONTROL)
-            self._send_cors()
-            self.end_headers()
+                client_headers.append(('Cache-Control', PROXY_MEDIA_CACHE_CONTROL))
+            if use_cache:
+                PROXY_CACHE.record('miss')
+                client_headers.append(('X-Tapnow-Cache', 'MISS'))
+            if flight:
+                flight.publish(resp.status, resp.reason, client_headers, method != 'HEAD')
+
+            client_alive = True
+            try:
+                self.send_response(resp.status, resp.reason)
+                for header, value in client_headers:
+                    self.send_header(header, value)
+                self._send_cors()
+                self.end_headers()
+            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+                client_alive = False
 
             if method == 'HEAD':
+                resp.read()
                 return
 
+            if use_cache and should_override_cache:
+                writer = PROXY_CACHE.open_writer(cache_key, target_url, resp, response_headers)
             for chunk in iter_proxy_response_chunks(resp):
-                self.wfile.write(chunk)
-                self.wfile.flush()
+                if writer:
+                    writer.write(chunk)
+                if flight:
+                    flight.append(chunk)
+                if client_alive:
+                    try:
+                        self.wfile.write(chunk)
+                        self.wfile.flush()
+                    except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+                        client_alive = False
+                # 客户端已断开：仍有跟随者或正在写缓存时继续读完上游
+                if not client_alive and not (flight and flight.has_followers()) and not (writer and writer.active()):
+                    return
+            if flight:
+                flight.end_body()
+            if writer:
+                writer.commit()
+                writer = None
         except (BrokenPipeError, ConnectionResetError):
             pass
         finally:
+            if writer:
+                writer.abort()
+            # 响应未读完 (客户端中断等) 时 release 会直接关闭连接
+            UPSTREAM_POOL.release(conn, resp)
             resp.close()
-            conn.close()
+
+    def _follow_proxy_flight(self, flight):
+        """跟随进行中的相同请求：复用其响应头，并从共享缓冲读取响应体"""
+        try:
+            timeout_value = config.get("proxy_timeout", DEFAULT_PROXY_TIMEOUT) or None
+            if not flight.ready.wait(timeout_value):
+                self._send_json({"success": False, "error": "代理请求超时"}, 504)
+                return
+            if flight.cache_key:
+                meta = PROXY_CACHE.lookup_key(flight.cache_key)
+                if meta is None or not self._serve_proxy_cache(flight.cache_key, meta, 'REVALIDATED'):
+                    self._send_json({"success": False, "error": "缓存条目已失效，请重试"}, 502)
+                return
+            if flight.error:
+                self._send_json({"success": False, "error": flight.error}, 502)
+                return
+            self.send_response(flight.status, flight.reason)
+            for header, value in flight.headers:
+                self.send_header(header, value)
+            self.send_header('X-Tapnow-Coalesced', '1')
+            self._send_cors()
+            self.end_headers()
+            sent = 0
+            for chunk in flight.iter_body():
+                self.wfile.write(chunk)
+                sent += len(chunk)
+            self.wfile.flush()
+            PROXY_FLIGHTS.record_shared(sent)
+        except ProxyFlightAborted as e:
+            log(f"代理合并请求中断: {e}")
+            self._abort_connection()
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+            pass
+        finally:
+            flight.release()
+
+    def _abort_connection(self):
+        """以 RST 关闭连接：响应头已发出但响应体不完整时，让客户端报错而不是当作正常结束"""
+        self.close_connection = True
+        try:
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except OSError:
+            pass
+
+    def _serve_proxy_cache(self, cache_key, meta, outcome):
+        """从代理缓存输出；数据文件已被淘汰时返回 False"""
+        data_path = PROXY_CACHE.paths(cache_key)[0]
+        if not os.path.isfile(data_path):
+            PROXY_CACHE.remove(cache_key)
+            return False
+        headers = meta.get('headers', {})
+        self._serve_local_file(
+            data_path,
+            content_type=headers.get('content-type'),
+            etag=headers.get('etag'),
+            last_modified=headers.get('last-modified'),
+            cache_control=PROXY_MEDIA_CACHE_CONTROL,
+            extra_headers={'X-Tapnow-Cache': outcome}
+        )
+        return True
 
 
 # ==============================================================================
@@ -1613,6 +5303,8 @@ def main():
 
     # 3. 启动后台线程
     if FEATURES["comfy_middleware"]:
+        COMFY_POOL.configure(config.get("comfy_backends"))
+        threading.Thread(target=TEMPLATE_CACHE.preload, daemon=True).start()
         t = threading.Thread(target=ComfyMiddleware.worker_loop, daemon=True)
         t.start()
         log(f"ComfyUI 中间件模块已启用 (Workflows: {WORKFLOWS_DIR})")
@@ -1630,6 +5322,9 @@ def main():
     print(f"  [x] File Server")
     print(f"  [x] HTTP Proxy")
     print(f"  [{'x' if FEATURES['comfy_middleware'] else ' '}] ComfyUI Middleware")
+    if FEATURES['comfy_middleware']:
+        for backend in COMFY_POOL.backends:
+            print(f"      - {backend.name}: {backend.url}")
     print("=" * 60)
     
     try:
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+/list-files 流式输出出错测试
+
+1. 响应头发出后索引读取出错 (fetchmany 抛出 sqlite3.Error)：只中断连接，不能再写出目录遍历的第二个响应
+2. 响应头发出前出错 (open_stream 抛出)：回退到目录遍历，返回完整列表
+
+可直接运行，也可由 pytest 收集 (test_* 函数)。
+
+用法:
+    python tests/test_list_files_stream.py
+"""
+
+import os
+import sys
+import json
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import importlib.util
+from http.server import ThreadingHTTPServer
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tapnow-server-full.py")
+
+FILE_COUNT = 30
+
+_server = None
+
+
+def load_server():
+    global _server
+    if _server is None:
+        spec = importlib.util.spec_from_file_location("tapnow_server_full", SERVER_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.config["log_enabled"] = False
+        _server = module
+    return _server
+
+
+class FailingCursor:
+    """第一批正常返回，之后模拟 WAL 下的 "database is locked" """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.calls = 0
+
+    def fetchmany(self, size):
+        self.calls += 1
+        if self.calls > 1:
+            raise sqlite3.OperationalError("database is locked")
+        return self.cursor.fetchmany(size)
+
+
+class ListFilesServer:
+    """临时保存目录 + 本进程内的 HTTP 服务；记录目录遍历回退的调用次数"""
+
+    def __init__(self):
+        self.server = load_server()
+        self.root = tempfile.mkdtemp()
+        for index in range(FILE_COUNT):
+            with open(os.path.join(self.root, f"{index:03d}.png"), "wb") as f:
+                f.write(b"x" * (index + 1))
+        self.saved = (self.server.config["save_path"], self.server.config["media_index_enabled"])
+        self.server.config["save_path"] = self.root
+        self.server.config["media_index_enabled"] = True
+        self.walks = 0
+        handler_class = self.server.TapnowFullHandler
+        original_walk = handler_class.handle_list_files_walk
+        owner = self
+
+        class Handler(handler_class):
+            def log_message(self, *args):
+                pass
+
+            def handle_list_files_walk(self, base_path):
+                owner.walks += 1
+                return original_walk(self, base_path)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def get(self, path):
+        """原始 socket 读取完整响应 (含被 RST 中断的情况)"""
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=10)
+        sock.sendall(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        data = b""
+        try:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        except ConnectionResetError:
+            pass
+        finally:
+            sock.close()
+        return data
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.server.config["save_path"], self.server.config["media_index_enabled"] = self.saved
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def patch_open_stream(server, replacement):
+    index = server.MEDIA_INDEX
+    original = index.open_stream
+    index.open_stream = lambda params: replacement(original, params)
+    return lambda: setattr(index, "open_stream", original)
+
+
+def fail_mid_stream(original, params):
+    conn, seq, cursor = original(params)
+    return conn, seq, FailingCursor(cursor)
+
+
+def fail_before_headers(original, params):
+    raise sqlite3.OperationalError("database is locked")
+
+
+def test_error_after_headers_aborts_stream():
+    ctx = ListFilesServer()
+    restore = patch_open_stream(ctx.server, fail_mid_stream)
+    try:
+        for path in ("/list-files", "/list-files?format=ndjson"):
+            data = ctx.get(path)
+            # 只能有一个状态行；中断后不得再写出目录遍历的响应
+            assert data.count(b"HTTP/1.") <= 1, data[:500]
+            if data:
+                assert data.startswith(b"HTTP/1.0 200"), data[:200]
+                body = data.partition(b"\r\n\r\n")[2]
+                if path.endswith("ndjson"):
+                    assert body.count(b"\n") <= 1, body[:500]
+                else:
+                    try:
+                        json.loads(body)
+                    except ValueError:
+                        pass
+                    else:
+                        raise AssertionError("中断的 JSON 响应不应是完整文档")
+        assert ctx.walks == 0, ctx.walks
+    finally:
+        restore()
+        ctx.close()
+
+
+def test_error_before_headers_falls_back_to_walk():
+    ctx = ListFilesServer()
+    restore = patch_open_stream(ctx.server, fail_before_headers)
+    try:
+        data = ctx.get("/list-files")
+        assert data.count(b"HTTP/1.") == 1, data[:500]
+        assert data.startswith(b"HTTP/1.0 200"), data[:200]
+        payload = json.loads(data.partition(b"\r\n\r\n")[2])
+        assert payload["success"] and len(payload["files"]) == FILE_COUNT
+        assert ctx.walks == 1, ctx.walks
+    finally:
+        restore()
+        ctx.close()
+
+
+def test_stream_without_error():
+    ctx = ListFilesServer()
+    try:
+        payload = json.loads(ctx.get("/list-files").partition(b"\r\n\r\n")[2])
+        assert payload["total"] == FILE_COUNT and len(payload["files"]) == FILE_COUNT
+        assert ctx.walks == 0
+    finally:
+        ctx.close()
+
+
+TESTS = [
+    test_error_after_headers_aborts_stream,
+    test_error_before_headers_falls_back_to_walk,
+    test_stream_without_error,
+]
+
+
+def main():
+    load_server()
+    failed = 0
+    for test in TESTS:
+        try:
+            test()
+        except Exception as e:
+            failed += 1
+            print(f"  FAIL {test.__name__}: {type(e).__name__}: {str(e)[:300]}")
+        else:
+            print(f"  ok   {test.__name__}")
+    print(f"{len(TESTS) - failed}/{len(TESTS)} passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流式解析器分块边界测试
+
+对同一份输入按随机位置切分 (含逐字节切分) 后喂给解析器，检查结果与一次性解析一致：
+1. MultipartReader:           分隔符/CRLF 跨块、正文中含近似分隔符、未读完的部分自动丢弃
+2. JsonStreamReader:          字段名/转义/\\uXXXX 跨块，流式字段与其余字段
+3. Base64StreamDecoder:       data URL 前缀与换行跨块，无前缀时的回退
+4. parse_byte_range:          单段/后缀/越界/非法 Range
+5. iter_chunked_request_body: 分块长度行、扩展参数、trailer 跨读，上限与截断
+
+可直接运行，也可由 pytest 收集 (test_* 函数)。
+
+用法:
+    python tests/test_stream_parsers.py [--rounds 200] [--seed 1]
+"""
+
+import io
+import os
+import sys
+import json
+import base64
+import random
+import argparse
+import importlib.util
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tapnow-server-full.py")
+
+ROUNDS = 200
+SEED = 1
+
+_server = None
+
+
+def load_server():
+    global _server
+    if _server is None:
+        spec = importlib.util.spec_from_file_location("tapnow_server_full", SERVER_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.config["log_enabled"] = False
+        _server = module
+    return _server
+
+
+def split_random(data, rng):
+    """随机切分；约四分之一的情况逐字节切分"""
+    if rng.random() < 0.25:
+        return [data[i:i + 1] for i in range(len(data))]
+    chunks, pos = [], 0
+    while pos < len(data):
+        size = rng.choice((1, 2, 3, 5, 7, 16, 64, 1000, 4096))
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def random_bytes(rng, size):
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+def expect_error(exc_type, func):
+    try:
+        func()
+    except exc_type:
+        return
+    raise AssertionError(f"应抛出 {exc_type.__name__}")
+
+
+# ---------- MultipartReader ----------
+
+def build_multipart(boundary, parts):
+    body = [b"preamble\r\n"]
+    for name, filename, payload in parts:
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        body.append(b"--" + boundary + b"\r\n")
+        body.append(f"Content-Disposition: {disposition}\r\n".encode())
+        body.append(b"Content-Type: application/octet-stream\r\n\r\n")
+        body.append(payload + b"\r\n")
+    body.append(b"--" + boundary + b"--\r\n")
+    return b"".join(body)
+
+
+def multipart_payload(rng, boundary):
+    """正文中混入分隔符前缀、CRLF 与 -- 等易误判片段 (完整分隔符不会出现在合法正文中)"""
+    while True:
+        pieces = []
+        for _ in range(rng.randint(0, 6)):
+            pieces.append(rng.choice((
+                random_bytes(rng, rng.randint(0, 300)),
+                b"\r\n",
+                b"\r\n--",
+                b"\r\n--" + boundary[:rng.randint(0, len(boundary) - 1)],
+                b"--" + boundary,
+                b"-",
+            )))
+        payload = b"".join(pieces)
+        if b"\r\n--" + boundary not in b"\r\n" + payload:
+            return payload
+
+
+def test_multipart_round_trip():
+    server = load_server()
+    rng = random.Random(SEED)
+    for _ in range(ROUNDS):
+        boundary = b"----tapnow" + str(rng.getrandbits(32)).encode()
+        parts = []
+        for index in range(rng.randint(1, 4)):
+            filename = f"f{index}.bin" if rng.random() < 0.7 else None
+            parts.append((f"field{index}", filename, multipart_payload(rng, boundary)))
+        body = build_multipart(boundary, parts)
+        skip = rng.randrange(len(parts))
+        reader = server.MultipartReader(split_random(body, rng), boundary)
+        got = []
+        for index, (name, filename, content_type, body_iter) in enumerate(reader.parts()):
+            if index == skip:
+                got.append((name, filename, None))  # 不读正文，由解析器丢弃
+                continue
+            got.append((name, filename, b"".join(body_iter)))
+            assert content_type == "application/octet-stream"
+        expected = [(name, filename, None if index == skip else payload) for index, (name, filename, payload) in enumerate(parts)]
+        assert got == expected, (got, expected)
+
+
+def test_multipart_truncated():
+    server = load_server()
+    boundary = b"xyz"
+    body = build_multipart(boundary, [("file", "a.bin", b"hello")])
+    for cut in range(len(body) - 4):
+        reader = server.MultipartReader(split_random(body[:cut], random.Random(cut)), boundary)
+
+        def consume():
+            for _, _, _, body_iter in reader.parts():
+                for _ in body_iter:
+                    pass
+        expect_error(ValueError, consume)
+
+
+# ---------- JsonStreamReader + Base64StreamDecoder ----------
+
+def random_text(rng, size):
+    """BMP 字符 (不含代理区)，覆盖 ASCII 控制字符、引号、反斜杠与多字节 UTF-8"""
+    alphabet = '"\\/\b\f\n\r\t aZ09,:{}[]é中'
+    chars = []
+    for _ in range(size):
+        if rng.random() < 0.5:
+            chars.append(rng.choice(alphabet))
+        else:
+            code = rng.randint(1, 0xFFFF)
+            chars.append(chr(code) if not 0xD800 <= code <= 0xDFFF else 'x')
+    return ''.join(chars)
+
+
+def test_json_stream_round_trip():
+    server = load_server()
+    rng = random.Random(SEED)
+    for _ in range(ROUNDS):
+        content = random_text(rng, rng.randint(0, 400))
+        others = {
+            "filename": random_text(rng, 8),
+            "subfolder": "a/b",
+            "count": rng.randint(-5, 5),
+            "ratio": 0.5,
+            "flag": rng.random() < 0.5,
+            "none": None,
+            "nested": {"list": [1, "two", {"three": [3]}], "text": "}]\","},
+        }
+        items = list(others.items()) + [("content", content)]
+        rng.shuffle(items)
+        raw = json.dumps(dict(items), ensure_ascii=rng.random() < 0.5, indent=rng.choice((None, 1))).encode("utf-8")
+        received = []
+        fields = server.JsonStreamReader(split_random(raw, rng)).parse("content", received.append)
+        assert b"".join(received) == content.encode("utf-8")
+        assert fields == others, (fields, others)
+
+
+def test_json_stream_truncated():
+    server = load_server()
+    raw = json.dumps({"filename": "a.png", "content": "abc\\n中", "n": 1}).encode()
+    for cut in range(len(raw)):
+        reader = server.JsonStreamReader([raw[:cut]])
+        expect_error(ValueError, lambda: reader.parse("content", lambda data: None))
+
+
+def test_base64_stream_round_trip():
+    server = load_server()
+    rng = random.Random(SEED)
+    for _ in range(ROUNDS):
+        data = random_bytes(rng, rng.randint(0, 3000))
+        encoded = base64.b64encode(data)
+        if rng.random() < 0.5:
+            encoded = b"\n".join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+        prefix = rng.choice((b"", b"data:image/png;base64,", b"data:application/octet-stream;base64,"))
+        out = io.BytesIO()
+        decoder = server.Base64StreamDecoder(out)
+        for chunk in split_random(prefix + encoded, rng):
+            decoder.feed(chunk)
+        decoder.close()
+        assert out.getvalue() == data
+        assert decoder.size == len(data)
+        assert decoder.received == len(prefix) + len(encoded)
+
+
+def test_json_base64_pipeline():
+    """旧客户端 /save 的完整路径：JSON 流式字段直接送入 base64 解码"""
+    server = load_server()
+    rng = random.Random(SEED)
+    for _ in range(ROUNDS // 4 or 1):
+        data = random_bytes(rng, rng.randint(0, 20000))
+        content = "data:image/png;base64," + base64.b64encode(data).decode()
+        raw = json.dumps({"filename": "a.png", "content": content, "subfolder": ""}).encode()
+        out = io.BytesIO()
+        decoder = server.Base64StreamDecoder(out)
+        fields = server.JsonStreamReader(split_random(raw, rng)).parse("content", decoder.feed)
+        decoder.close()
+        assert out.getvalue() == data
+        assert fields == {"filename": "a.png", "subfolder": ""}
+
+
+# ---------- parse_byte_range ----------
+
+def test_parse_byte_range():
+    server = load_server()
+    cases = [
+        ("bytes=0-99", 1000, (0, 99)),
+        ("bytes=100-", 1000, (100, 999)),
+        ("bytes=-100", 1000, (900, 999)),
+        ("bytes=-5000", 1000, (0, 999)),
+        ("bytes=990-2000", 1000, (990, 999)),
+        ("bytes=999-999", 1000, (999, 999)),
+        (" bytes = 1 - 2 ", 1000, (1, 2)),
+        ("BYTES=0-0", 1, (0, 0)),
+        ("bytes=1000-", 1000, False),
+        ("bytes=1000-1001", 1000, False),
+        ("bytes=-0", 1000, False),
+        ("bytes=-1", 0, False),
+        ("bytes=0-", 0, False),
+        ("bytes=5-1", 1000, None),
+        ("bytes=0-1,5-9", 1000, None),
+        ("bytes=abc-", 1000, None),
+        ("bytes=-abc", 1000, None),
+        ("bytes=0", 1000, None),
+        ("items=0-1", 1000, None),
+        ("", 1000, None),
+        (None, 1000, None),
+    ]
+    for value, size, expected in cases:
+        got = server.parse_byte_range(value, size)
+        assert got == expected, (value, size, got, expected)
+    rng = random.Random(SEED)
+    for _ in range(ROUNDS * 5):
+        size = rng.randint(0, 50)
+        start = rng.randint(0, 60)
+        end = rng.randint(start, 70)
+        got = server.parse_byte_range(f"bytes={start}-{end}", size)
+        if start >= size:
+            assert got is False
+        else:
+            assert got == (start, min(end, size - 1))
+
+
+# ---------- iter_chunked_request_body ----------
+
+class TrickleRaw(io.RawIOBase):
+    """每次只返回随机长度的少量字节，模拟 socket 上的短读"""
+
+    def __init__(self, data, rng):
+        self.data = data
+        self.pos = 0
+        self.rng = rng
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.rng.choice((1, 2, 3, 7, 64, 5000)), len(self.data) - self.pos)
+        buffer[:size] = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+
+def encode_chunked(body, rng, trailers=False):
+    out, pos = [], 0
+    while pos < len(body):
+        size = rng.randint(1, 3000)
+        piece = body[pos:pos + size]
+        pos += size
+        head = format(len(piece), rng.choice(("x", "X", "04x")))
+        if rng.random() < 0.2:
+            head += ";ext=1"
+        out.append(head.encode() + b"\r\n" + piece + b"\r\n")
+    out.append(b"0\r\n")
+    if trailers:
+        out.append(b"X-Checksum: 1\r\nX-Other: 2\r\n")
+    out.append(b"\r\n")
+    return b"".join(out)
+
+
+def make_rfile(data, rng):
+    return io.BufferedReader(TrickleRaw(data, rng), buffer_size=rng.choice((1, 8, 8192)))
+
+
+def test_chunked_round_trip():
+    server = load_server()
+    rng = random.Random(SEED)
+    for _ in range(ROUNDS):
+        body = random_bytes(rng, rng.randint(0, 20000))
+        encoded = encode_chunked(body, rng, trailers=rng.random() < 0.3)
+        rfile = make_rfile(encoded + b"NEXT", rng)
+        chunk_size = rng.choice((1, 7, 1024, 65536))
+        got = b"".join(server.iter_chunked_request_body(rfile, chunk_size=chunk_size))
+        assert got == body
+        assert rfile.read() == b"NEXT"  # 不多读下一请求的数据
+
+
+def test_chunked_limits_and_errors():
+    server = load_server()
+    rng = random.Random(SEED)
+    body = random_bytes(rng, 5000)
+    encoded = encode_chunked(body, rng)
+    expect_error(server.RequestBodyTooLarge, lambda: b"".join(server.iter_chunked_request_body(make_rfile(encoded, rng), max_size=4999)))
+    assert b"".join(server.iter_chunked_request_body(make_rfile(encoded, rng), max_size=5000)) == body
+    # 截断在结束块 "0\r\n\r\n" 之前的任意位置
+    for cut in (1, len(encoded) // 2, len(encoded) - 5):
+        expect_error(ConnectionResetError, lambda: b"".join(server.iter_chunked_request_body(make_rfile(encoded[:cut], rng))))
+    # 长度行只收到一部分 ("04a0" 截断为 "0") 不能当作结束块
+    for partial in (b"0", b"04", b"3\r\nabc\r\n0"):
+        expect_error(ConnectionResetError, lambda: b"".join(server.iter_chunked_request_body(make_rfile(partial, rng))))
+    expect_error(ValueError, lambda: b"".join(server.iter_chunked_request_body(make_rfile(b"zz\r\nabc\r\n0\r\n\r\n", rng))))
+    # 块长度与实际数据不符、块尾不是 CRLF：拒绝而不是错位继续解析
+    for framing in (b"3\r\nabcde\r\n0\r\n\r\n", b"5\r\nabc\r\n0\r\n\r\n", b"3\r\nabc\n0\r\n\r\n", b"3\r\nabcXY\r\n0\r\n\r\n"):
+        expect_error(ValueError, lambda: b"".join(server.iter_chunked_request_body(make_rfile(framing, rng))))
+
+
+TESTS = [
+    test_multipart_round_trip,
+    test_multipart_truncated,
+    test_json_stream_round_trip,
+    test_json_stream_truncated,
+    test_base64_stream_round_trip,
+    test_json_base64_pipeline,
+    test_parse_byte_range,
+    test_chunked_round_trip,
+    test_chunked_limits_and_errors,
+]
+
+
+def main():
+    global ROUNDS, SEED
+    parser = argparse.ArgumentParser(description="streaming parser chunk-boundary tests")
+    parser.add_argument("--rounds", type=int, default=ROUNDS)
+    parser.add_argument("--seed", type=int, default=SEED)
+    args = parser.parse_args()
+    ROUNDS, SEED = args.rounds, args.seed
+
+    load_server()
+    failed = 0
+    for test in TESTS:
+        try:
+            test()
+        except Exception as e:
+            failed += 1
+            print(f"  FAIL {test.__name__}: {type(e).__name__}: {str(e)[:300]}")
+        else:
+            print(f"  ok   {test.__name__}")
+    print(f"{len(TESTS) - failed}/{len(TESTS)} passed (rounds={ROUNDS}, seed={SEED})")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()